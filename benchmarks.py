@@ -0,0 +1,325 @@
+"""
+Benchmark suite over the pages and CSVs bundled with the repo.
+
+Every benchmark is a setup function registered under a name; it builds
+whatever it needs outside the timing (parsed pages, a temp database, a
+local server) and returns the call to time, optionally with a reset
+that puts its state back before each round:
+
+    parse/<engine>/<page>   parsers.parse on each bundled page
+    analyze/<page>          WebStructureAnalyzer.analyze()
+    extract/<site>          a compiled site spec (or __NEXT_DATA__) on its page
+    normalize/<csv>         typing a bundled CSV's columns
+    write/<format>          20,000 book rows through a sink, or a
+                            PriceHistory run of 5,000 products
+    crawl/<mode>            the books crawl against the local fixture server
+
+Results are appended to .benchmarks/results.jsonl with the git commit
+they were measured on. Each run is compared with the latest stored run
+of a different commit on the same machine, and a benchmark whose best
+time got more than `threshold` slower is flagged as a regression (exit
+status 1).
+
+    python benchmarks.py [name prefix ...] [--list] [--repeat N]
+                         [--threshold 0.2] [--against COMMIT] [--no-store]
+"""
+
+import contextlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from functools import partial
+
+RESULTS_PATH = os.path.join(".benchmarks", "results.jsonl")
+
+# name -> (setup(stack) returning the function to time, items per call)
+BENCHMARKS = {}
+
+
+def benchmark(name, items=None):
+    def register(setup):
+        BENCHMARKS[name] = (setup, items)
+        return setup
+    return register
+
+
+def _read(file_path):
+    # times.html was saved in the Windows code page, don't choke on it
+    with open(file_path, encoding="utf-8", errors="replace") as f:
+        return f.read()
+
+
+def _parse_setup(html, engine, stack):
+    from parsers import parse
+    return lambda: parse(html, engine)
+
+
+def _analyze_setup(file_path, stack):
+    from websrcInspect import WebStructureAnalyzer
+    analyzer = WebStructureAnalyzer(_read(file_path))
+    return analyzer.analyze
+
+
+def _spec_setup(name, stack):
+    from site_spec import _spec_fixtures, compile_spec
+    pages = {spec: pages for spec, pages, _ in _spec_fixtures()}[name]
+    plan = compile_spec(name)
+    path, html = pages[0]
+    return lambda: plan.extract(html, "http://localhost" + path)
+
+
+def _register_page_benchmarks():
+    from parsers import _fixture_pages, available_engines
+    from websrcInspect import BUNDLED_PAGES
+
+    for page, html, _ in _fixture_pages():
+        for engine in available_engines():
+            benchmark(f"parse/{engine}/{page}")(partial(_parse_setup, html, engine))
+    for file_path in BUNDLED_PAGES:
+        benchmark(f"analyze/{file_path}")(partial(_analyze_setup, file_path))
+    for site in ("books", "imdb", "sapphire"):
+        benchmark(f"extract/{site}")(partial(_spec_setup, site))
+
+
+@benchmark("extract/walmart")
+def _walmart_setup(stack):
+    from next_data import extract_product
+    with open("walmart_data.html", "rb") as f:
+        blob = f.read()
+    page = (b'<!DOCTYPE html><html><head><title>Walmart.com</title></head><body><div id="__next"></div>'
+            b'<script id="__NEXT_DATA__" type="application/json">' + blob + b"</script></body></html>")
+    return lambda: extract_product(page)
+
+
+def _normalize_setup(file_name, stack):
+    import pandas as pd
+    from normalize import BUNDLED_CSVS
+    raw = pd.read_csv(file_name, dtype=str, keep_default_na=False)
+    return lambda: BUNDLED_CSVS[file_name](raw)
+
+
+for _csv in ("books_data.csv", "imdb_top_movies.csv", "world_capitals_weather.csv"):
+    benchmark(f"normalize/{_csv}")(partial(_normalize_setup, _csv))
+
+WRITE_ROWS = 20_000
+
+
+def _book_rows():
+    import csv
+    with open("books_data.csv", newline="", encoding="utf-8") as f:
+        rows = list(csv.reader(f))[1:]
+    return (rows * (WRITE_ROWS // len(rows) + 1))[:WRITE_ROWS]
+
+
+def _sink_setup(extension, stack):
+    from sinks import open_sink
+    rows = _book_rows()
+    path = os.path.join(stack.enter_context(tempfile.TemporaryDirectory()), "rows" + extension)
+
+    def write():
+        with open_sink(path, ["Title", "Price", "Rating"]) as sink:
+            sink.write_all(rows)
+    return write
+
+
+for _extension in (".csv", ".jsonl", ".parquet"):
+    benchmark(f"write/{_extension[1:]}", items=WRITE_ROWS)(partial(_sink_setup, _extension))
+
+
+@benchmark("write/price_history", items=5000)
+def _price_history_setup(stack):
+    from price_history import PriceHistory
+    directory = stack.enter_context(tempfile.TemporaryDirectory())
+    rounds = iter(range(10 ** 9))
+    runs = iter(range(1, 10 ** 9))
+    store = None
+
+    def products(run):
+        return [{"url": f"https://example.com/p/{n}", "title": f"Product {n}", "price": f"Rs.{1000 + n + run}.00"}
+                for n in range(5000)]
+
+    def reset():
+        # A new database with one run in it before every round, so every
+        # round times the same writes against a table of the same size
+        nonlocal store
+        if store is not None:
+            store.close()
+        store = PriceHistory(os.path.join(directory, f"history-{next(rounds)}.db"))
+        store.record(products(0), observed_at="run 000000000")
+
+    def record():
+        # Every run changes every price, the most a daily run can write
+        run = next(runs)
+        store.record(products(run), observed_at=f"run {run:09d}")
+
+    stack.callback(lambda: store and store.close())
+    return record, reset
+
+
+def _crawl_setup(mode, stack):
+    import asyncio
+    from bookscrapingproject import scrape_books, scrape_books_async
+    from fixture_server import FixtureServer, books_catalogue_pages
+
+    server = stack.enter_context(FixtureServer(books_catalogue_pages()))
+    url = server.url("/catalogue/page-1.html")
+    if mode == "serial":
+        return lambda: scrape_books(url)
+    return lambda: asyncio.run(scrape_books_async(url, concurrency=10))
+
+
+for _mode in ("serial", "async"):
+    benchmark(f"crawl/books-{_mode}", items=50)(partial(_crawl_setup, _mode))
+
+
+def time_call(function, repeat=5, min_round=0.05, reset=None):
+    """Best and median seconds per call over `repeat` rounds, each round
+    calling the function often enough to last at least `min_round`.
+    reset() runs before every round, outside the timing"""
+    reset = reset or (lambda: None)
+    reset()
+    function()  # warm-up: imports, caches, connections
+    number = 1
+    while True:
+        reset()
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_round:
+            break
+        number *= max(2, int(min_round / max(elapsed, 1e-9) * 1.2))
+    samples = [elapsed / number]
+    for _ in range(repeat - 1):
+        reset()
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        samples.append((time.perf_counter() - start) / number)
+    return {"best": min(samples), "median": statistics.median(samples), "rounds": repeat, "number": number}
+
+
+def _git(*arguments):
+    try:
+        return subprocess.run(["git", *arguments], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def _environment():
+    return {
+        "commit": _git("rev-parse", "--short", "HEAD") or "unknown",
+        "dirty": bool(_git("status", "--porcelain", "--untracked-files=no")),
+        "machine": f"{platform.node()} {platform.machine()} python {platform.python_version()}",
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+def load_runs(path=RESULTS_PATH):
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def store_run(run, path=RESULTS_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(json.dumps(run) + "\n")
+
+
+def baseline_for(run, runs, against=None):
+    """The stored run to compare with: `against` if given, else the latest
+    one from another commit on this machine"""
+    for previous in reversed(runs):
+        if previous["machine"] != run["machine"]:
+            continue
+        if against and previous["commit"].startswith(against):
+            return previous
+        if not against and previous["commit"] != run["commit"]:
+            return previous
+    return None
+
+
+def compare(name, result, baseline, threshold=0.2):
+    """One line for a result, and its slowdown if it is a regression"""
+    line = f"  {name:<44} best {result['best'] * 1000:9.3f} ms  median {result['median'] * 1000:9.3f} ms"
+    if result.get("items"):
+        line += f"  {result['items'] / result['best']:>10,.0f} items/s"
+    before = baseline["results"].get(name) if baseline else None
+    if before is None:
+        return line, None
+    change = result["best"] / before["best"] - 1
+    line += f"  {change:+7.1%} vs {baseline['commit']}"
+    if change > threshold:
+        return line + "  REGRESSION", change
+    return line + ("  faster" if change < -threshold else ""), None
+
+
+def run_benchmarks(prefixes=(), repeat=5, baseline=None, threshold=0.2):
+    """Run the benchmarks whose names start with one of `prefixes` (all by
+    default), printing each against the baseline as it finishes"""
+    _register_page_benchmarks()
+    run = _environment()
+    run["results"] = {}
+    regressions = []
+    for name, (setup, items) in BENCHMARKS.items():
+        if prefixes and not name.startswith(tuple(prefixes)):
+            continue
+        with contextlib.ExitStack() as stack:
+            try:
+                function = setup(stack)
+            except ImportError as e:  # optional dependency not installed
+                print(f"  {name:<44} skipped ({e})")
+                continue
+            # A setup returns the function to time, or it and a reset to
+            # run before every round
+            function, reset = function if isinstance(function, tuple) else (function, None)
+            result = time_call(function, repeat, reset=reset)
+        result["items"] = items
+        run["results"][name] = result
+        line, change = compare(name, result, baseline, threshold)
+        print(line, flush=True)
+        if change is not None:
+            regressions.append((name, change))
+    return run, regressions
+
+
+def main(arguments):
+    options = {"--repeat": "5", "--threshold": "0.2", "--against": None}
+    flags = set()
+    prefixes = []
+    while arguments:
+        argument = arguments.pop(0)
+        if argument in options:
+            options[argument] = arguments.pop(0)
+        elif argument.startswith("--"):
+            flags.add(argument)
+        else:
+            prefixes.append(argument)
+    if "--list" in flags:
+        _register_page_benchmarks()
+        print("\n".join(name for name in BENCHMARKS if not prefixes or name.startswith(tuple(prefixes))))
+        return 0
+
+    environment = _environment()
+    baseline = baseline_for(environment, load_runs(), options["--against"])
+    print(f"commit {environment['commit']}{' (uncommitted changes)' if environment['dirty'] else ''} "
+          f"on {environment['machine']}")
+    print(f"compared with {baseline['commit']} from {baseline['date']}" if baseline
+          else "no earlier run to compare with")
+    run, regressions = run_benchmarks(prefixes, int(options["--repeat"]), baseline, float(options["--threshold"]))
+    if "--no-store" not in flags:
+        store_run(run)
+    for name, change in regressions:
+        print(f"REGRESSION {name}: {change:+.1%} slower")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
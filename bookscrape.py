@@ -1,18 +1,18 @@
-import requests
-from bs4 import BeautifulSoup
+from fetcher import fetch
+from parsers import parse
 
 url = "https://books.toscrape.com/"
 
 # Setting verify=False to bypass SSL verification
-r = requests.get(url)
+r = fetch(url)
 
-soup = BeautifulSoup(r.text, "html.parser")
+soup = parse(r.text)
 
-catalogue = soup.select("article",class_= "product_prod")
+catalogue = soup.select("article.product_pod")
 
 for book in catalogue:
-    title = book.h3.a['title']
-    price = book.find("p",class_="price_color")
+    title = book.select_one("h3 a")['title']
+    price = book.find("p",class_="price_color").text()
     rating = book.find("p", class_ = "star-rating")["class"][1]
     availaibility = book.find("p", class_ = "instock availaibility")
 
@@ -1,54 +1,268 @@
 
+import asyncio
+import re
+import sys
+import time
+from urllib.parse import urljoin
+
 import requests
-from bs4 import BeautifulSoup
-import csv
 
+from change_detection import REGIONS
+from fetcher import fetch
+from parsers import parse
+from sinks import CsvSink
+
+START_URL = "https://books.toscrape.com/catalogue/page-1.html"
+
+# Catalogue pages are numbered like ".../page-7.html"
+PAGE_PATTERN = re.compile(r"page-(\d+)\.html$")
+PAGE_COUNT_PATTERN = re.compile(r"Page \d+ of (\d+)")
+
+# All parse_books_page reads, for a partial parse with html.parser
+PAGE_TARGETS = ("article.product_pod", "li.next", "li.current")
+# Bump when parse_books_page returns something different, so a
+# ChangeDetector doesn't serve rows the old version stored
+PARSER_VERSION = 1
+
+
+def parse_books_page(html, url, engine=None, only=None):
+    soup = parse(html, engine, only=only)  # Parse HTML
+    books_data = []
+
+    # Find all book containers
+    books = soup.find_all("article", class_="product_pod")
+
+    for book in books:
+        # Extract book title
+        title = book.select_one("h3 a")["title"]
+
+        # Extract book price
+        price = book.find("p", class_="price_color").text()
+
+        # Extract book rating (class names contain the rating)
+        rating_class = book.find("p", class_="star-rating")["class"]
+        rating = rating_class[1]  # Second class name is the rating (e.g., "Three")
+
+        books_data.append([title, price, rating])  # Append data to the list
+
+    # Check if there's a "Next" page button
+    next_page = soup.find("li", class_="next")
+    next_url = urljoin(url, next_page.select_one("a")["href"]) if next_page else None
 
-def scrape_books():
-    url = "https://books.toscrape.com/catalogue/page-1.html"
-    base_url = "https://books.toscrape.com/catalogue/"
-    
-    books_data = []  # List to store book details
-    
+    # "Page 1 of 50" tells us how many pages to fetch up front
+    current = soup.find("li", class_="current")
+    match = PAGE_COUNT_PATTERN.search(current.text()) if current else None
+    page_count = int(match.group(1)) if match else None
+
+    return books_data, next_url, page_count
+
+
+def _parse_page(html, url, detector=None):
+    # With a ChangeDetector, pages whose book list is unchanged since the
+    # last run reuse that run's rows instead of being parsed again
+    if detector is None:
+        return parse_books_page(html, url)
+    result, _ = detector.process(url, html, lambda page: parse_books_page(page, url), REGIONS["books"],
+                                 version=PARSER_VERSION)
+    return result
+
+
+def iter_books(url=START_URL, detector=None, dedup=None):
+    """Yield book rows page by page, so they can be written as they come.
+    With a dedup.Deduplicator, rows already yielded are dropped, the crawl
+    stops when the pager leads back to a page it has, and a page found to
+    mirror another one isn't fetched again by later crawls"""
+    if dedup is not None:
+        from dedup import canonical_url
+    visited = set()  # this chain's pages, exact: a false positive would cut it short
     while url:  # Loop through all pages
-        response = requests.get(url)  # Fetch the webpage
-        soup = BeautifulSoup(response.text, "html.parser")  # Parse HTML
-        
-        # Find all book containers
-        books = soup.find_all("article", class_="product_pod")
-        
-        for book in books:
-            # Extract book title
-            title = book.h3.a["title"]
-
-            # Extract book price
-            price = book.find("p", class_="price_color").text.strip()
-
-            # Extract book rating (class names contain the rating)
-            rating_class = book.find("p", class_="star-rating")["class"]
-            rating = rating_class[1]  # Second class name is the rating (e.g., "Three")
-
-            books_data.append([title, price, rating])  # Append data to the list
-
-        # Check if there's a "Next" page button
-        next_page = soup.find("li", class_="next")
-        if next_page:
-            url = "https://books.toscrape.com/catalogue/" + next_page.a["href"]
+        if dedup is not None:
+            page = canonical_url(url)
+            if page in visited:
+                break  # the pager led back to a page we have
+            visited.add(page)
+            mirrored, next_url = dedup.mirror(url)
+            if mirrored:
+                url = next_url  # go where the mirror led last time
+                continue
+        response = fetch(url)  # Fetch the webpage
+        rows, next_url, _ = _parse_page(response.text, url, detector)  # next_url is None on the last page
+        if dedup is None:
+            yield from rows
         else:
-            url = None  # Stop loop if no next page
+            # A near-duplicate page can still hold a book that changed,
+            # its rows go through the row seen-set like any other's
+            if not dedup.new_content("\n".join(" ".join(row) for row in rows), url):
+                dedup.add_mirror(url, next_url)
+            yield from dedup.rows(rows)
+        url = next_url
+
+
+def scrape_books(url=START_URL, detector=None):
+    return list(iter_books(url, detector))
+
+
+def scrape_books_resumable(url=START_URL, frontier=None):
+    """Crawl through a frontier.Frontier: pages it already has as done are
+    not fetched again, so a stopped crawl continues where it was. Without
+    one it opens books_frontier.db, and closes it when done"""
+    from frontier import Frontier
+
+    own = frontier is None
+    frontier = frontier or Frontier("books_frontier.db")
+    try:
+        frontier.add([url])
+        while (page_url := frontier.next()) is not None:
+            try:
+                response = fetch(page_url)
+                response.raise_for_status()
+            except requests.RequestException as e:
+                frontier.failed(page_url, e)
+                continue
+            rows, next_url, _ = parse_books_page(response.text, page_url)
+            if next_url:
+                frontier.add([next_url])  # goes into the same checkpoint as done()
+            frontier.done(page_url, rows)
+
+        return [row for _, rows in frontier.results() for row in rows]
+    finally:
+        if own:
+            frontier.close()  # writes the last checkpoint
+
+
+def books_task(url):
+    """One catalogue page as a work_queue task: its rows, and the pages
+    to queue next. Page 1 queues every page it counts, so all the
+    workers get one at once instead of following the "next" links"""
+    response = fetch(url)
+    response.raise_for_status()
+    rows, next_url, page_count = parse_books_page(response.text, url)
+    follow = [next_url] if next_url else []
+    match = PAGE_PATTERN.search(url)
+    if match and match.group(1) == "1" and page_count:
+        follow += [_page_url(url, number) for number in range(2, page_count + 1)]
+    return rows, follow
+
+
+def scrape_books_distributed(url=START_URL, workers=4, path="books_queue.db"):
+    """Crawl with `workers` processes sharing a work_queue.WorkQueue at
+    `path`. Workers on other machines can join with
+    python work_queue.py --worker <path> bookscrapingproject:books_task
+    Raises work_queue.CrawlError if a page failed or was never fetched,
+    rather than returning the rows of the pages that were"""
+    from work_queue import crawl
+
+    with crawl(path, [url], "bookscrapingproject:books_task", workers) as queue:
+        return [row for _, rows in queue.results() for row in rows]
+
+
+def _page_url(url, number):
+    # Swap the page number in a ".../page-N.html" url
+    return PAGE_PATTERN.sub(f"page-{number}.html", url)
+
+
+async def _fetch_page(url, semaphore, detector=None):
+    # requests is blocking, so run it in a worker thread and let the
+    # semaphore cap how many requests are in flight at once
+    async with semaphore:
+        response = await asyncio.to_thread(fetch, url)
+    if response.status_code != 200:
+        return None
+    return await asyncio.to_thread(_parse_page, response.text, url, detector)
+
+
+async def scrape_books_async(url=START_URL, concurrency=10, detector=None):
+    """Fetch catalogue pages concurrently, returning rows in page order"""
+    semaphore = asyncio.Semaphore(concurrency)
+    books_data = []
+
+    page = await _fetch_page(url, semaphore, detector)
+    while page:
+        rows, next_url, page_count = page
+        books_data.extend(rows)
+        if not next_url:
+            break
+
+        match = PAGE_PATTERN.search(url)
+        if not match or next_url != _page_url(url, int(match.group(1)) + 1):
+            # The url pattern doesn't hold, follow the "next" link instead
+            url = next_url
+            page = await _fetch_page(url, semaphore, detector)
+            continue
+
+        # Guess the next batch of page urls: every remaining page when the
+        # page count is known, otherwise one window of `concurrency` pages
+        number = int(match.group(1))
+        last = page_count if page_count else number + concurrency
+        guesses = [_page_url(url, n) for n in range(number + 1, last + 1)]
+        pages = await asyncio.gather(*(_fetch_page(guess, semaphore, detector) for guess in guesses))
+
+        # Keep guessed pages only while each one is the "next" of the one
+        # before it, so the rows match what following the links would give
+        for guess, result in zip(guesses, pages):
+            if guess != next_url or result is None:
+                break
+            url = guess
+            rows, next_url, page_count = result
+            books_data.extend(rows)
+            if not next_url:
+                return books_data
+
+        # Carry on from the first page we couldn't take from the batch
+        url = next_url
+        page = await _fetch_page(url, semaphore, detector)
 
     return books_data
 
+
 def save_to_csv(data, filename="books_data.csv"):
-    with open(filename, mode="w", newline="", encoding="utf-8") as file:
-        writer = csv.writer(file)
-        writer.writerow(["Title", "Price", "Rating"])  # Write header
-        writer.writerows(data)  # Write book data
+    # data can be a generator: rows are written in batches as they arrive,
+    # and filename is only replaced once the crawl has finished
+    with CsvSink(filename, columns=["Title", "Price", "Rating"]) as sink:
+        sink.write_all(data)
 
     print(f"Data saved to {filename}")
 
 
+def benchmark_crawl(delay=0.1, limits=(1, 2, 5, 10, 25)):
+    # Crawl a local copy of the catalogue where every page takes `delay`
+    # seconds to serve, wall clock time should drop as the limit grows
+    from fixture_server import FixtureServer, books_catalogue_pages
+
+    with FixtureServer(books_catalogue_pages(), delay=delay) as server:
+        start_url = server.url("/catalogue/page-1.html")
+
+        start = time.perf_counter()
+        expected = scrape_books(start_url)
+        print(f"serial       : {time.perf_counter() - start:.2f}s ({len(expected)} books)")
+
+        for limit in limits:
+            start = time.perf_counter()
+            rows = asyncio.run(scrape_books_async(start_url, concurrency=limit))
+            elapsed = time.perf_counter() - start
+            status = "same rows" if rows == expected else "ROWS DIFFER"
+            print(f"concurrency {limit:<3}: {elapsed:.2f}s ({status})")
+
 
 if __name__ == "__main__":
-    books = scrape_books()
-    save_to_csv(books)
+    if "--bench" in sys.argv:
+        benchmark_crawl()
+    else:
+        # --incremental keeps page fingerprints between runs and skips
+        # parsing catalogue pages that haven't changed
+        from change_detection import ChangeDetector
+
+        detector = ChangeDetector() if "--incremental" in sys.argv else None
+        if "--async" in sys.argv:
+            books = asyncio.run(scrape_books_async(detector=detector))
+        elif "--resume" in sys.argv:
+            # Progress is kept in books_frontier.db, rerun to continue
+            books = scrape_books_resumable()
+        elif "--workers" in sys.argv:
+            # Worker processes share books_queue.db, rerun to continue
+            books = scrape_books_distributed(workers=int(sys.argv[sys.argv.index("--workers") + 1]))
+        else:
+            books = iter_books(detector=detector)
+        save_to_csv(books)
+        if detector:
+            print(detector.report())
@@ -0,0 +1,183 @@
+"""
+Skip parsing pages whose content hasn't changed since the last run.
+
+Scheduled jobs fetch the same listing pages again and again, and most of
+them come back with the same products. For each URL we keep a
+fingerprint of the page's content region (the product list, not the
+whole page, so ads and timestamps around it don't count) together with
+what extraction returned last time. When the fingerprint matches, the
+stored result is reused and the page is never parsed.
+
+A stored result is only as good as the extractor that made it, so it is
+kept with the extractor's version: pass a new version whenever the
+extractor's output changes (a new column, a fixed parse) and every page
+is parsed again once instead of serving the old rows.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+# site -> (start, end) markers around the content that extraction reads
+REGIONS = {
+    # Product list and the pager (extraction reads the next link from it)
+    "books": (b'<ol class="row">', b"</section>"),
+    # Product grid of a collection page, up to its "show more" footer
+    "sapphire": (b'class="row product-grid', b'class="col-12 grid-footer"'),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS page (
+    url TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL,
+    result TEXT NOT NULL,
+    parse_seconds REAL NOT NULL,
+    checked_at TEXT NOT NULL,
+    version TEXT NOT NULL DEFAULT ''
+)
+"""
+
+
+def content_region(page, region=None):
+    """Bytes between a region's start and end markers, the whole page when
+    no region is given or a marker is missing"""
+    if isinstance(page, str):
+        page = page.encode("utf-8")
+    if region is None:
+        return page
+    start_marker, end_marker = region
+    start = page.find(start_marker)
+    end = page.find(end_marker, start + 1) if start != -1 else -1
+    if start == -1 or end == -1:
+        return page
+    return page[start:end]
+
+
+def fingerprint(page, region=None):
+    return hashlib.blake2b(content_region(page, region), digest_size=16).hexdigest()
+
+
+class ChangeDetector:
+    def __init__(self, path="page_fingerprints.db"):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(SCHEMA)
+        if "version" not in [row[1] for row in self.conn.execute("PRAGMA table_info(page)")]:
+            # Results stored before versions were: they match no version
+            self.conn.execute("ALTER TABLE page ADD COLUMN version TEXT NOT NULL DEFAULT ''")
+        self._lock = threading.Lock()
+        self.stats = {"skipped": 0, "reparsed": 0, "seconds_saved": 0.0}
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def process(self, url, page, extract, region=None, version=""):
+        """Return (result, changed): extract(page) when the page's region
+        changed or the result was stored by another `version` of the
+        extractor, the stored result of the last run when neither did. The
+        result has to be JSON serialisable (tuples come back as lists)."""
+        start = time.perf_counter()
+        digest = fingerprint(page, region)
+        version = str(version)
+        checked_at = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT fingerprint, result, parse_seconds, version FROM page WHERE url = ?", (url,)
+            ).fetchone()
+        if row and row[0] == digest and row[3] == version:
+            result = json.loads(row[1])
+            with self._lock, self.conn:
+                self.conn.execute("UPDATE page SET checked_at = ? WHERE url = ?", (checked_at, url))
+                self.stats["skipped"] += 1
+                # What parsing cost last time, less what the check cost now
+                self.stats["seconds_saved"] += row[2] - (time.perf_counter() - start)
+            return result, False
+
+        start = time.perf_counter()
+        result = extract(page)
+        parse_seconds = time.perf_counter() - start
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO page (url, fingerprint, result, parse_seconds, checked_at, version) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (url, digest, json.dumps(result), parse_seconds, checked_at, version),
+            )
+            self.stats["reparsed"] += 1
+        return result, True
+
+    def report(self):
+        return (f"{self.stats['skipped']} pages skipped, {self.stats['reparsed']} reparsed, "
+                f"{self.stats['seconds_saved'] * 1000:.0f} ms of parsing saved")
+
+
+def benchmark_skip(changed_pages=5):
+    # Crawl the local catalogue twice with a detector, changing a few
+    # prices between runs; the second run should only parse those pages
+    import os
+    import tempfile
+    from bookscrapingproject import scrape_books
+    from fixture_server import FixtureServer, books_catalogue_pages
+
+    pages = books_catalogue_pages()
+    db_path = os.path.join(tempfile.mkdtemp(prefix="change_detection_"), "pages.db")
+    with FixtureServer(pages) as server, ChangeDetector(db_path) as detector:
+        start_url = server.url("/catalogue/page-1.html")
+        for label, change in (("first run", 0), ("unchanged", 0), (f"{changed_pages} pages changed", changed_pages)):
+            if change:
+                for number in range(1, change + 1):
+                    path = f"/catalogue/page-{number * 7}.html"
+                    pages[path] = pages[path].replace("£", "£1", 1)
+            detector.stats = {"skipped": 0, "reparsed": 0, "seconds_saved": 0.0}
+            start = time.perf_counter()
+            rows = scrape_books(start_url, detector=detector)
+            elapsed = time.perf_counter() - start
+            same = rows == scrape_books(start_url)
+            print(f"{label:<18} {elapsed:.2f}s, {len(rows)} books (same as full parse: {same}): "
+                  f"{detector.report()}")
+
+
+def check_versions():
+    # The same page under a new extractor version is parsed again and its
+    # new result kept; the old version's rows are never served for it
+    import os
+    import tempfile
+
+    directory = tempfile.mkdtemp(prefix="change_detection_")
+    path = os.path.join(directory, "pages.db")
+    url, page = "https://example.com/list", "<ol class=\"row\"><li>A Light in the Attic £51.77</li></ol>"
+    results = []
+    with ChangeDetector(path) as detector:
+        for version, extract in ((1, lambda text: ["A Light"]), (1, lambda text: ["not called"]),
+                                 (2, lambda text: ["A Light in the Attic", 51.77])):
+            results.append(detector.process(url, page, extract, version=version))
+    # A database from before versions were stored: its result isn't reused
+    with sqlite3.connect(os.path.join(directory, "old.db")) as conn:
+        conn.execute("CREATE TABLE page (url TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, result TEXT NOT NULL, "
+                     "parse_seconds REAL NOT NULL, checked_at TEXT NOT NULL)")
+        conn.execute("INSERT INTO page VALUES (?, ?, '[\"old\"]', 0.1, '2024-01-01 00:00:00')", (url, fingerprint(page)))
+    conn.close()
+    with ChangeDetector(os.path.join(directory, "old.db")) as detector:
+        results.append(detector.process(url, page, lambda text: ["new"], version=1))
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+    expected = [(["A Light"], True), (["A Light"], False), (["A Light in the Attic", 51.77], True), (["new"], True)]
+    ok = results == expected
+    print(f"{'ok ' if ok else 'BAD'} extractor versions: {results}")
+    return ok
+
+
+if __name__ == "__main__":
+    import sys
+    if "--check" in sys.argv:
+        sys.exit(0 if check_versions() else 1)
+    benchmark_skip()
@@ -0,0 +1,422 @@
+"""
+Keep duplicate fetches and duplicate rows away from the writers.
+
+Three layers, cheapest first:
+
+    canonical_url  one spelling per page: lower-case scheme and host,
+                   no default port, fragment or tracking parameters
+                   (utm_*, gclid on every site, and per site in
+                   HOST_PARAMETERS: Amazon's ref/crid/sprefix, Walmart's
+                   classType/athbdg/adsRedirect ...), query sorted
+    BloomFilter    seen-set of fixed size: `capacity` items at
+                   `error_rate` false positives (10M URLs at 1% is 12 MB,
+                   a set of the same URLs is well over 1 GB), no false
+                   negatives
+    SimHash        64-bit fingerprint of a page's extracted text; pages
+                   within `distance` bits of one seen before are the same
+                   content under another URL (a product listed in several
+                   categories, a page that only changed its ads)
+
+Deduplicator puts the three together for a crawl: new_url() before
+fetching, new_content() after extracting, rows() in front of a sink;
+bookscrapingproject.iter_books(dedup=...) and Frontier(canonicalize=...)
+take them. new_url() is for URLs only worth one fetch, like links found
+on listing pages. A pager chain needs every page for its next link, so
+iter_books doesn't consult the URL filter: it keeps an exact set of the
+current chain's pages to end pager loops. A near-duplicate page only
+tells later crawls which URLs they needn't fetch (`mirrors`, for
+`mirror_ttl` seconds, then the page is fetched and checked again); its
+rows still go through rows(), since one changed product leaves the
+fingerprint within `distance`. rows() keeps exact keys (128-bit hashes
+of the rows, about 70 bytes each) rather than a Bloom filter, whose
+false positives would drop new rows without a trace.
+
+    python dedup.py [--bench]
+"""
+
+import hashlib
+import math
+import re
+import sys
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from lazy import lazy_module
+
+try:
+    np = lazy_module("numpy")  # canonical_url and the Bloom filter don't need it
+except ImportError:  # SimHash falls back to counting bits in Python
+    np = None
+
+# Query parameters that only say where a click came from, on any site
+TRACKING_PARAMETERS = {
+    "gclid", "gclsrc", "dclid", "fbclid", "msclkid", "yclid", "mc_cid", "mc_eid", "igshid",
+    "_ga", "_gl", "spm", "srsltid",
+}
+TRACKING_PREFIXES = ("utm_", "pd_rd_", "pf_rd_")
+
+# Host (or parent domain) -> more parameters that don't change the page.
+# "ref" is only tracking on some sites (elsewhere it names a branch or a
+# version), so it is listed per site
+HOST_PARAMETERS = {
+    "amazon.com": {"ref", "ref_", "crid", "sprefix", "qid", "sr", "keywords", "dib", "dib_tag", "psc", "th", "_encoding",
+                   "content-id", "smid"},
+    "walmart.com": {"classType", "athbdg", "adsRedirect", "athcpid", "athpgid", "athznid", "athieid",
+                    "athstid", "athguid", "athancid", "athena", "from", "wl13", "wmlspartner"},
+}
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+# Amazon puts its ref tag in the path too: /dp/B08VJYZF2K/ref=sr_1_3
+AMAZON_REF_PATH = re.compile(r"/ref=[^/]*$")
+
+
+def _host_parameters(host, host_parameters):
+    parts = host.split(".")
+    for start in range(len(parts) - 1):
+        domain = ".".join(parts[start:])
+        if domain in host_parameters:
+            return domain, host_parameters[domain]
+    return None, ()
+
+
+def canonical_url(url, host_parameters=HOST_PARAMETERS):
+    """The one spelling of url that all its tracking variants share.
+    host_parameters maps a domain to the parameters stripped on it and
+    its subdomains, on top of TRACKING_PARAMETERS"""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    hostname = (parts.hostname or "").rstrip(".")
+    domain, site_parameters = _host_parameters(hostname, host_parameters)
+    host = f"[{hostname}]" if ":" in hostname else hostname  # IPv6 keeps its brackets
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+
+    path = parts.path or "/"
+    if domain == "amazon.com":
+        path = AMAZON_REF_PATH.sub("", path) or "/"
+
+    query = [
+        (name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if name not in TRACKING_PARAMETERS and not name.startswith(TRACKING_PREFIXES)
+        and name not in site_parameters
+    ]
+    return urlunsplit((scheme, host, path, urlencode(sorted(query)), ""))
+
+
+def _hash128(item):
+    if isinstance(item, str):
+        item = item.encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(item, digest_size=16).digest(), "little")
+
+
+class BloomFilter:
+    def __init__(self, capacity=10_000_000, error_rate=0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        # Optimal size and hash count for `capacity` items at `error_rate`
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)  # bits
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        # Double hashing: k positions from the two halves of one 128-bit hash
+        value = _hash128(item)
+        first, second = value & 0xFFFFFFFFFFFFFFFF, value >> 64 | 1
+        size = self.size
+        return [(first + i * second) % size for i in range(self.hashes)]
+
+    def add(self, item):
+        """Add item, True if it was not in the filter before"""
+        new = False
+        bits = self.bits
+        for position in self._positions(item):
+            byte, mask = position >> 3, 1 << (position & 7)
+            if not bits[byte] & mask:
+                bits[byte] |= mask
+                new = True
+        if new:
+            self.count += 1
+        return new
+
+    def __contains__(self, item):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def memory(self):
+        return len(self.bits)
+
+    def expected_error_rate(self):
+        """False positive rate at the current fill"""
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def simhash(text, shingle=3):
+    """64-bit SimHash of text's word `shingle`-grams"""
+    words = WORD_PATTERN.findall(text.lower())
+    features = [" ".join(words[i:i + shingle]) for i in range(max(1, len(words) - shingle + 1))]
+    digests = b"".join(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest() for feature in features)
+    if np is not None:
+        # One row of 64 bits per feature, bit 0 first; a bit is set in the
+        # SimHash when more than half the features have it
+        bits = np.unpackbits(np.frombuffer(digests, dtype=np.uint8).reshape(-1, 8), axis=1, bitorder="little")
+        counts = bits.sum(axis=0, dtype=np.int64) * 2 - len(features)
+    else:
+        counts = [0] * 64
+        for start in range(0, len(digests), 8):
+            value = int.from_bytes(digests[start:start + 8], "little")
+            for bit in range(64):
+                counts[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit in range(64) if counts[bit] > 0)
+
+
+def hamming(a, b):
+    return bin(a ^ b).count("1")
+
+
+class SimHashIndex:
+    # Fingerprints within `distance` bits of each other agree exactly on at
+    # least one of distance + 1 blocks (pigeonhole), so a lookup only
+    # compares against fingerprints sharing a block. Extracted rows are
+    # short texts, a small edit moves a few more bits than on a full page:
+    # on the catalogue, edited pages were at most 6 bits away, different
+    # pages at least 15
+    def __init__(self, distance=6):
+        self.distance = distance
+        self.blocks = distance + 1
+        self.width = 64 // self.blocks
+        self.tables = [{} for _ in range(self.blocks)]
+        self.count = 0
+
+    def _keys(self, fingerprint):
+        mask = (1 << self.width) - 1
+        return [(fingerprint >> (block * self.width)) & mask for block in range(self.blocks)]
+
+    def find(self, fingerprint):
+        """A stored fingerprint within `distance` bits, or None"""
+        for table, key in zip(self.tables, self._keys(fingerprint)):
+            for other in table.get(key, ()):
+                if hamming(fingerprint, other) <= self.distance:
+                    return other
+        return None
+
+    def add(self, fingerprint):
+        for table, key in zip(self.tables, self._keys(fingerprint)):
+            table.setdefault(key, []).append(fingerprint)
+        self.count += 1
+
+
+class Deduplicator:
+    def __init__(self, capacity=10_000_000, error_rate=0.01, distance=6, mirror_ttl=86400):
+        self.urls = BloomFilter(capacity, error_rate)
+        self.rows_seen = set()  # _hash128 of every row key yielded
+        self.content = SimHashIndex(distance)
+        self.content_urls = {}  # fingerprint -> canonical URL it was first seen under
+        self.mirror_ttl = mirror_ttl
+        self.mirrors = {}  # canonical URL of a near-duplicate page -> (its next page, expires at)
+        self.stats = {"urls": 0, "duplicate_urls": 0, "pages": 0, "duplicate_pages": 0,
+                      "rows": 0, "duplicate_rows": 0}
+
+    def new_url(self, url):
+        """True the first time a page is seen under any of its URL variants"""
+        new = self.urls.add(canonical_url(url))
+        self.stats["urls" if new else "duplicate_urls"] += 1
+        return new
+
+    def new_content(self, text, url=None):
+        """True unless text is a near-duplicate of a page seen before under
+        another URL (the same page crawled again isn't a duplicate)"""
+        fingerprint = simhash(text)
+        page = canonical_url(url) if url else None
+        found = self.content.find(fingerprint)
+        if found is not None:
+            if page is None or self.content_urls[found] != page:
+                self.stats["duplicate_pages"] += 1
+                return False
+            return True
+        self.content.add(fingerprint)
+        self.content_urls[fingerprint] = page
+        self.stats["pages"] += 1
+        return True
+
+    def add_mirror(self, url, next_url):
+        """Remember that url held a near-duplicate page whose pager led to
+        next_url (None on a last page), for mirror_ttl seconds"""
+        self.mirrors[canonical_url(url)] = (next_url, time.time() + self.mirror_ttl)
+
+    def mirror(self, url):
+        """(True, its next page) while url is a remembered mirror, else
+        (False, None). An expired entry is dropped, so the page is
+        fetched and compared again"""
+        page = canonical_url(url)
+        next_url, expires_at = self.mirrors.get(page, (None, None))
+        if expires_at is None:
+            return False, None
+        if expires_at <= time.time():
+            del self.mirrors[page]
+            return False, None
+        return True, next_url
+
+    def rows(self, rows, key=None):
+        """Yield rows whose key (default: the whole row) wasn't seen before"""
+        seen = self.rows_seen
+        for row in rows:
+            value = _hash128(repr(key(row) if key else row))
+            if value not in seen:
+                seen.add(value)
+                self.stats["rows"] += 1
+                yield row
+            else:
+                self.stats["duplicate_rows"] += 1
+
+    def report(self):
+        s = self.stats
+        return (f"{s['duplicate_urls']} duplicate URLs, {s['duplicate_pages']} near-duplicate pages, "
+                f"{s['duplicate_rows']} duplicate rows dropped")
+
+
+# URLs from the scripts with their tracking, and variants of them
+SAMPLE_URLS = [
+    ("https://www.amazon.com/s?k=samsung&crid=XQQJ2J26JHOZ&sprefix=samsung%2Caps%2C533&ref=nb_sb_noss_1",
+     "https://www.amazon.com/s?k=samsung"),
+    ("https://WWW.Amazon.com:443/dp/B08VJYZF2K/ref=sr_1_3?utm_source=mail#reviews",
+     "https://www.amazon.com/dp/B08VJYZF2K"),
+    ("https://www.walmart.com/ip/Gawfolk-34-Inch-Curved-Gaming-Monitor-165hz-Ultrawide-WQHD-3440x1440-Screen-PC-"
+     "Computer-1500R-21-9/5239346994?classType=VARIANT&athbdg=L1600&adsRedirect=true",
+     "https://www.walmart.com/ip/Gawfolk-34-Inch-Curved-Gaming-Monitor-165hz-Ultrawide-WQHD-3440x1440-Screen-PC-"
+     "Computer-1500R-21-9/5239346994"),
+    ("https://pk.sapphireonline.pk/collections/man?page=2&utm_campaign=sale&fbclid=abc",
+     "https://pk.sapphireonline.pk/collections/man?page=2"),
+    ("http://books.toscrape.com:80/catalogue/page-2.html?b=2&a=1",
+     "http://books.toscrape.com/catalogue/page-2.html?a=1&b=2"),
+    ("http://[::1]:8080/catalogue/page-1.html?utm_source=x", "http://[::1]:8080/catalogue/page-1.html"),
+    ("https://GitHub.com/scrapy/scrapy/archive?ref=2.11#readme", "https://github.com/scrapy/scrapy/archive?ref=2.11"),
+]
+
+
+def check_canonical():
+    ok = True
+    for url, expected in SAMPLE_URLS:
+        got = canonical_url(url)
+        ok = ok and got == expected
+        print(f"{'ok ' if got == expected else 'BAD'} {got}")
+    return ok
+
+
+def benchmark_bloom(items=1_000_000, error_rate=0.01):
+    # Fill a filter sized for `items` to capacity and probe it with as many
+    # URLs it never saw; then what 10M URLs cost as a filter and as a set
+    import tracemalloc
+
+    urls = [f"https://books.toscrape.com/catalogue/book-{n}/index.html" for n in range(items)]
+    bloom = BloomFilter(items, error_rate)
+    start = time.perf_counter()
+    for url in urls:
+        bloom.add(url)
+    elapsed = time.perf_counter() - start
+    false_positives = sum(f"https://books.toscrape.com/catalogue/other-{n}/index.html" in bloom
+                          for n in range(items))
+    print(f"bloom, {items:,} URLs at capacity: {bloom.memory / 1e6:.2f} MB, {bloom.hashes} hashes, "
+          f"{elapsed / items * 1e6:.1f} us/add, false positives {false_positives / items:.3%} "
+          f"(target {error_rate:.1%}, expected {bloom.expected_error_rate():.3%})")
+
+    del urls
+    tracemalloc.start()
+    seen = {f"https://books.toscrape.com/catalogue/book-{n}/index.html" for n in range(items)}
+    per_url = tracemalloc.get_traced_memory()[0] / items
+    tracemalloc.stop()
+    del seen
+    big = BloomFilter(10_000_000, error_rate)
+    print(f"10M URLs: bloom filter {big.memory / 1e6:.1f} MB, a set of them ~{per_url * 10_000_000 / 1e6:,.0f} MB "
+          f"({per_url:.0f} bytes per URL)")
+
+
+def benchmark_simhash(distance=6):
+    # Catalogue pages' extracted rows: each page against itself with a few
+    # changes (near duplicates) and against every other page (distinct)
+    from bookscrapingproject import parse_books_page
+    from fixture_server import books_catalogue_pages
+
+    texts = []
+    for path, html in books_catalogue_pages().items():
+        rows, _, _ = parse_books_page(html, "http://localhost" + path)
+        texts.append("\n".join(" ".join(row) for row in rows))
+    fingerprints = [simhash(text) for text in texts]
+
+    # A near duplicate: one price changed and a "sponsored" line added
+    near = [simhash(text.replace(".", ",", 1) + "\nSponsored: today's deals") for text in texts]
+    caught = sum(hamming(a, b) <= distance for a, b in zip(fingerprints, near))
+    pairs = [(i, j) for i in range(len(texts)) for j in range(i + 1, len(texts))]
+    false_matches = sum(hamming(fingerprints[i], fingerprints[j]) <= distance for i, j in pairs)
+    distances = sorted(hamming(a, b) for a, b in zip(fingerprints, near))
+    print(f"simhash, {len(texts)} catalogue pages, distance <= {distance}: near duplicates caught "
+          f"{caught}/{len(texts)} (median {distances[len(distances) // 2]} bits), distinct pages matched "
+          f"{false_matches}/{len(pairs)}")
+
+    index = SimHashIndex(distance)
+    start = time.perf_counter()
+    for fingerprint in fingerprints:
+        index.add(fingerprint)
+    found = sum(index.find(fingerprint) is not None for fingerprint in near)
+    print(f"  index lookups {(time.perf_counter() - start) / len(near) * 1e6:.0f} us each, {found} found")
+
+
+def check_crawl():
+    # The books crawl against a catalogue whose pager goes through a mirror
+    # of page 6 with a tracking parameter, a banner and one price changed,
+    # and whose last page links back to the first: every distinct row once,
+    # every page fetched once and the mirror not fetched by the next crawl
+    # until its entry expires
+    import itertools
+    from bookscrapingproject import iter_books
+    from fixture_server import FixtureServer, books_catalogue_pages
+
+    pages = books_catalogue_pages()
+    pages["/catalogue/page-5.html"] = pages["/catalogue/page-5.html"].replace(
+        'href="page-6.html"', 'href="page-6-sponsored.html?utm_source=promo"')
+    pages["/catalogue/page-6-sponsored.html"] = re.sub(
+        r'(<p class="price_color">\D*)\d', r"\g<1>9", pages["/catalogue/page-6.html"], count=1).replace(
+        "<body>", "<body><div class=\"banner\">Sponsored: today's deals</div>").replace(
+        'href="page-7.html"', 'href="page-6.html?ref=banner"')
+    pages["/catalogue/page-50.html"] = pages["/catalogue/page-50.html"].replace(
+        '</ul></div></section>', '<li class="next"><a href="page-1.html?utm_campaign=loop">next</a></li></ul></div></section>')
+    with FixtureServer(pages) as server:
+        url = server.url("/catalogue/page-1.html")
+        # Without it the pager never ends, stop after two laps
+        rows = list(itertools.islice(iter_books(url), 2000))
+        dedup = Deduplicator(capacity=100_000)
+        server.requests_served = 0
+        unique = list(iter_books(url, dedup=dedup))
+        fetched = server.requests_served
+        server.requests_served = 0
+        again = list(iter_books(url, dedup=dedup))
+        fetched_again = server.requests_served
+        # Once the mirror entry expires the page is fetched and compared again
+        dedup.mirrors = {page: (next_url, 0) for page, (next_url, _) in dedup.mirrors.items()}
+        server.requests_served = 0
+        list(iter_books(url, dedup=dedup))
+        fetched_expired = server.requests_served
+
+    ok = (len(unique) == len({tuple(row) for row in unique}) == 1001 and fetched == 51
+          and not again and fetched_again == 50 and fetched_expired == 51)
+    print(f"{'ok ' if ok else 'BAD'} crawl: {len(rows)} rows before stopping it by hand without dedup, "
+          f"{len(unique)} with it from {fetched} fetches ({dedup.report()}); again: {len(again)} rows "
+          f"from {fetched_again} fetches, {fetched_expired} once the mirror expired")
+    return ok
+
+
+if __name__ == "__main__":
+    ok = check_canonical()
+    ok = check_crawl() and ok
+    if "--bench" in sys.argv:
+        benchmark_bloom()
+        benchmark_simhash()
+    sys.exit(0 if ok else 1)
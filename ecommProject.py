@@ -1,19 +1,16 @@
-import requests
 from bs4 import BeautifulSoup
+from dedup import canonical_url
+from proxy_pool import ProxyPool
 
-proxies = {
-    "http": "http://83.217.23.34",
-    "https": "http://45.140.143.77"
-}
+# Requests go through whichever proxy is healthier, and one that keeps
+# failing is left alone for a while
+pool = ProxyPool(["http://83.217.23.34", "http://45.140.143.77"])
 
-url = "https://www.amazon.com/s?k=samsung&crid=XQQJ2J26JHOZ&sprefix=samsung%2Caps%2C533&ref=nb_sb_noss_1"
-
-headers = {
-    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/110.0.0.0 Safari/537.36"
-}
+# Only k= picks the results, the rest is Amazon's click tracking
+url = canonical_url("https://www.amazon.com/s?k=samsung&crid=XQQJ2J26JHOZ&sprefix=samsung%2Caps%2C533&ref=nb_sb_noss_1")
 
 # Setting verify=False to bypass SSL verification
-r = requests.get(url, headers=headers, proxies=proxies)
+r = pool.get(url)  # Browser User-Agent comes from the pool's session
 
 soup = BeautifulSoup(r.text, "html.parser")
 
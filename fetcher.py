@@ -0,0 +1,145 @@
+"""
+Shared HTTP session for all the scrapers.
+
+requests.get opens a brand new TCP (and TLS) connection on every call.
+A requests.Session keeps connections alive in a pool per host, so
+repeated requests to the same site reuse the same socket. This module
+holds one such session with our browser headers, a default timeout and
+a retry/backoff policy, and every scraper fetches through it.
+
+Passing a http_cache.ResponseCache (or calling enable_cache() for the
+shared fetcher) puts an on-disk cache with ETag/Last-Modified
+revalidation under every GET. With metrics enabled every GET is counted
+and timed per host (see metrics.py).
+"""
+
+import sys
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import METRICS, instrument_adapter, record_error, record_response
+
+# Browser headers that were copied into each script
+DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36",
+    "Accept-Language": "en-US,en;q=0.9",
+}
+
+DEFAULT_TIMEOUT = 15  # seconds, same as the IMDb scraper used
+
+# Retry connection errors and "try again later" statuses with exponential
+# backoff (0.5s, 1s, 2s ...), honouring Retry-After when the server sends it
+DEFAULT_RETRY = Retry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=("GET", "HEAD"),
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+
+
+class Fetcher:
+    def __init__(self, headers=None, timeout=DEFAULT_TIMEOUT, retry=DEFAULT_RETRY,
+                 pool_connections=10, pool_maxsize=32, cache=None):
+        self.timeout = timeout
+        self.cache = cache
+        self.session = requests.Session()
+        self.session.headers.update(DEFAULT_HEADERS if headers is None else headers)
+
+        # pool_connections is how many hosts get a pool, pool_maxsize is how
+        # many open connections each host pool keeps (one per worker thread)
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize,
+                              max_retries=retry)
+        instrument_adapter(adapter)  # times DNS/connect, only while metrics are on
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        if not METRICS.enabled:
+            return self._get(url, **kwargs)
+        start = time.perf_counter()
+        try:
+            response = self._get(url, **kwargs)
+        except Exception as e:
+            record_error(url, e)
+            raise
+        record_response(url, response, time.perf_counter() - start)
+        return response
+
+    def _get(self, url, **kwargs):
+        if self.cache is not None and "proxies" not in kwargs:
+            return self.cache.get(self.session, url, **kwargs)
+        return self.session.get(url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+_default_fetcher = None
+_default_lock = threading.Lock()
+
+
+def get_fetcher():
+    # One shared Fetcher per process, created on first use
+    global _default_fetcher
+    if _default_fetcher is None:
+        with _default_lock:
+            if _default_fetcher is None:
+                _default_fetcher = Fetcher()
+    return _default_fetcher
+
+
+def enable_cache(directory=".http_cache", **options):
+    """Put an on-disk response cache under fetch() and return it"""
+    from http_cache import ResponseCache
+
+    fetcher = get_fetcher()
+    if fetcher.cache is None:
+        fetcher.cache = ResponseCache(directory, **options)
+    return fetcher.cache
+
+
+def fetch(url, **kwargs):
+    """Drop-in replacement for requests.get that reuses pooled connections"""
+    return get_fetcher().get(url, **kwargs)
+
+
+def benchmark_connections(requests_count=1000):
+    # Count the TCP connections a local server accepts for the same number
+    # of requests made with requests.get and with the pooled fetcher
+    from fixture_server import FixtureServer
+
+    with FixtureServer({"/": "<html><body>ok</body></html>"}) as server:
+        url = server.url("/")
+
+        start = time.perf_counter()
+        for _ in range(requests_count):
+            requests.get(url, timeout=DEFAULT_TIMEOUT)
+        elapsed = time.perf_counter() - start
+        print(f"requests.get : {server.connections_opened} connections for "
+              f"{requests_count} requests in {elapsed:.2f}s")
+
+        server.connections_opened = 0
+        start = time.perf_counter()
+        with Fetcher() as fetcher:
+            for _ in range(requests_count):
+                fetcher.get(url)
+        elapsed = time.perf_counter() - start
+        print(f"fetcher.get  : {server.connections_opened} connections for "
+              f"{requests_count} requests in {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    benchmark_connections(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,423 @@
+"""
+Local HTTP server that replays fixture pages.
+
+Used to benchmark the scrapers without hitting the real websites.
+Pages are kept in a dict of {path: html} and every response can be
+delayed to simulate network latency. With validators=True pages carry
+an ETag and Last-Modified and conditional requests get a 304.
+"""
+
+import csv
+import hashlib
+import random
+import sys
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from html import escape
+
+
+def books_catalogue_pages(csv_file="books_data.csv", per_page=20):
+    # Rebuild books.toscrape.com style catalogue pages from our saved CSV
+    with open(csv_file, newline="", encoding="utf-8") as file:
+        rows = list(csv.reader(file))[1:]
+
+    # The CSV was saved from a page decoded as latin-1, undo that so the
+    # fixture serves the same bytes as the real site
+    rows = [[field.encode("latin-1").decode("utf-8") for field in row] for row in rows]
+
+    total = (len(rows) + per_page - 1) // per_page
+    pages = {}
+    for number in range(1, total + 1):
+        articles = []
+        for title, price, rating in rows[(number - 1) * per_page:number * per_page]:
+            articles.append(
+                '<li class="col-xs-6 col-sm-4 col-md-3 col-lg-3"><article class="product_pod">'
+                f'<p class="star-rating {rating}"><i class="icon-star"></i></p>'
+                f'<h3><a href="book.html" title="{escape(title)}">{escape(title[:20])}</a></h3>'
+                f'<div class="product_price"><p class="price_color">{price}</p>'
+                '<p class="instock availability"><i class="icon-ok"></i> In stock</p></div>'
+                '</article></li>'
+            )
+        pager = f'<li class="current">Page {number} of {total}</li>'
+        if number > 1:
+            pager = f'<li class="previous"><a href="page-{number - 1}.html">previous</a></li>' + pager
+        if number < total:
+            pager += f'<li class="next"><a href="page-{number + 1}.html">next</a></li>'
+        pages[f"/catalogue/page-{number}.html"] = (
+            "<!DOCTYPE html><html><head><title>All products | Books to Scrape</title></head>"
+            '<body><div class="container-fluid page"><section><ol class="row">'
+            + "".join(articles)
+            + f'</ol><div><ul class="pager">{pager}</ul></div></section></div></body></html>'
+        )
+    return pages
+
+
+def imdb_chart_page(csv_file="imdb_top_movies.csv"):
+    # Rebuild the Top 250 chart (July 2024 markup) from our saved CSV,
+    # the rating cell "9.3(3M)" is the star rating plus its vote count
+    with open(csv_file, newline="", encoding="utf-8") as file:
+        rows = list(csv.reader(file))[1:]
+
+    items = []
+    for rank, (title, year, rating) in enumerate(rows, 1):
+        stars, votes = rating.split("(", 1)
+        items.append(
+            '<li class="ipc-metadata-list-summary-item sc-10233bc-0 TwzGn cli-parent">'
+            '<div class="ipc-metadata-list-summary-item__c"><div class="cli-children">'
+            f'<a class="ipc-title-link-wrapper" href="/title/tt{rank:07d}/">'
+            f'<h3 class="ipc-title__text">{rank}. {escape(title)}</h3></a>'
+            f'<div class="cli-title-metadata"><span class="cli-title-metadata-item">{year}</span>'
+            '<span class="cli-title-metadata-item">2h 22m</span>'
+            '<span class="cli-title-metadata-item">R</span></div>'
+            '<span class="ipc-rating-star ipc-rating-star--base ipc-rating-star--imdb">'
+            f'<svg class="ipc-icon ipc-icon--star-inline"></svg>{stars}'
+            f'<span class="ipc-rating-star--voteCount">&nbsp;(<!-- -->{votes.rstrip(")")}<!-- -->)</span>'
+            '</span></div></div></li>'
+        )
+    return (
+        "<!DOCTYPE html><html><head><title>IMDb Top 250 Movies</title></head><body>"
+        '<main><div class="ipc-page-grid__item ipc-page-grid__item--span-2">'
+        '<ul class="ipc-metadata-list ipc-metadata-list--dividers-between compact-list-view">'
+        + "".join(items)
+        + "</ul></div></main></body></html>"
+    )
+
+
+# Draws the collection grid the way the Shopify theme's JS does, after a
+# short hydration delay so nothing is there when the HTML arrives
+_GRID_SCRIPT = """
+function renderGrid(products) {
+  setTimeout(function () {
+    document.getElementById("product-grid").innerHTML = products.map(function (p) {
+      var price = Number(p.variants[0].price).toLocaleString("en-US", {minimumFractionDigits: 2});
+      return '<div class="product-tile"><div class="tile-body"><div class="pdp-link">' +
+        '<a class="link" href="/products/' + p.handle + '">' + p.title + '</a></div>' +
+        '<div class="price"><span class="sales"><span class="value cc-price" content="' +
+        p.variants[0].price + '">Rs.' + price + '</span></span></div></div></div>';
+    }).join("");
+  }, 300);
+}
+"""
+
+
+def sapphire_collection_pages(html_file="sap.txt"):
+    # The men's collection four ways, from the tiles in our saved page:
+    #   /static/...    grid already in the HTML
+    #   /embedded/...  grid drawn by JS from a JSON <script> in the page
+    #   /xhr/...       grid drawn by JS from /<collection>/products.json
+    #   /broken/...    an embedded JSON <script> that doesn't parse, the
+    #                  grid drawn from products.json
+    #   /js/...        grid drawn by JS from data only the script knows
+    import json
+    from parsers import _sapphire_fields, parse
+
+    with open(html_file, encoding="utf-8", errors="replace") as file:
+        tiles = _sapphire_fields(parse(file.read()))["products"]
+    products = [
+        {"title": tile["title"], "handle": tile["url"].split("/")[-1].split(".")[0].lower(),
+         "variants": [{"price": tile["amount"]}]}
+        for tile in tiles if tile["amount"]
+    ]
+    catalogue = json.dumps({"products": products})
+
+    def page(head="", grid="", script=""):
+        return (
+            "<!DOCTYPE html><html><head><title>Men | Sapphire</title>"
+            '<link rel="stylesheet" href="/assets/theme.css">' + head + "</head><body>"
+            f'<div id="product-grid" class="grid product-grid">{grid}</div>'
+            f"<script>{_GRID_SCRIPT}{script}</script></body></html>"
+        )
+
+    # The tiles' markup as the saved page has it, trimmed to what we read
+    static_grid = "".join(
+        '<div class="product-tile"><div class="tile-body"><div class="pdp-link">'
+        f'<a class="link" href="/products/{p["handle"]}">{escape(p["title"])}</a></div>'
+        '<div class="price"><span class="sales"><span class="value cc-price" '
+        f'content="{p["variants"][0]["price"]}">Rs.{float(p["variants"][0]["price"]):,.2f}</span></span></div>'
+        '</div></div>'
+        for p in products
+    )
+    return {
+        "/static/collections/man": page(grid=static_grid),
+        "/embedded/collections/man": page(
+            head=f'<script type="application/json" id="collection-products">{catalogue}</script>',
+            script='renderGrid(JSON.parse(document.getElementById("collection-products").textContent).products);',
+        ),
+        "/xhr/collections/man": page(
+            script='fetch("/xhr/collections/man/products.json").then(function (r) { return r.json(); })'
+                   '.then(function (data) { renderGrid(data.products); });',
+        ),
+        "/xhr/collections/man/products.json": catalogue,
+        "/broken/collections/man": page(
+            head='<script type="application/json" id="collection-products">{"products": [</script>',
+            script='fetch("/broken/collections/man/products.json").then(function (r) { return r.json(); })'
+                   '.then(function (data) { renderGrid(data.products); });',
+        ),
+        "/broken/collections/man/products.json": catalogue,
+        "/js/collections/man": page(script=f"renderGrid({catalogue}.products.slice());"),
+    }
+
+
+# Product page markup of the stores in products.csv, filled with
+# (title, price text)
+PRODUCT_MARKUP = {
+    "amazon": ('<div id="centerCol"><h1 id="title"><span id="productTitle">{title}</span></h1>'
+               '<div id="corePrice_feature_div"><span class="a-price"><span class="a-offscreen">${price:,.2f}'
+               '</span></span></div></div>'),
+    "ebay": ('<h1 class="x-item-title__mainTitle"><span class="ux-textspans">{title}</span></h1>'
+             '<div class="x-price-primary"><span class="ux-textspans">US ${price:,.2f}</span></div>'),
+    "bestbuy": ('<div class="sku-title"><h1>{title}</h1></div>'
+                '<div class="priceView-customer-price"><span aria-hidden="true">${price:,.2f}</span></div>'),
+    "books": ('<div class="product_main"><h1>{title}</h1><p class="price_color">\u00a3{price:.2f}</p></div>'),
+}
+
+
+def product_pages(markup, count, seed=0, changed=0.0, run=0):
+    # `count` product pages at /p/<n> in one store's markup. Prices come
+    # from `seed`; each later `run` moves `changed` of them by a little
+    rng = random.Random(seed)
+    prices = [rng.randrange(500, 50000) / 100 for _ in range(count)]
+    for step in range(1, run + 1):
+        moves = random.Random(seed * 1000 + step)
+        prices = [price + 1 if moves.random() < changed else price for price in prices]
+    template = PRODUCT_MARKUP[markup]
+    return {
+        f"/p/{n}": ("<!DOCTYPE html><html><head><title>" + escape(f"Product {n}") + "</title></head><body>"
+                    + template.format(title=escape(f"{markup.title()} product {n}"), price=price)
+                    + "</body></html>")
+        for n, price in enumerate(prices)
+    }
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients that hang up mid-response (timeouts, killed crawls) are
+        # part of what we test, anything else is still reported
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FixtureServer:
+    def __init__(self, pages, delay=0.0, content_type="text/html", validators=False):
+        self.pages = pages
+        self.delay = delay
+        self.content_type = content_type
+        self.validators = validators
+        self.last_modified = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime())
+        self.requests_served = 0
+        self.connections_opened = 0
+        self.not_modified = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self._server = _Server(("127.0.0.1", 0), self._make_handler())
+        self._thread = None
+
+    def _make_handler(self):
+        fixture = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # HTTP/1.1 lets clients keep the connection open between requests
+            protocol_version = "HTTP/1.1"
+            # Headers and body go out in separate writes, without this a
+            # kept-alive connection stalls on delayed ACKs
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                # Called once per accepted TCP connection
+                super().setup()
+                with fixture._lock:
+                    fixture.connections_opened += 1
+
+            def do_GET(self):
+                with fixture._lock:
+                    fixture.requests_served += 1
+                if fixture.delay:
+                    time.sleep(fixture.delay)
+
+                page = fixture.pages.get(self.path.split("?")[0])
+                if page is None:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                body = page.encode("utf-8") if isinstance(page, str) else page
+                if fixture.validators:
+                    # Changing a page in fixture.pages changes its ETag
+                    etag = '"%s"' % hashlib.sha1(body).hexdigest()
+                    if self.headers.get("If-None-Match") == etag:
+                        with fixture._lock:
+                            fixture.not_modified += 1
+                        self.send_response(304)
+                        self.send_header("ETag", etag)
+                        self.end_headers()
+                        return
+
+                self.send_response(200)
+                self.send_header("Content-Type", fixture.content_type)
+                self.send_header("Content-Length", str(len(body)))
+                if fixture.validators:
+                    self.send_header("ETag", etag)
+                    self.send_header("Last-Modified", fixture.last_modified)
+                self.end_headers()
+                self.wfile.write(body)
+                with fixture._lock:
+                    fixture.bytes_sent += len(body)
+
+            def log_message(self, format, *args):
+                pass  # Keep benchmark output clean
+
+        return Handler
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def url(self, path):
+        return self.base_url + path
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class ThrottlingServer(FixtureServer):
+    """FixtureServer that throttles like a protective site.
+
+    More than `max_qps` requests in the last second get a 429 (with a
+    Retry-After of `retry_after` seconds if set), or with captcha=True a
+    200 block page. Requests in flight beyond `capacity` queue, each one
+    adding `delay` to the response time. robots, if given, is served as
+    /robots.txt.
+    """
+
+    def __init__(self, pages, max_qps=20, delay=0.0, capacity=None, retry_after=None, captcha=False,
+                 robots=None):
+        pages = dict(pages)
+        if robots is not None:
+            pages["/robots.txt"] = robots
+        super().__init__(pages, delay=delay)
+        self.max_qps = max_qps
+        self.capacity = capacity
+        self.retry_after = retry_after
+        self.captcha = captcha
+        self.throttled = 0
+        self.in_flight = 0
+        self.most_in_flight = 0
+        self._recent = []  # start times of the requests served in the last second
+
+    def _admit(self):
+        # True if this request is within the rate, counting it as started
+        with self._lock:
+            now = time.monotonic()
+            self._recent = [t for t in self._recent if now - t < 1.0]
+            if len(self._recent) >= self.max_qps:
+                self.throttled += 1
+                return False
+            self._recent.append(now)
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+            queued = self.in_flight - self.capacity if self.capacity else 0
+        if queued > 0:
+            time.sleep(queued * self.delay)
+        return True
+
+    def _make_handler(self):
+        fixture = self
+        Handler = super()._make_handler()
+
+        class ThrottlingHandler(Handler):
+            def do_GET(self):
+                if self.path == "/robots.txt":
+                    return super().do_GET()
+                if not fixture._admit():
+                    body = b"<html><title>Robot check</title><body>Please solve the captcha</body></html>"
+                    self.send_response(200 if fixture.captcha else 429)
+                    if fixture.retry_after is not None and not fixture.captcha:
+                        self.send_header("Retry-After", str(fixture.retry_after))
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+                try:
+                    super().do_GET()
+                finally:
+                    with fixture._lock:
+                        fixture.in_flight -= 1
+
+        return ThrottlingHandler
+
+
+# Fetches upstream pages without going through any proxy set in the environment
+_direct = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+
+class FakeProxy(FixtureServer):
+    """Forward-proxy stand-in with injected latency and failures.
+
+    Answers plain-HTTP proxy requests (GET with an absolute URL) by
+    fetching the URL itself. Every request waits `delay` seconds plus up
+    to `jitter`, `failure_rate` of them get a 502, and a `dead` proxy
+    accepts the connection and then never answers in time.
+    """
+
+    def __init__(self, delay=0.0, jitter=0.0, failure_rate=0.0, dead=False, seed=None):
+        super().__init__({}, delay=delay)
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.dead = dead
+        self._random = random.Random(seed)
+
+    def _make_handler(self):
+        fixture = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                with fixture._lock:
+                    fixture.requests_served += 1
+                    failed = fixture._random.random() < fixture.failure_rate
+                    jitter = fixture._random.random() * fixture.jitter
+                if fixture.dead:
+                    time.sleep(60)  # the client times out long before this
+                    return
+                time.sleep(fixture.delay + jitter)
+
+                if failed:
+                    self.send_response(502)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                # self.path is the absolute URL the client wants
+                with _direct.open(self.path, timeout=10) as upstream:
+                    body = upstream.read()
+                    content_type = upstream.headers.get("Content-Type", "text/html")
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,232 @@
+"""
+Persistent crawl frontier, so a stopped crawl picks up where it left off.
+
+Every URL the crawl knows about is a row in SQLite with a state:
+
+    queued     waiting to be fetched
+    in_flight  handed out by next(), back to queued if the run dies
+    done       fetched, with whatever the crawler stored as its result
+    failed     gave up after max_attempts
+
+URLs are deduplicated on add(), and next() hands them out in the order
+they were first added. State changes are kept in memory and written in
+one transaction every `checkpoint_every` finished URLs (and on close), so
+the database isn't committed once per page. A run killed outright loses
+at most the last unwritten batch, which the next run simply fetches
+again.
+"""
+
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import deque
+
+QUEUED, IN_FLIGHT, DONE, FAILED = "queued", "in_flight", "done", "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS frontier (
+    url TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS frontier_state ON frontier(state, seq);
+"""
+
+
+class Frontier:
+    def __init__(self, path="frontier.db", checkpoint_every=25, max_attempts=3, canonicalize=None):
+        self.checkpoint_every = checkpoint_every
+        self.max_attempts = max_attempts
+        self.canonicalize = canonicalize  # e.g. dedup.canonical_url, applied by add()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self._lock = threading.RLock()
+        self._pending = {}  # url -> row waiting for the next checkpoint
+        self._finished_since_checkpoint = 0
+
+        # Whatever was in flight when the last run stopped goes back in line
+        with self.conn:
+            self.conn.execute("UPDATE frontier SET state = ? WHERE state = ?", (QUEUED, IN_FLIGHT))
+        self._seen = {}  # url -> [seq, state, attempts]
+        self._queue = deque()
+        for url, seq, state, attempts in self.conn.execute(
+            "SELECT url, seq, state, attempts FROM frontier ORDER BY seq"
+        ):
+            self._seen[url] = [seq, state, attempts]
+            if state == QUEUED:
+                self._queue.append(url)
+        self._next_seq = max((entry[0] for entry in self._seen.values()), default=0) + 1
+
+    def _set(self, url, state, error=None, result=None):
+        entry = self._seen[url]
+        entry[1] = state
+        self._pending[url] = (url, entry[0], state, entry[2], error, result)
+
+    def add(self, urls):
+        """Queue urls not seen before, returns how many were new"""
+        added = 0
+        with self._lock:
+            for url in urls:
+                if self.canonicalize is not None:
+                    url = self.canonicalize(url)
+                if url in self._seen:
+                    continue
+                self._seen[url] = [self._next_seq, QUEUED, 0]
+                self._next_seq += 1
+                self._set(url, QUEUED)
+                self._queue.append(url)
+                added += 1
+        return added
+
+    def next(self):
+        """The next queued url (now in flight), or None when there is none"""
+        with self._lock:
+            if not self._queue:
+                return None
+            url = self._queue.popleft()
+            self._seen[url][2] += 1
+            self._set(url, IN_FLIGHT)
+            return url
+
+    def done(self, url, result=None):
+        """Mark url fetched, keeping a JSON serialisable result with it"""
+        with self._lock:
+            self._set(url, DONE, result=json.dumps(result))
+            self._finished()
+
+    def failed(self, url, error):
+        """Requeue url, or mark it failed once it used up its attempts"""
+        with self._lock:
+            if self._seen[url][2] < self.max_attempts:
+                self._set(url, QUEUED, error=str(error))
+                self._queue.append(url)
+            else:
+                self._set(url, FAILED, error=str(error))
+            self._finished()
+
+    def _finished(self):
+        self._finished_since_checkpoint += 1
+        if self._finished_since_checkpoint >= self.checkpoint_every:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """Write every pending state change in one transaction"""
+        with self._lock:
+            if not self._pending:
+                return
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT INTO frontier (url, seq, state, attempts, error, result) VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(url) DO UPDATE SET state = excluded.state, attempts = excluded.attempts, "
+                    "error = excluded.error, result = COALESCE(excluded.result, frontier.result)",
+                    list(self._pending.values()),
+                )
+            self._pending = {}
+            self._finished_since_checkpoint = 0
+
+    def results(self):
+        """Yield (url, result) for done urls in the order they were added"""
+        self.checkpoint()
+        for url, result in self.conn.execute(
+            "SELECT url, result FROM frontier WHERE state = ? ORDER BY seq", (DONE,)
+        ):
+            yield url, json.loads(result)
+
+    def counts(self):
+        with self._lock:
+            counts = {QUEUED: 0, IN_FLIGHT: 0, DONE: 0, FAILED: 0}
+            for _, state, _ in self._seen.values():
+                counts[state] += 1
+            return counts
+
+    def close(self):
+        self.checkpoint()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _crawl_child(base_url, db_path):
+    # Run by check_resume() in a separate process that gets killed midway
+    from bookscrapingproject import scrape_books_resumable
+
+    with Frontier(db_path, checkpoint_every=5) as frontier:
+        scrape_books_resumable(base_url + "/catalogue/page-1.html", frontier)
+
+
+def check_resume(kill_after=25, delay=0.05):
+    # Kill a crawl of the local catalogue outright (SIGKILL, no cleanup)
+    # once `kill_after` pages were served, then resume it and check that
+    # only pages the frontier hadn't recorded as done get fetched again
+    # and the rows are those of an uninterrupted crawl
+    import subprocess
+    import tempfile
+    from bookscrapingproject import scrape_books, scrape_books_resumable
+    from fixture_server import FixtureServer, books_catalogue_pages
+
+    pages = books_catalogue_pages()
+    db_path = os.path.join(tempfile.mkdtemp(prefix="frontier_"), "frontier.db")
+    with FixtureServer(pages, delay=delay) as server:
+        child = subprocess.Popen([sys.executable, __file__, "--crawl", server.base_url, db_path])
+        while server.requests_served < kill_after and child.poll() is None:
+            time.sleep(0.005)
+        child.kill()
+        child.wait()
+        first_run = server.requests_served
+
+        with Frontier(db_path) as frontier:
+            done_at_kill = frontier.counts()[DONE]
+            server.requests_served = 0
+            rows = scrape_books_resumable(server.url("/catalogue/page-1.html"), frontier)
+            resumed = server.requests_served
+
+    with FixtureServer(pages) as server:
+        same = rows == scrape_books(server.url("/catalogue/page-1.html"))
+    killed_midway = 0 < done_at_kill < len(pages)
+    ok = killed_midway and resumed == len(pages) - done_at_kill and same
+    print(f"{'ok ' if killed_midway else 'BAD'} killed after {first_run} pages fetched, "
+          f"{done_at_kill} checkpointed as done")
+    print(f"{'ok ' if resumed == len(pages) - done_at_kill else 'BAD'} resume fetched {resumed} pages "
+          f"(remaining: {len(pages) - done_at_kill}), "
+          f"{first_run - done_at_kill} fetched pages were past the last checkpoint")
+    print(f"{'ok ' if same else 'BAD'} rows after resume: {len(rows)}, same as an uninterrupted crawl: {same}")
+    return ok
+
+
+def benchmark_checkpoints(urls=20000):
+    # Frontier bookkeeping alone for a crawl of `urls` pages, committing
+    # after every page versus in batches
+    import tempfile
+
+    for every in (1, 25, 250):
+        db_path = os.path.join(tempfile.mkdtemp(prefix="frontier_"), "frontier.db")
+        start = time.perf_counter()
+        with Frontier(db_path, checkpoint_every=every) as frontier:
+            frontier.add(f"https://example.com/page-{n}.html" for n in range(urls))
+            while (url := frontier.next()) is not None:
+                frontier.done(url, [url])
+        elapsed = time.perf_counter() - start
+        print(f"checkpoint every {every:<4} {urls / elapsed:9,.0f} pages/s")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--crawl"]:
+        _crawl_child(sys.argv[2], sys.argv[3])
+    elif "--check" in sys.argv:
+        sys.exit(0 if check_resume() else 1)
+    else:
+        ok = check_resume()
+        benchmark_checkpoints()
+        sys.exit(0 if ok else 1)
@@ -0,0 +1,421 @@
+"""
+On-disk HTTP response cache for the shared fetcher.
+
+Bodies are stored content-addressed (file name = sha256 of the body), so
+pages that come back byte-identical share one file. A small SQLite index
+maps each URL to its body, headers, validators and expiry. The URL is the
+prepared one, query parameters included, and a response with a Vary
+header is kept once per value of the request headers it names, so a
+page asked for with another Accept-Language isn't served from the wrong
+entry:
+
+    fresh entry              served from disk, no request at all
+    stale with ETag or       one conditional request, a 304 refreshes the
+    Last-Modified            entry (expiry, validators, headers) and the
+                             stored body is served
+    missing / changed        normal request, new body stored
+
+Responses with Cache-Control: no-store are never kept (and drop what was
+kept for that URL); max-age=0 or no-cache ones are kept but revalidated
+on every use. Total body size is capped and the least recently used
+entries are evicted first; a body file goes as soon as no entry refers
+to it any more. Counters for hits, misses and revalidations are kept in
+ResponseCache.stats.
+"""
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+import requests
+from requests.sessions import merge_setting
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+DEFAULT_TTL = 60 * 60  # one hour when the server doesn't say
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entry (
+    url TEXT NOT NULL,
+    variant TEXT NOT NULL,
+    vary TEXT NOT NULL,
+    body_hash TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    status INTEGER NOT NULL,
+    headers TEXT NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    expires_at REAL NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (url, variant)
+);
+CREATE INDEX IF NOT EXISTS entry_last_used ON entry(last_used);
+CREATE INDEX IF NOT EXISTS entry_body ON entry(body_hash);
+"""
+
+MAX_AGE_PATTERN = re.compile(r"max-age=(\d+)")
+
+
+def _vary(response):
+    # Request header names the response varies on, lowercased and sorted;
+    # None for "Vary: *", which no stored copy can ever match
+    names = sorted({name.strip().lower() for name in response.headers.get("Vary", "").split(",") if name.strip()})
+    return None if "*" in names else names
+
+
+def _variant(vary, request_headers):
+    # What the request sent for each of those headers, as stored with it
+    return json.dumps([[name, request_headers.get(name)] for name in vary])
+
+
+class ResponseCache:
+    def __init__(self, directory=".http_cache", max_bytes=DEFAULT_MAX_BYTES, ttl=DEFAULT_TTL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stats = {"hits": 0, "misses": 0, "revalidated": 0, "stored": 0, "evicted": 0}
+        os.makedirs(os.path.join(directory, "bodies"), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(directory, "index.db"), check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(entry)")]
+        if columns and "variant" not in columns:
+            # An index from before entries were kept per Vary: start over
+            self.clear()
+            self._db.execute("DROP TABLE entry")
+        self._db.executescript(INDEX_SCHEMA)
+
+    def _body_path(self, body_hash):
+        return os.path.join(self.directory, "bodies", body_hash[:2], body_hash)
+
+    def _read_body(self, body_hash):
+        try:
+            with open(self._body_path(body_hash), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write_body(self, body):
+        body_hash = hashlib.sha256(body).hexdigest()
+        path = self._body_path(body_hash)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temporary = f"{path}.{threading.get_ident()}.tmp"
+            with open(temporary, "wb") as f:
+                f.write(body)
+            os.replace(temporary, path)  # readers never see half a file
+        return body_hash
+
+    def lookup(self, url, request_headers=None):
+        """Return the entry for url whose Vary headers match
+        request_headers (a CaseInsensitiveDict) as a dict, or None"""
+        request_headers = request_headers or CaseInsensitiveDict()
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT variant, vary, body_hash, status, headers, etag, last_modified, expires_at "
+                "FROM entry WHERE url = ?",
+                (url,),
+            ).fetchall()
+        for variant, vary, body_hash, status, headers, etag, last_modified, expires_at in rows:
+            if variant == _variant(json.loads(vary), request_headers):
+                return {"variant": variant, "body_hash": body_hash, "status": status,
+                        "headers": json.loads(headers), "etag": etag, "last_modified": last_modified,
+                        "expires_at": expires_at}
+        return None
+
+    def _expires_at(self, headers):
+        cache_control = headers.get("Cache-Control", "")
+        if "no-cache" in cache_control:
+            return time.time()  # keep it, but ask again every time
+        match = MAX_AGE_PATTERN.search(cache_control)
+        ttl = int(match.group(1)) if match else self.ttl
+        return time.time() + ttl
+
+    def _release_body(self, body_hash):
+        # Under the lock: remove the body file once no entry refers to it
+        if self._db.execute("SELECT 1 FROM entry WHERE body_hash = ? LIMIT 1", (body_hash,)).fetchone():
+            return False
+        try:
+            os.remove(self._body_path(body_hash))
+        except FileNotFoundError:
+            pass
+        return True
+
+    def _forget(self, url):
+        # Every variant of the URL
+        with self._lock, self._db:
+            rows = self._db.execute("SELECT DISTINCT body_hash FROM entry WHERE url = ?", (url,)).fetchall()
+            self._db.execute("DELETE FROM entry WHERE url = ?", (url,))
+            for (body_hash,) in rows:
+                self._release_body(body_hash)
+
+    def store(self, url, response, request_headers=None):
+        """Save a 200 response unless the server asked us not to, under
+        the request_headers its Vary names"""
+        cache_control = response.headers.get("Cache-Control", "")
+        if "no-store" in cache_control:
+            self._forget(url)
+            return
+        vary = _vary(response)
+        if response.status_code != 200 or vary is None:
+            return
+        variant = _variant(vary, request_headers or CaseInsensitiveDict())
+        body = response.content
+        headers = {key: value for key, value in response.headers.items()
+                   if key.lower() not in ("content-encoding", "transfer-encoding", "content-length")}
+        now = time.time()
+        # Body file and index row change together, so another thread can't
+        # release a body between it being written and referenced
+        with self._lock, self._db:
+            body_hash = self._write_body(body)
+            previous = self._db.execute("SELECT body_hash FROM entry WHERE url = ? AND variant = ?",
+                                        (url, variant)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO entry VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (url, variant, json.dumps(vary), body_hash, len(body), response.status_code, json.dumps(headers),
+                 response.headers.get("ETag"), response.headers.get("Last-Modified"),
+                 self._expires_at(response.headers), now),
+            )
+            if previous and previous[0] != body_hash:
+                self._release_body(previous[0])  # the page changed, its old body may be unused now
+            self.stats["stored"] += 1
+        self._evict()
+
+    def _revalidated(self, url, entry, response):
+        # A 304 carries the current validators and caching headers, keep
+        # them for the next request
+        headers = dict(entry["headers"])
+        headers.update((key, value) for key, value in response.headers.items()
+                       if key.lower() not in ("content-encoding", "transfer-encoding", "content-length"))
+        entry = {**entry, "headers": headers,
+                 "etag": response.headers.get("ETag", entry["etag"]),
+                 "last_modified": response.headers.get("Last-Modified", entry["last_modified"])}
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE entry SET headers = ?, etag = ?, last_modified = ?, expires_at = ?, last_used = ? "
+                "WHERE url = ? AND variant = ?",
+                (json.dumps(headers), entry["etag"], entry["last_modified"],
+                 self._expires_at(response.headers), time.time(), url, entry["variant"]),
+            )
+            self.stats["revalidated"] += 1
+        return entry
+
+    def _touch(self, url, variant):
+        with self._lock, self._db:
+            self._db.execute("UPDATE entry SET last_used = ? WHERE url = ? AND variant = ?",
+                             (time.time(), url, variant))
+
+    def _evict(self):
+        # Drop least recently used entries until the distinct bodies fit
+        with self._lock, self._db:
+            total = self._db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT body_hash, size FROM entry)"
+            ).fetchone()[0]
+            if total <= self.max_bytes:
+                return
+            for url, variant, body_hash, size in self._db.execute(
+                "SELECT url, variant, body_hash, size FROM entry ORDER BY last_used"
+            ).fetchall():
+                self._db.execute("DELETE FROM entry WHERE url = ? AND variant = ?", (url, variant))
+                self.stats["evicted"] += 1
+                if self._release_body(body_hash):
+                    total -= size
+                if total <= self.max_bytes:
+                    break
+
+    def _build_response(self, url, entry, body):
+        response = requests.Response()
+        response.status_code = entry["status"]
+        response.reason = "OK"
+        response.url = url
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = body
+        response.from_cache = True
+        return response
+
+    def get(self, session, url, **kwargs):
+        """Fetch url through the cache with a requests.Session"""
+        # The key is the URL the request goes to, params and all, and the
+        # Vary headers are matched against what the session will send
+        url = requests.Request("GET", url, params=kwargs.pop("params", None)).prepare().url
+        headers = dict(kwargs.pop("headers", None) or {})
+        request_headers = CaseInsensitiveDict(merge_setting(headers, getattr(session, "headers", None)))
+        entry = self.lookup(url, request_headers)
+        body = self._read_body(entry["body_hash"]) if entry else None
+
+        if entry and body is not None and entry["expires_at"] > time.time():
+            with self._lock:
+                self.stats["hits"] += 1
+            self._touch(url, entry["variant"])
+            return self._build_response(url, entry, body)
+
+        if entry and body is not None:
+            # Stale, ask the server whether our copy is still good
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        response = session.get(url, headers=headers, **kwargs)
+        if response.status_code == 304 and entry and body is not None:
+            if "no-store" in response.headers.get("Cache-Control", ""):
+                self._forget(url)
+                with self._lock:
+                    self.stats["revalidated"] += 1
+            else:
+                entry = self._revalidated(url, entry, response)
+            return self._build_response(url, entry, body)
+
+        with self._lock:
+            self.stats["misses"] += 1
+        self.store(url, response, request_headers)
+        response.from_cache = False
+        return response
+
+    def clear(self):
+        with self._lock, self._db:
+            for (body_hash,) in self._db.execute("SELECT DISTINCT body_hash FROM entry").fetchall():
+                try:
+                    os.remove(self._body_path(body_hash))
+                except FileNotFoundError:
+                    pass
+            self._db.execute("DELETE FROM entry")
+
+    def close(self):
+        self._db.close()
+
+
+def demo_revalidation(ttl=0):
+    # Against a local server that sends ETags: the first pass downloads
+    # every page, later passes cost one 304 each (ttl=0) or nothing at all
+    # and serve the bodies the first pass stored. Returns whether they did
+    import shutil
+    import tempfile
+    from fetcher import Fetcher
+    from fixture_server import FixtureServer, books_catalogue_pages
+
+    directory = tempfile.mkdtemp(prefix="http_cache_")
+    pages = books_catalogue_pages()
+    ok = True
+    try:
+        with FixtureServer(pages, validators=True) as server:
+            cache = ResponseCache(directory, ttl=ttl)
+            with Fetcher(cache=cache) as fetcher:
+                for label in ("cold", "warm", "warm"):
+                    served, sent, not_modified = server.requests_served, server.bytes_sent, server.not_modified
+                    start = time.perf_counter()
+                    bodies = [fetcher.get(server.url(path)).content for path in pages]
+                    requests_sent = server.requests_served - served
+                    # Warm passes send a conditional request per page and get a
+                    # 304 for each (ttl=0), or send nothing at all
+                    expected = len(pages) if label == "cold" or not ttl else 0
+                    good = (bodies == [page.encode() for page in pages.values()]
+                            and requests_sent == expected
+                            and server.not_modified - not_modified == (expected if label == "warm" else 0)
+                            and (label == "cold" or server.bytes_sent == sent))
+                    ok = ok and good
+                    print(f"{'ok ' if good else 'BAD'} {label}: {time.perf_counter() - start:.3f}s, "
+                          f"{requests_sent} requests, {server.not_modified - not_modified} answered 304, "
+                          f"{server.bytes_sent - sent:,} body bytes, stats {cache.stats}")
+            cache.close()
+    finally:
+        shutil.rmtree(directory)
+    return ok
+
+
+class _ScriptedSession:
+    # Answers get() with the next (status, headers, body) of a script and
+    # keeps the request headers, for check_bookkeeping()
+    def __init__(self, script):
+        self.script = list(script)
+        self.sent = []
+
+    def get(self, url, headers=None, **kwargs):
+        status, response_headers, body = self.script.pop(0)
+        self.sent.append(headers or {})
+        response = requests.Response()
+        response.status_code = status
+        response.url = url
+        response.headers = CaseInsensitiveDict(response_headers)
+        response._content = body
+        return response
+
+
+def check_bookkeeping():
+    """Changed bodies don't leave files behind, max_bytes holds, no-store
+    and max-age=0 are honoured and a 304's validators are kept"""
+    import shutil
+    import tempfile
+
+    directory = tempfile.mkdtemp(prefix="http_cache_")
+    cache = ResponseCache(directory, max_bytes=3000, ttl=0)
+
+    def body_files():
+        return sum(len(files) for _, _, files in os.walk(os.path.join(directory, "bodies")))
+
+    try:
+        checks = []
+        # The same URL changing 20 times, 1000 bytes each
+        session = _ScriptedSession((200, {"ETag": f'"v{n}"'}, bytes([n]) * 1000) for n in range(20))
+        for _ in range(20):
+            cache.get(session, "http://example.com/page")
+        checks.append(("changed body leaves one file", body_files() == 1))
+        session = _ScriptedSession((200, {}, bytes([n]) * 1000) for n in range(20))
+        for n in range(20):
+            cache.get(session, f"http://example.com/page-{n}")
+        checks.append(("max_bytes holds with many URLs", body_files() * 1000 <= cache.max_bytes))
+
+        session = _ScriptedSession([(200, {"Cache-Control": "no-store"}, b"secret")])
+        cache.get(session, "http://example.com/page")
+        checks.append(("no-store drops the entry", cache.lookup("http://example.com/page") is None))
+
+        session = _ScriptedSession([
+            (200, {"Cache-Control": "max-age=0", "ETag": '"a"'}, b"body"),
+            (304, {"Cache-Control": "max-age=0", "ETag": '"b"', "Last-Modified": "Tue, 01 Jan 2030 00:00:00 GMT"},
+             b""),
+            (304, {"ETag": '"b"'}, b""),
+        ])
+        url = "http://example.com/revalidated"
+        first = cache.get(session, url)
+        second = cache.get(session, url)  # max-age=0: asks again, keeps "b"
+        third = cache.get(session, url)
+        checks.append(("max-age=0 revalidates every time", len(session.sent) == 3))
+        checks.append(("304 validators are kept", session.sent[2].get("If-None-Match") == '"b"'
+                       and session.sent[2].get("If-Modified-Since") == "Tue, 01 Jan 2030 00:00:00 GMT"))
+        checks.append(("304 serves the stored body", first.content == second.content == third.content == b"body"))
+
+        # The key is the URL with its params, and the headers Vary names
+        cache.ttl = 3600
+        session = _ScriptedSession([(200, {}, b"page 1"), (200, {}, b"page 2")])
+        pages = [cache.get(session, "http://example.com/list", params={"page": page}).content
+                 for page in (1, 2, 1, 2)]
+        checks.append(("params are part of the key", pages == [b"page 1", b"page 2"] * 2
+                       and len(session.sent) == 2))
+        session = _ScriptedSession([(200, {"Vary": "Accept-Language"}, b"english"),
+                                    (200, {"Vary": "Accept-Language"}, b"deutsch")])
+        languages = [cache.get(session, "http://example.com/home", headers={"Accept-Language": language}).content
+                     for language in ("en", "de", "en", "de")]
+        checks.append(("one entry per Vary header value", languages == [b"english", b"deutsch"] * 2
+                       and len(session.sent) == 2))
+        session = _ScriptedSession([(200, {"Vary": "*"}, b"one"), (200, {"Vary": "*"}, b"two")])
+        bodies = [cache.get(session, "http://example.com/any").content for _ in range(2)]
+        checks.append(('"Vary: *" is never served from the cache', bodies == [b"one", b"two"]))
+        cache.close()
+    finally:
+        shutil.rmtree(directory)
+    for label, good in checks:
+        print(f"{'ok ' if good else 'BAD'} {label}")
+    return all(good for _, good in checks)
+
+
+if __name__ == "__main__":
+    if "--check" in sys.argv:
+        sys.exit(0 if check_bookkeeping() else 1)
+    sys.exit(0 if demo_revalidation() & demo_revalidation(ttl=3600) else 1)
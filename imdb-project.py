@@ -1,45 +1,13 @@
-import requests
-from bs4 import BeautifulSoup
+from site_spec import compile_spec
 import csv
 
-def scrape_imdb():
-    url = "https://www.imdb.com/chart/top/"
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36",
-        "Accept-Language": "en-US,en;q=0.9",
-        "Referer": "https://www.google.com/",
-        "Accept-Encoding": "gzip, deflate, br",
-    }
+# URL, headers, captcha check and selectors (July 2024 markup) live in specs/imdb.yaml
+IMDB_PLAN = compile_spec("imdb")
 
+def scrape_imdb():
     try:
-        response = requests.get(url, headers=headers, timeout=15)
-        response.raise_for_status()
-        
-        # Verify we're getting the correct page
-        if "IMDb Top 250 Movies" not in response.text:
-            raise ValueError("Captcha or redirect detected")
-
-        soup = BeautifulSoup(response.text, 'html.parser')
-        movies = []
-
-        # Updated CSS selector for movie containers (July 2024)
-        movie_list = soup.select('div.ipc-page-grid__item ul.ipc-metadata-list li.ipc-metadata-list-summary-item')
-
-        if not movie_list:
-            raise ValueError("No movie rows found. Check the HTML structure.")
-
-        for movie in movie_list:
-            # Extract title and remove ranking number
-            title = movie.select_one('h3.ipc-title__text').get_text(strip=True).split('. ', 1)[-1]
-            
-            # Extract metadata (year, rating, etc.)
-            metadata = movie.select('span.cli-title-metadata-item')
-            year = metadata[0].get_text(strip=True) if len(metadata) > 0 else 'N/A'
-            rating = movie.select_one('span.ipc-rating-star').get_text(strip=True).split()[0]
-
-            movies.append([title, year, rating])
-
-        return movies
+        # Fails on a captcha/redirect page or when no movie rows match
+        return IMDB_PLAN.run()
 
     except Exception as e:
         print(f"Error during scraping: {str(e)}")
@@ -0,0 +1,38 @@
+"""
+Import heavy optional modules on first use instead of at import time.
+
+pandas, numpy, pyarrow and playwright cost from 100 ms to over half a
+second to import, and most runs of most scrapers never touch them.
+
+    pd = lazy_module("pandas")
+
+puts a module object in place right away (and in sys.modules, so a
+later plain `import pandas` gets the same one) whose code only runs
+when one of its attributes is first looked up. A module that isn't
+installed still raises ImportError right there, so the usual
+
+    try:
+        pyarrow = lazy_module("pyarrow")
+    except ImportError:
+        pyarrow = None
+
+keeps working. A dotted name imports its parent packages straight
+away, only the last module is deferred.
+"""
+
+import importlib.util
+import sys
+
+
+def lazy_module(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"No module named {name!r}", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
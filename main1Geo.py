@@ -1,9 +1,12 @@
 
-import requests 
+from fetcher import enable_cache, fetch
+
+# Re-running only revalidates the article instead of downloading it again
+enable_cache()
 
 
 def fetchandsavetofile(url , path):
-    r= requests.get(url)
+    r= fetch(url)
 
     with open(path , "w") as file:
         file.write(r.text)
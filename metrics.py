@@ -0,0 +1,432 @@
+"""
+Where scrape time goes: counters, latency histograms and profiling.
+
+Off by default. enable() turns on instrumentation that is already wired
+into the shared pieces:
+
+    fetcher     per host: responses by status, retries, bytes, cache hits,
+                errors, and fetch / TTFB / body seconds
+    connections per host: new connections, DNS and connect (+TLS) seconds
+    stages      parse (parsers.parse), extract (ExtractionPlan.extract)
+                and write (Sink.flush) seconds
+
+TTFB is requests' response.elapsed (request sent to headers parsed), so
+for a new connection it includes DNS and connect; body is the rest of
+the fetch. Export with prometheus() (text exposition format) or
+to_json(), or print report() for a quick look.
+
+While disabled every hook is a single flag check, and stage timers
+return a shared no-op context manager.
+
+Any scraper script can be run instrumented:
+
+    python metrics.py [--profile | --profile=sample] [--metrics out.prom|out.json] script.py [args]
+
+--profile runs it under cProfile and prints the top functions by own
+time; --profile=sample uses a signal-driven sampler with less overhead
+and counts where every thread was on each tick.
+"""
+
+import bisect
+import contextlib
+import json
+import os
+import pstats
+import runpy
+import signal
+import socket
+import sys
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# Histogram bucket upper bounds in seconds, Prometheus' defaults
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_NOT_TIMING = contextlib.nullcontext()
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "labels", "start")
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+class Metrics:
+    def __init__(self, buckets=BUCKETS):
+        self.enabled = False
+        self.buckets = buckets
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [count per bucket ..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def count(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+            histogram[-1] += seconds
+
+    def time(self, name, **labels):
+        """Context manager observing how long its block took"""
+        if not self.enabled:
+            return _NOT_TIMING
+        return _Timer(self, name, labels)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def quantile(self, histogram, q):
+        # Upper bound of the bucket holding the q-th observation
+        counts = histogram[:-1]
+        rank = q * sum(counts)
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            seen += count
+            if seen >= rank and count:
+                return bound
+        return float("nan")
+
+    def prometheus(self, prefix="scrape_"):
+        """Everything in the Prometheus text exposition format"""
+        def labels_text(labels, extra=()):
+            pairs = [(key, str(value)) for key, value in labels] + list(extra)
+            if not pairs:
+                return ""
+            escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+                       for _, value in pairs)
+            return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + "}"
+
+        lines = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(value)) for key, value in self.histograms.items())
+        for index, ((name, labels), value) in enumerate(counters):
+            if index == 0 or counters[index - 1][0][0] != name:
+                lines.append(f"# TYPE {prefix}{name} counter")
+            lines.append(f"{prefix}{name}{labels_text(labels)} {value}")
+        for index, ((name, labels), histogram) in enumerate(histograms):
+            if index == 0 or histograms[index - 1][0][0] != name:
+                lines.append(f"# TYPE {prefix}{name} histogram")
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), histogram[:-1]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{prefix}{name}_bucket{labels_text(labels, [('le', le)])} {cumulative}")
+            lines.append(f"{prefix}{name}_sum{labels_text(labels)} {histogram[-1]:.6f}")
+            lines.append(f"{prefix}{name}_count{labels_text(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+    def to_json(self):
+        with self._lock:
+            counters = [{"name": name, "labels": dict(labels), "value": value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            histograms = [{
+                "name": name, "labels": dict(labels), "count": sum(histogram[:-1]),
+                "sum": histogram[-1], "p50": self.quantile(histogram, 0.5),
+                "p95": self.quantile(histogram, 0.95),
+                "buckets": dict(zip([*map(str, self.buckets), "+Inf"], histogram[:-1])),
+            } for (name, labels), histogram in sorted(self.histograms.items())]
+        return {"counters": counters, "histograms": histograms}
+
+    def save(self, path):
+        """Write prometheus() or, for a .json path, to_json()"""
+        with open(path, "w", encoding="utf-8") as f:
+            if path.endswith(".json"):
+                json.dump(self.to_json(), f, indent=2)
+            else:
+                f.write(self.prometheus())
+
+    def report(self):
+        """Per-host and per-stage summary, one line each"""
+        hosts = {}
+        for (name, labels), value in self.counters.items():
+            labels = dict(labels)
+            if "host" in labels:
+                host = hosts.setdefault(labels["host"], Counter())
+                key = f"{name}:{labels['status']}" if name == "responses_total" else name
+                host[key] += value
+        lines = []
+        for host, counts in sorted(hosts.items()):
+            statuses = " ".join(f"{key.split(':')[1]}x{value}" for key, value in sorted(counts.items())
+                                if key.startswith("responses_total:"))
+            fetch = self.histograms.get(("fetch_seconds", (("host", host),)))
+            latency = (f"  fetch p50 {self.quantile(fetch, 0.5) * 1000:g} ms p95 "
+                       f"{self.quantile(fetch, 0.95) * 1000:g} ms" if fetch else "")
+            lines.append(f"{host}: {statuses or 'no responses'}  retries {counts['retries_total']}  "
+                         f"{counts['bytes_total'] / 1024:.0f} KB  cache hits {counts['cache_hits_total']}  "
+                         f"connections {counts['connections_total']}  errors {counts['errors_total']}{latency}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            if name == "stage_seconds":
+                count = sum(histogram[:-1])
+                lines.append(f"{' '.join(str(value) for _, value in labels)}: {count} calls, "
+                             f"{histogram[-1]:.3f}s total, {histogram[-1] / count * 1000:.2f} ms each")
+        return "\n".join(lines)
+
+
+METRICS = Metrics()
+
+
+def _host(url):
+    return urlsplit(url).netloc
+
+
+def record_response(url, response, seconds):
+    # Called by Fetcher.get for every response while enabled
+    host = _host(url)
+    METRICS.count("responses_total", host=host, status=response.status_code)
+    METRICS.count("bytes_total", len(response.content), host=host)
+    METRICS.observe("fetch_seconds", seconds, host=host)
+    if getattr(response, "from_cache", False):
+        METRICS.count("cache_hits_total", host=host)
+    retries = getattr(getattr(response, "raw", None), "retries", None)
+    if retries is not None and retries.history:
+        METRICS.count("retries_total", len(retries.history), host=host)
+    ttfb = response.elapsed.total_seconds()
+    if ttfb:  # responses served from the cache never went out
+        METRICS.observe("ttfb_seconds", ttfb, host=host)
+        METRICS.observe("body_seconds", max(seconds - ttfb, 0.0), host=host)
+
+
+def record_error(url, error):
+    METRICS.count("errors_total", host=_host(url), error=type(error).__name__)
+
+
+# DNS time: socket.getaddrinfo is swapped for a timed one while enabled,
+# and the connection that triggered the lookup reads it back
+_real_getaddrinfo = socket.getaddrinfo
+_lookup = threading.local()
+
+
+def _timed_getaddrinfo(*args, **kwargs):
+    start = time.perf_counter()
+    try:
+        return _real_getaddrinfo(*args, **kwargs)
+    finally:
+        _lookup.seconds = getattr(_lookup, "seconds", 0.0) + time.perf_counter() - start
+
+
+class _TimedConnect:
+    def connect(self):
+        if not METRICS.enabled:
+            return super().connect()
+        _lookup.seconds = 0.0
+        start = time.perf_counter()
+        super().connect()
+        elapsed = time.perf_counter() - start
+        host = self.host if self.port in (None, self.default_port) else f"{self.host}:{self.port}"
+        METRICS.count("connections_total", host=host)
+        METRICS.observe("dns_seconds", _lookup.seconds, host=host)
+        METRICS.observe("connect_seconds", elapsed - _lookup.seconds, host=host)
+
+
+class TimedHTTPConnection(_TimedConnect, HTTPConnection):
+    pass
+
+
+class TimedHTTPSConnection(_TimedConnect, HTTPSConnection):
+    pass
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+def instrument_adapter(adapter):
+    """Make a requests HTTPAdapter open connections that time DNS and connect"""
+    adapter.poolmanager.pool_classes_by_scheme = {
+        "http": _TimedHTTPConnectionPool, "https": _TimedHTTPSConnectionPool,
+    }
+    return adapter
+
+
+def enable():
+    METRICS.enabled = True
+    socket.getaddrinfo = _timed_getaddrinfo
+    return METRICS
+
+
+def disable():
+    METRICS.enabled = False
+    socket.getaddrinfo = _real_getaddrinfo
+
+
+# Where threads that are blocked (not using CPU) sit when sampled
+_IDLE = {"select", "poll", "wait", "accept", "readinto", "sleep", "_wait_for_tstate_lock"}
+
+
+class Sampler:
+    """Statistical profiler: every `interval` seconds of CPU time, note the
+    function each thread is in (own) and every function on its stack"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.own = Counter()
+        self.total = Counter()
+        self.samples = 0
+        self._previous = None
+
+    def _sample(self, signum, frame):
+        self.samples += 1
+        frames = sys._current_frames()
+        frames[threading.main_thread().ident] = frame  # not this handler's own frame
+        for thread_frame in frames.values():
+            if thread_frame.f_code.co_name in _IDLE:
+                continue
+            leaf = thread_frame
+            seen = set()
+            while thread_frame is not None:
+                code = thread_frame.f_code
+                seen.add((code.co_filename, code.co_firstlineno, code.co_name))
+                thread_frame = thread_frame.f_back
+            code = leaf.f_code
+            self.own[(code.co_filename, code.co_firstlineno, code.co_name)] += 1
+            for function in seen:
+                self.total[function] += 1
+
+    def start(self):
+        self._previous = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previous)
+
+    def report(self, top=20, file=sys.stderr):
+        print(f"{self.samples} samples every {self.interval * 1000:g} ms of CPU time", file=file)
+        print(f"{'own':>6} {'total':>6}  function", file=file)
+        for function, own in self.own.most_common(top):
+            filename, line, name = function
+            print(f"{own / self.samples:6.1%} {self.total[function] / self.samples:6.1%}  "
+                  f"{name} ({os.path.basename(filename)}:{line})", file=file)
+
+
+def profile_call(function, *args, mode="cprofile", top=20, file=sys.stderr, **kwargs):
+    """Run function(*args, **kwargs) under a profiler and print its hot spots"""
+    if mode == "sample":
+        sampler = Sampler()
+        sampler.start()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            sampler.stop()
+            sampler.report(top, file)
+
+    import cProfile
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args, **kwargs)
+    finally:
+        stats = pstats.Stats(profiler, stream=file)
+        stats.sort_stats("tottime").print_stats(top)
+
+
+def run_script(path, argv=(), profile=None, metrics_path=None):
+    """Run a scraper script as __main__ with metrics on, then report"""
+    enable()
+    sys.argv = [path, *argv]
+    sys.path.insert(0, os.path.dirname(os.path.abspath(path)))
+
+    def run():
+        try:
+            runpy.run_path(path, run_name="__main__")
+        except SystemExit as e:
+            if e.code not in (None, 0):
+                print(f"{path} exited with {e.code}", file=sys.stderr)
+
+    start = time.perf_counter()
+    if profile:
+        profile_call(run, mode=profile)
+    else:
+        run()
+    print(f"\n{path} ran for {time.perf_counter() - start:.2f}s", file=sys.stderr)
+    print(METRICS.report(), file=sys.stderr)
+    if metrics_path:
+        METRICS.save(metrics_path)
+        print(f"metrics written to {metrics_path}", file=sys.stderr)
+
+
+def benchmark_overhead(repeat=5):
+    # The books crawl against the local catalogue with metrics off and on,
+    # plus the cost of a stage timer on its own
+    from timeit import timeit
+
+    from bookscrapingproject import scrape_books
+    from fixture_server import FixtureServer, books_catalogue_pages
+
+    disable()
+    calls = 1_000_000
+    bare = timeit("pass", number=calls)
+    off = timeit("with time('stage_seconds', stage='x'): pass", globals={"time": METRICS.time}, number=calls)
+    hook = (off - bare) / calls
+
+    with FixtureServer(books_catalogue_pages()) as server:
+        url = server.url("/catalogue/page-1.html")
+        scrape_books(url)  # warm up connections and imports
+        timings = {}
+        for label, switch in (("disabled", disable), ("enabled", enable)):
+            switch()
+            best = float("inf")
+            for _ in range(repeat):
+                start = time.perf_counter()
+                scrape_books(url)
+                best = min(best, time.perf_counter() - start)
+            timings[label] = best
+        disable()
+    print(f"books crawl, 50 pages: disabled {timings['disabled'] * 1000:.0f} ms, "
+          f"enabled {timings['enabled'] * 1000:.0f} ms "
+          f"({(timings['enabled'] / timings['disabled'] - 1) * 100:+.1f}%)")
+    # Disabled, a page costs one flag check in fetch and one no-op timer in parse
+    page = timings["disabled"] / 50
+    print(f"disabled stage timer {hook * 1e9:.0f} ns, {hook / page:.4%} of a page's {page * 1000:.1f} ms")
+    print(METRICS.report())
+
+
+def main(arguments):
+    if not arguments or arguments[0] == "--bench":
+        benchmark_overhead()
+        return
+    profile = metrics_path = None
+    while arguments and arguments[0].startswith("--"):
+        option = arguments.pop(0)
+        if option.startswith("--profile"):
+            profile = option.partition("=")[2] or "cprofile"
+        elif option == "--metrics":
+            metrics_path = arguments.pop(0)
+    run_script(arguments[0], arguments[1:], profile, metrics_path)
+
+
+if __name__ == "__main__":
+    # Go through the imported module: its METRICS is the one fetcher,
+    # parsers and sinks record into, not this __main__ copy's
+    import metrics
+
+    metrics.main(sys.argv[1:])
@@ -0,0 +1,177 @@
+"""
+Pull product fields out of a Next.js page's __NEXT_DATA__ JSON.
+
+Walmart (and other Next.js sites) ship the whole page state as JSON in
+<script id="__NEXT_DATA__">. Instead of building a DOM to find that tag
+and json.loads-ing all of it, this finds the tag with a plain byte
+search and then walks the JSON text along the paths we ask for: values
+off the path are skipped over, wanted values are decoded, and the walk
+stops as soon as every wanted path has been read.
+"""
+
+import json
+import re
+import statistics
+import sys
+import time
+
+# Where the product lives in Walmart's page state
+PRODUCT_PATH = "props.pageProps.initialData.data.product"
+
+# field name -> path inside the product
+PRODUCT_FIELDS = {
+    "name": "name",
+    "brand": "brand",
+    "price": "priceInfo.currentPrice.price",
+    "rating": "averageRating",
+    "reviews": "numberOfReviews",
+    "availability": "availabilityStatus",
+}
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_decoder = json.JSONDecoder()
+
+
+def find_next_data(page):
+    """Return the __NEXT_DATA__ JSON text of a page (bytes or str), or None"""
+    if isinstance(page, str):
+        page = page.encode("utf-8")
+
+    position = page.find(b"__NEXT_DATA__")
+    while position != -1:
+        # Make sure the match sits inside a <script ...> opening tag
+        tag_start = page.rfind(b"<script", 0, position)
+        tag_end = page.find(b">", position)
+        if tag_start != -1 and tag_end != -1 and b">" not in page[tag_start:position]:
+            end = page.find(b"</script", tag_end)
+            return page[tag_end + 1:end if end != -1 else len(page)].decode("utf-8")
+        position = page.find(b"__NEXT_DATA__", position + 1)
+
+    # Some saved pages (like walmart_data.html) are the bare JSON already
+    if page.lstrip()[:1] == b"{":
+        return page.decode("utf-8")
+    return None
+
+
+def _path_tree(paths):
+    # ["a.b", "a.c"] -> {"a": {"b": None, "c": None}}, None marks a wanted value
+    tree = {}
+    for path in paths:
+        node = tree
+        keys = path.split(".")
+        for key in keys[:-1]:
+            node = node.setdefault(key, {})
+            if node is None:
+                raise ValueError(f"Path {path!r} goes inside another wanted path")
+        node[keys[-1]] = None
+    return tree
+
+
+def _walk(text, index, tree, found, prefix, stop_when_done):
+    # Read the value starting at text[index], collecting wanted paths into
+    # `found`. Returns the index after the value, or None when it stopped
+    # early because nothing after this point is needed.
+    if text[index] != "{":
+        # Not an object, so none of the paths below it can exist
+        return _decoder.raw_decode(text, index)[1]
+
+    remaining = set(tree)
+    index = _WHITESPACE.match(text, index + 1).end()
+    if text[index] == "}":
+        return index + 1
+
+    while True:
+        key, index = _decoder.raw_decode(text, index)
+        index = _WHITESPACE.match(text, index).end() + 1  # step over ':'
+        index = _WHITESPACE.match(text, index).end()
+
+        if key in remaining:
+            remaining.discard(key)
+            done = stop_when_done and not remaining
+            if tree[key] is None:
+                found[prefix + key], index = _decoder.raw_decode(text, index)
+            else:
+                index = _walk(text, index, tree[key], found, prefix + key + ".", done)
+            if done:
+                return None
+        else:
+            _, index = _decoder.raw_decode(text, index)  # skip the whole value
+
+        index = _WHITESPACE.match(text, index).end()
+        if text[index] == "}":
+            return index + 1
+        index = _WHITESPACE.match(text, index + 1).end()  # step over ','
+
+
+def extract_paths(json_text, paths):
+    """Return {path: value} for the dotted paths present in the JSON text"""
+    found = {}
+    index = _WHITESPACE.match(json_text).end()
+    _walk(json_text, index, _path_tree(paths), found, "", True)
+    return found
+
+
+def extract_product(page, fields=PRODUCT_FIELDS, base=PRODUCT_PATH):
+    """Return {field: value} for one product page, None for missing fields"""
+    json_text = find_next_data(page)
+    if json_text is None:
+        return None
+    paths = {field: f"{base}.{path}" for field, path in fields.items()}
+    found = extract_paths(json_text, paths.values())
+    return {field: found.get(path) for field, path in paths.items()}
+
+
+def extract_products(pages, fields=PRODUCT_FIELDS, base=PRODUCT_PATH):
+    """Yield (product, seconds) for each page, timing every extraction"""
+    for page in pages:
+        start = time.perf_counter()
+        product = extract_product(page, fields, base)
+        yield product, time.perf_counter() - start
+
+
+def _extract_with_soup(page):
+    # What walmart_scrape.py used to do: full DOM, full json.loads
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(page, "html.parser")
+    data = json.loads(soup.find("script", id="__NEXT_DATA__").string)
+    product = data.get("props", {}).get("pageProps", {}).get("initialData", {}).get("data", {}).get("product", {})
+    return {
+        "name": product.get("name"),
+        "brand": product.get("brand"),
+        "price": product.get("priceInfo", {}).get("currentPrice", {}).get("price"),
+        "rating": product.get("averageRating"),
+        "reviews": product.get("numberOfReviews"),
+        "availability": product.get("availabilityStatus"),
+    }
+
+
+def benchmark_extraction(file_path="walmart_data.html", batch_size=200):
+    # walmart_data.html is the saved __NEXT_DATA__ blob, wrap it back into
+    # a page the way Walmart serves it
+    with open(file_path, "rb") as f:
+        blob = f.read()
+    page = (b'<!DOCTYPE html><html><head><title>Walmart.com</title></head><body><div id="__next"></div>'
+            b'<script id="__NEXT_DATA__" type="application/json">' + blob + b"</script></body></html>")
+    pages = [page] * batch_size
+
+    streamed = list(extract_products(pages))
+    latencies = [seconds for _, seconds in streamed]
+
+    soup_latencies = []
+    for page in pages[:20]:  # the DOM path is slow, a smaller sample will do
+        start = time.perf_counter()
+        expected = _extract_with_soup(page)
+        soup_latencies.append(time.perf_counter() - start)
+
+    same = all(product == expected for product, _ in streamed)
+    print(f"{batch_size} pages of {len(page) / 1024:.0f} KB, same fields: {same}")
+    for label, values in (("byte scan + path walk", latencies), ("soup + json.loads", soup_latencies)):
+        values = sorted(values)
+        print(f"  {label:<22} mean {statistics.mean(values) * 1000:6.2f} ms   "
+              f"p50 {values[len(values) // 2] * 1000:6.2f} ms   "
+              f"p99 {values[int(len(values) * 0.99) - 1] * 1000:6.2f} ms")
+
+
+if __name__ == "__main__":
+    benchmark_extraction(*sys.argv[1:2])
@@ -0,0 +1,432 @@
+"""
+Turn scraped text columns into typed numeric columns.
+
+Every scraper kept prices, ratings and weather readings as display text
+("Â£51.77", "Three", "+21°C", "↓4km/h") and cleaned them up row by row,
+sometimes wrongly: keeping only the digits of "£51.77" gives 5177. This
+module parses whole columns at once with pandas string methods:
+
+    parse_amounts       "Rs.4,990.00", "1.234,56 €", "£51.77" -> float
+    parse_currencies    the same prices -> "PKR", "EUR", "GBP"
+    parse_ratings       "Three", "4.5 out of 5", "9.3(3M)" -> float
+    parse_counts        "3M", "524K", "1,234" -> float
+    parse_temperatures  "+21°C", "70°F" -> degrees Celsius
+    parse_humidity      "55%" -> float
+    parse_wind          "↓4km/h", "3m/s", "5mph" -> km/h
+
+Scraped columns repeat the same few values a lot, so each column is
+factorized first and only its distinct values go through the string
+methods. The scalar parse_amount() & co. do the same for one value and
+are what the column versions are checked against.
+
+Decimal separators: when a number has both "." and "," the last one is
+the decimal point. With only one kind, a single separator followed by
+exactly three digits ("5,990", "1.234") groups thousands, anything else
+("51.77", "12,5") is the decimal point. Pass decimal="." or "," to
+override that guess.
+"""
+
+import math
+import re
+import sys
+import time
+
+from lazy import lazy_module
+
+# The column functions need them, the scalar parse_*() calls others
+# import this module for don't
+np = lazy_module("numpy")
+pd = lazy_module("pandas")
+
+# A space, NBSP or apostrophe only groups thousands: exactly three digits
+# after it, and before any "." or ",". "12.99 2 bids" is 12.99. No
+# lookarounds, the column version runs it in Arrow's RE2
+AMOUNT_PATTERN = r"(\d+(?:['  ]\d{3}\b)*(?:[.,]\d+)*)"
+# Amounts float() reads right once their commas are dropped: no
+# separator, one "." that can't be grouping thousands, or commas grouping
+# thousands before an optional "." (see _decimal_separator)
+PLAIN_AMOUNT_PATTERN = (r"\d+|\d+\.(?:\d{1,2}|\d{4,})|(?:\d{4,}|0\d{0,2})\.\d{3}"
+                        r"|[1-9]\d{0,2}(?:,\d{3})+(?:\.\d+)?")
+# "2 for 19.99" is a price of 19.99, not of 2
+MULTIBUY_PATTERN = r"^\D*?\d+\s+[Ff][Oo][Rr]\b"
+CURRENCY_PATTERN = r"([$£€₨]|\b(?:USD|GBP|EUR|PKR|INR)\b|\bRs\b)"
+CURRENCY_CODES = {"$": "USD", "£": "GBP", "€": "EUR", "₨": "PKR", "Rs": "PKR"}
+RATING_WORDS = {"zero": 0, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5}
+RATING_PATTERN = r"(?i)\b(zero|one|two|three|four|five)\b|(\d+(?:\.\d+)?)"
+COUNT_PATTERN = r"(?i)(\d+(?:[.,]\d+)*)\s*([KMB])?\b"
+COUNT_FACTORS = {"": 1, "K": 1e3, "M": 1e6, "B": 1e9}
+TEMPERATURE_PATTERN = r"([+-]?\d+(?:\.\d+)?)\s*(?:Â?°)?\s*([CF])\b"
+HUMIDITY_PATTERN = r"(\d+(?:\.\d+)?)\s*%"
+WIND_PATTERN = r"(\d+(?:\.\d+)?)\s*(km/h|mph|m/s|kt)"
+WIND_FACTORS = {"km/h": 1.0, "mph": 1.609344, "m/s": 3.6, "kt": 1.852}
+
+_amount = re.compile(AMOUNT_PATTERN, re.ASCII)  # \d and \b as RE2 reads them
+_multibuy = re.compile(MULTIBUY_PATTERN, re.ASCII)
+_currency = re.compile(CURRENCY_PATTERN)
+_rating = re.compile(RATING_PATTERN)
+_count = re.compile(COUNT_PATTERN)
+_temperature = re.compile(TEMPERATURE_PATTERN)
+_humidity = re.compile(HUMIDITY_PATTERN)
+_wind = re.compile(WIND_PATTERN)
+
+
+# One value at a time
+
+def _decimal_separator(number):
+    separators = [char for char in number if char in ".,"]
+    if not separators:
+        return None
+    last = separators[-1]
+    if len(set(separators)) == 2:
+        return last
+    if separators.count(last) > 1:
+        return None  # "1,234,567"
+    # One separator groups thousands only after 1-3 digits that don't
+    # start with 0 and before exactly three: "5,990" but not "0.995"
+    head, tail = (re.sub(r"\D", "", part) for part in number.split(last))
+    return None if len(tail) == 3 and len(head) <= 3 and not head.startswith("0") else last
+
+
+def parse_amount(text, decimal=None):
+    """The first amount in a price string as a float, NaN if none"""
+    if text is None:
+        return math.nan
+    text = str(text)
+    multibuy = _multibuy.match(text)
+    match = _amount.search(text, multibuy.end() if multibuy else 0)
+    if not match:
+        return math.nan
+    number = match.group(1)
+    decimal = decimal or _decimal_separator(number)
+    digits = re.sub(r"[^\d" + re.escape(decimal) + "]" if decimal else r"\D", "", number)
+    return float(digits.replace(decimal, ".") if decimal else digits)
+
+
+def parse_currency(text):
+    """ISO code of the currency nearest before the amount, else the
+    first one after it"""
+    text = "" if text is None else str(text)
+    match = _amount.search(text)
+    if not match:
+        return None
+    before = _currency.findall(text[:match.start()])
+    after = _currency.findall(text[match.start():])
+    symbol = before[-1] if before else after[0] if after else None
+    return CURRENCY_CODES.get(symbol, symbol)
+
+
+def parse_rating(text):
+    match = _rating.search(str(text)) if text is not None else None
+    if not match:
+        return math.nan
+    word, number = match.groups()
+    return float(RATING_WORDS[word.lower()]) if word else float(number)
+
+
+def parse_count(text):
+    match = _count.search(str(text)) if text is not None else None
+    if not match:
+        return math.nan
+    number, suffix = match.groups()
+    if suffix:
+        return float(number.replace(",", ".")) * COUNT_FACTORS[suffix.upper()]
+    return float(number.replace(",", "").replace(".", ""))
+
+
+def parse_temperature(text):
+    match = _temperature.search(str(text)) if text is not None else None
+    if not match:
+        return math.nan
+    value = float(match.group(1))
+    return (value - 32) * 5 / 9 if match.group(2) == "F" else value
+
+
+def parse_humidity_value(text):
+    match = _humidity.search(str(text)) if text is not None else None
+    return float(match.group(1)) if match else math.nan
+
+
+def parse_wind_speed(text):
+    match = _wind.search(str(text)) if text is not None else None
+    return float(match.group(1)) * WIND_FACTORS[match.group(2)] if match else math.nan
+
+
+# Whole columns
+
+def _by_distinct(values, parse_column, dtype=float):
+    # Run parse_column over the distinct values only and spread the
+    # results back over the column with their factorize codes
+    if isinstance(values, pd.Series):
+        index, name = values.index, values.name
+    else:
+        values, index, name = np.asarray(values, dtype=object), None, None
+    codes, distinct = pd.factorize(values)
+    parsed = parse_column(pd.Series(distinct).astype("str"))
+    if dtype is float:
+        parsed = pd.to_numeric(parsed, errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+        filler = np.nan
+    else:
+        parsed = parsed.astype(object).where(parsed.notna(), None).to_numpy()
+        filler = None
+    result = parsed.take(codes) if len(parsed) else np.full(len(codes), filler, dtype=parsed.dtype)
+    if (codes < 0).any():
+        result[codes < 0] = filler  # missing in, missing out
+    return pd.Series(result, index=index, name=name)
+
+
+def _to_float(numbers):
+    # Arrow casts its strings to float64 itself, numpy's astype goes
+    # through one Python str per row first
+    if getattr(numbers.dtype, "storage", None) == "pyarrow":
+        numbers = numbers.astype("float64[pyarrow]")
+    return numbers.to_numpy(dtype="float64", na_value=np.nan)
+
+
+def _amount_column(texts, decimal):
+    # Only regex replaces and slices, which run in Arrow when pyarrow is
+    # behind the str dtype. The amount is all its digits divided by ten
+    # to the number of decimals, exactly what float() of "51.77" gives.
+    # Every pass is a full scan of the column, so there are as few as the
+    # rules allow: with one kind of separator the last one is that kind,
+    # and with a single separator its head is the digits before the tail.
+    number = texts.str.replace(r"(?s)^[^0-9]*" + AMOUNT_PATTERN + ".*$", r"\1", regex=True)
+    # The multi-buy prefix is rare: a cheap scan finds the rows to redo
+    multibuy = texts.str.contains(r"\d\s+[Ff][Oo][Rr]\b", regex=True).to_numpy(dtype=bool)
+    if multibuy.any():
+        number[multibuy] = texts[multibuy].str.replace(
+            r"(?s)(?:" + MULTIBUY_PATTERN + r")?\D*?" + AMOUNT_PATTERN + ".*$", r"\1", regex=True)
+    amounts = pd.Series(np.nan, index=texts.index)
+    if decimal is None:
+        # "1299", "12.99", "4,990.00": most of what we scrape, cast in one
+        # go once the commas are gone; the rest takes the passes below
+        plain = number.str.fullmatch(PLAIN_AMOUNT_PATTERN)
+        amounts[plain.to_numpy(dtype=bool)] = (
+            _to_float(number[plain].str.replace(",", "", regex=False)))
+        number = number[~plain]
+    digits = number.str.replace(r"\D", "", regex=True)
+    if decimal is None:
+        dots = number.str.count(r"\.")
+        commas = number.str.count(",")
+        tail = number.str.replace(r"^.*[.,]|\D", "", regex=True).str.len()
+        head = digits.str.len() - tail
+        grouped = (tail == 3) & (head <= 3) & ~digits.str.startswith("0")
+        is_decimal = ((dots > 0) & (commas > 0)) | ((dots + commas == 1) & ~grouped)
+    else:
+        tail = number.str.replace(r"^.*" + re.escape(decimal) + r"|\D", "", regex=True).str.len()
+        is_decimal = number.str.contains(decimal, regex=False)
+    decimals = tail.where(is_decimal, 0).to_numpy(dtype=float)
+    amounts[number.index] = _to_float(digits.where(digits != "")) / 10 ** decimals
+    return amounts
+
+
+def parse_amounts(values, decimal=None):
+    return _by_distinct(values, lambda texts: _amount_column(texts, decimal))
+
+
+def parse_currencies(values):
+    def column(texts):
+        prefix = texts.str.extract(r"^(\D*)\d", expand=False)
+        before = prefix.str.extract(r".*" + CURRENCY_PATTERN, expand=False)
+        after = texts.str.extract(r"^\D*\d.*?" + CURRENCY_PATTERN, expand=False)
+        symbol = before.fillna(after)
+        return symbol.map(lambda found: CURRENCY_CODES.get(found, found), na_action="ignore")
+    return _by_distinct(values, column, dtype=object)
+
+
+def parse_ratings(values):
+    def column(texts):
+        found = texts.str.extract(RATING_PATTERN)
+        words = found[0].str.lower().map(RATING_WORDS)
+        return words.fillna(pd.to_numeric(found[1], errors="coerce"))
+    return _by_distinct(values, column)
+
+
+def parse_counts(values):
+    def column(texts):
+        found = texts.str.extract(COUNT_PATTERN)
+        suffix = found[1].fillna("").str.upper()
+        scaled = pd.to_numeric(found[0].str.replace(",", ".", regex=False), errors="coerce")
+        plain = pd.to_numeric(found[0].str.replace(r"[.,]", "", regex=True), errors="coerce")
+        return (scaled * suffix.map(COUNT_FACTORS)).where(suffix != "", plain)
+    return _by_distinct(values, column)
+
+
+def parse_temperatures(values):
+    def column(texts):
+        found = texts.str.extract(TEMPERATURE_PATTERN)
+        value = pd.to_numeric(found[0], errors="coerce")
+        return value.where(found[1] != "F", (value - 32) * 5 / 9)
+    return _by_distinct(values, column)
+
+
+def parse_humidity(values):
+    return _by_distinct(values, lambda texts: texts.str.extract(HUMIDITY_PATTERN, expand=False))
+
+
+def parse_wind(values):
+    def column(texts):
+        found = texts.str.extract(WIND_PATTERN)
+        return pd.to_numeric(found[0], errors="coerce") * found[1].map(WIND_FACTORS)
+    return _by_distinct(values, column)
+
+
+# The CSVs in this repo
+
+def normalize_books(df):
+    return pd.DataFrame({
+        "title": df["Title"],
+        "price": parse_amounts(df["Price"]),
+        "currency": parse_currencies(df["Price"]),
+        "rating": parse_ratings(df["Rating"]).astype("Int8"),
+    })
+
+
+def normalize_imdb(df):
+    # "9.3(3M)" is the star rating followed by the vote count
+    votes = df["Rating"].astype(str).str.extract(r"\(([^)]*)\)", expand=False)
+    return pd.DataFrame({
+        "title": df["Title"],
+        "year": pd.to_numeric(df["Year"], errors="coerce").astype("Int16"),
+        "rating": parse_ratings(df["Rating"]),
+        "votes": parse_counts(votes).astype("Int64"),
+    })
+
+
+# Condition, temperature, humidity and wind, wherever the columns split them
+WEATHER_PATTERN = (r"^(?P<condition>.*?)\s*(?P<temperature>[+-]?\d+(?:\.\d+)?\s*(?:Â?°)?\s*[CF])\b"
+                   r"\s*(?P<humidity>\d+(?:\.\d+)?\s*%)?\s*(?P<wind>\S*?\d+(?:\.\d+)?\s*(?:km/h|mph|m/s|kt))?")
+
+
+def normalize_weather(df):
+    """Typed weather columns. Rows saved by the old split(" ") have
+    multi-word conditions spread over the next columns ("Partly",
+    "cloudy", "+15°C", "55%"), so the readings are found again in the
+    joined row; the wind of those rows was cut off and stays missing."""
+    readings = df["Condition"].astype(str).str.cat(
+        [df[column].astype(str) for column in ("Temperature", "Humidity", "Wind Speed")],
+        sep=" ", na_rep="",
+    ).str.replace(r"\bnan\b", "", regex=True)
+    found = readings.str.extract(WEATHER_PATTERN)
+    return pd.DataFrame({
+        "city": df["City"],
+        "condition": found["condition"].str.strip(),
+        "temperature_c": parse_temperatures(found["temperature"]),
+        "humidity_pct": parse_humidity(found["humidity"]),
+        "wind_kmh": parse_wind(found["wind"]),
+    })
+
+
+def normalize_alerts(df):
+    columns = {"url": df["url"], "alert_price": parse_amounts(df["alert_price"])}
+    if "price" in df:
+        columns["price"] = parse_amounts(df["price"])
+    return pd.DataFrame(columns)
+
+
+BUNDLED_CSVS = {
+    "books_data.csv": normalize_books,
+    "imdb_top_movies.csv": normalize_imdb,
+    "world_capitals_weather.csv": normalize_weather,
+    "products.csv": normalize_alerts,
+    "prices.csv": normalize_alerts,
+}
+
+# column function -> scalar function it has to agree with
+_REFERENCES = [
+    (parse_amounts, parse_amount), (parse_currencies, parse_currency), (parse_ratings, parse_rating),
+    (parse_counts, parse_count), (parse_temperatures, parse_temperature),
+    (parse_humidity, parse_humidity_value), (parse_wind, parse_wind_speed),
+]
+
+
+def _same(column, scalar):
+    column = list(column)
+    return all(
+        (a is None and b is None) or (a == b) or (isinstance(a, float) and isinstance(b, float)
+                                                  and math.isnan(a) and math.isnan(b))
+        for a, b in zip(column, scalar)
+    ) and len(column) == len(scalar)
+
+
+# Prices that have been parsed wrong before, with what they should give
+AMOUNT_CASES = [
+    ("US $12.99 2 bids", 12.99), ("19.99 24.99", 19.99), ("€0.995", 0.995), ("£51.77", 51.77),
+    ("Rs.4,990.00", 4990.0), ("PKR 5,990", 5990.0), ("1.234,56 €", 1234.56), ("€1.234,56", 1234.56),
+    ("EUR 12,50", 12.5), ("1\u00a0234,56 €", 1234.56), ("1 234 567", 1234567.0), ("1'234.50 CHF", 1234.5),
+    ("1234.567", 1234.567), ("1,234,567", 1234567.0), ("2 for 19.99", 19.99),
+    ("0,990", 0.99), ("1,234.567", 1234.567), ("£5.00, 3 for £12", 5.0),
+]
+
+
+def check_amounts():
+    texts = [text for text, _ in AMOUNT_CASES]
+    expected = [amount for _, amount in AMOUNT_CASES]
+    wrong = [(text, amount, one, column)
+             for text, amount, one, column in zip(texts, expected, map(parse_amount, texts), parse_amounts(texts))
+             if not (one == amount and column == amount)]
+    for text, amount, one, column in wrong:
+        print(f"  {text!r}: parse_amount {one}, parse_amounts {column}, expected {amount}")
+    print(f"amount cases: {'all ok' if not wrong else f'{len(wrong)} wrong'}")
+    return not wrong
+
+
+def check_bundled():
+    """Normalize every bundled CSV, report values that didn't parse and
+    check each column parser against its one-value-at-a-time version"""
+    ok = check_amounts()
+    for file_name, normalizer in BUNDLED_CSVS.items():
+        raw = pd.read_csv(file_name, dtype=str, keep_default_na=False)
+        typed = normalizer(raw)
+        missing = {column: int(typed[column].isna().sum()) for column in typed.columns
+                   if typed[column].isna().any()}
+        print(f"{file_name:<28} {len(typed):5} rows  dtypes "
+              f"{', '.join(f'{c}={t}' for c, t in typed.dtypes.astype(str).items())}"
+              f"{f'  missing {missing}' if missing else ''}")
+        for column in raw.columns:
+            values = raw[column].tolist()
+            for parse_column, parse_one in _REFERENCES:
+                if not _same(parse_column(values), [parse_one(value) for value in values]):
+                    print(f"  {parse_column.__name__} disagrees with {parse_one.__name__} on {column}")
+                    ok = False
+    return ok
+
+
+def _synthetic_columns(rows, rng):
+    # Prices in the formats our sites use, star words and wttr.in readings
+    cents = rng.integers(100, 2_000_000, rows)
+    formats = ["£{:.2f}", "PKR {:,.0f}", "Rs.{:,.2f}", "{:.2f} €"]
+    prices = [formats[which].format(amount) for which, amount in
+              zip(rng.integers(0, len(formats), rows).tolist(), (cents / 100).tolist())]
+    ratings = np.array(["One", "Two", "Three", "Four", "Five"])[rng.integers(0, 5, rows)]
+    temperatures = np.char.add(np.char.add("+", rng.integers(-20, 45, rows).astype(str)), "°C")
+    return {"price": prices, "rating": ratings.tolist(), "temperature": temperatures.tolist()}
+
+
+def benchmark_normalize(rows=1_000_000):
+    # Per-row Python against column-at-a-time on a DataFrame like
+    # read_csv() gives: a price in every format we scrape (nearly all
+    # distinct), a catalogue-like price column (prices repeat, as they do
+    # on real sites), star words and temperatures
+    rng = np.random.default_rng(0)
+    data = pd.DataFrame(_synthetic_columns(rows, rng), dtype="str")
+    books = pd.read_csv("books_data.csv", dtype="str")["Price"]
+    data["catalogue price"] = books.to_numpy()[rng.integers(0, len(books), rows)]
+    cases = [("price", parse_amounts, parse_amount), ("catalogue price", parse_amounts, parse_amount),
+             ("rating", parse_ratings, parse_rating), ("temperature", parse_temperatures, parse_temperature)]
+    for name, parse_column, parse_one in cases:
+        start = time.perf_counter()
+        expected = [parse_one(value) for value in data[name]]
+        per_row = time.perf_counter() - start
+        start = time.perf_counter()
+        result = parse_column(data[name])
+        vectorized = time.perf_counter() - start
+        print(f"{name:<16} {data[name].nunique():>9,} distinct  per-row {per_row:6.2f}s  "
+              f"column {vectorized:6.2f}s  x{per_row / vectorized:5.1f}  "
+              f"{'same values' if _same(result, expected) else 'VALUES DIFFER'}")
+
+
+if __name__ == "__main__":
+    if "--bench" in sys.argv:
+        benchmark_normalize()
+    else:
+        sys.exit(0 if check_bundled() else 1)
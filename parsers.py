@@ -0,0 +1,629 @@
+"""
+One parsing interface over several HTML parser engines.
+
+The scrapers used to hard-code BeautifulSoup(..., 'html.parser'), the
+slowest backend. parse() returns a Node with the handful of calls we
+actually use (select, select_one, find_all, find, text, attrs, get) and
+the engine underneath can be swapped:
+
+    html.parser  BeautifulSoup with Python's built-in parser
+    lxml         lxml.html with cssselect, C parser and C queries
+    selectolax   selectolax's lexbor engine, fastest of the three
+
+Text and attributes follow BeautifulSoup's rules on every engine
+(get_text(strip=True) joining, "class" as a list), so the same code gives
+the same fields whichever engine parsed the page.
+
+parse(html, only=[...]) is a partial parse for pages where a scraper
+reads a few known elements: with html.parser only the subtrees whose
+outermost tag matches one of the simple selectors ("li.next",
+"article.product_pod", "div#main") are built, the rest of the page is
+tokenized and dropped. lxml and selectolax build their whole tree in C
+faster than any filter in Python could skip it, so they ignore `only`,
+and a full lxml parse still beats a partial html.parser one (1.6 against
+12.5 ms on a books page, 26 against 213 ms on sap.txt). Scrapers on the
+default engine don't pass it; it is for code that has to parse with
+html.parser, as when lxml isn't installed.
+
+Even then it only pays on pages with a lot besides the targets. On
+sap.txt (parsers.py --partial) it takes about half the time and a
+quarter of the memory of a full html.parser parse. On the books and
+IMDb fixtures, which are little but the targets, it saves 1-13% memory
+and no time: repeated runs put the partial parse anywhere from 18%
+faster to 54% slower on the books page, and from 17% faster to 48%
+slower on the IMDb chart.
+"""
+
+import re
+import sys
+import time
+from functools import cached_property, lru_cache
+
+import soupsieve
+from bs4 import BeautifulSoup, CData, NavigableString
+from bs4.element import RubyParenthesisString, RubyTextString, Script, Stylesheet, TemplateString
+
+from metrics import METRICS
+
+try:
+    from bs4.filter import ElementFilter
+except ImportError:  # BeautifulSoup before 4.13 parses everything
+    ElementFilter = None
+
+try:
+    import lxml.html
+    from lxml.cssselect import CSSSelector
+except ImportError:  # the lxml engine needs both lxml and cssselect
+    CSSSelector = None
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
+
+# Strings inside these tags are kept apart from the page text, the same
+# as BeautifulSoup does: a div's text leaves out its <script> contents
+STRING_CONTAINERS = {"script", "style", "template", "rt", "rp"}
+
+# Attributes BeautifulSoup splits into a list of values
+LIST_ATTRIBUTES = {
+    "*": {"class", "accesskey", "dropzone"},
+    "a": {"rel", "rev"},
+    "link": {"rel", "rev"},
+    "td": {"headers"},
+    "th": {"headers"},
+    "form": {"accept-charset"},
+    "object": {"archive"},
+    "area": {"rel"},
+    "icon": {"sizes"},
+    "iframe": {"sandbox"},
+    "output": {"for"},
+}
+
+
+def _bs4_attrs(name, attrs):
+    # Turn {"class": "a b"} into {"class": ["a", "b"]} like BeautifulSoup
+    list_names = LIST_ATTRIBUTES["*"] | LIST_ATTRIBUTES.get(name, set())
+    return {
+        key: (value or "").split() if key in list_names else ("" if value is None else value)
+        for key, value in attrs.items()
+    }
+
+
+def _class_selector(name, class_=None, id=None):
+    # Build a CSS selector equivalent to find_all(name, class_=..., id=...)
+    selector = name or "*"
+    if id:
+        selector += f'[id="{id}"]'
+    if class_:
+        # BeautifulSoup matches one class, or the whole class string exactly
+        selector += f'[class~="{class_}"]' if " " not in class_ else f'[class="{class_}"]'
+    return selector
+
+
+class Node:
+    """A parsed element, wrapping whatever the engine returned"""
+
+    def __init__(self, element):
+        self.element = element
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {self.name}>"
+
+    @property
+    def _key(self):
+        # What makes two wrappers the same element: the engine's own
+        # object, as long as the engine hands out one object per element
+        return id(self.element)
+
+    def __eq__(self, other):
+        return isinstance(other, Node) and self.engine == other.engine and self._key == other._key
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __getitem__(self, key):
+        return self.attrs[key]
+
+    def __contains__(self, key):
+        return key in self.attrs
+
+    def get(self, key, default=None):
+        return self.attrs.get(key, default)
+
+    def find_all(self, name=None, class_=None, id=None):
+        if isinstance(name, (list, tuple, set)):
+            selector = ", ".join(_class_selector(tag, class_, id) for tag in name)
+        else:
+            selector = _class_selector(name, class_, id)
+        return self.select(selector)
+
+    def find(self, name=None, class_=None, id=None):
+        found = self.find_all(name, class_, id)
+        return found[0] if found else None
+
+    def text(self, strip=True):
+        # Only strings of this node's own kind count, see STRING_CONTAINERS
+        want = self.name if self.name in STRING_CONTAINERS else None
+        parts = []
+        for event in self._events():
+            if event[0] == "text" and event[2] == want:
+                string = event[1].strip() if strip else event[1]
+                if string:
+                    parts.append(string)
+        return "".join(parts)
+
+    def scan_text(self, names):
+        """Yield (node, text) for every descendant tag in `names`, in
+        document order, walking the tree only once.
+
+        Each open tag collects its strings per kind; when it closes its
+        text is joined and handed to its parent, so text is built bottom-up
+        instead of re-walking every subtree.
+        """
+        found = []  # [node, text] pairs, text filled in when the tag closes
+        stack = [(None, {}, None)]  # (want, parts by kind, slot in found)
+        for event in self._events():
+            if event[0] == "text":
+                string = event[1].strip()
+                if string:
+                    stack[-1][1].setdefault(event[2], []).append(string)
+            elif event[0] == "start":
+                node = event[1]
+                want = node.name if node.name in STRING_CONTAINERS else None
+                slot = None
+                if node.name in names:
+                    slot = len(found)
+                    found.append([node, ""])
+                stack.append((want, {}, slot))
+            else:
+                want, parts, slot = stack.pop()
+                parent_parts = stack[-1][1]
+                for kind, strings in parts.items():
+                    joined = "".join(strings)
+                    parent_parts.setdefault(kind, []).append(joined)
+                    if kind == want and slot is not None:
+                        found[slot][1] = joined
+        for node, text in found:
+            yield node, text
+
+
+class SoupNode(Node):
+    engine = "html.parser"
+
+    # BeautifulSoup string classes and the kind of text they hold
+    STRING_KINDS = {
+        NavigableString: None, CData: None, Script: "script", Stylesheet: "style",
+        TemplateString: "template", RubyTextString: "rt", RubyParenthesisString: "rp",
+    }
+
+    @property
+    def name(self):
+        return self.element.name
+
+    @property
+    def attrs(self):
+        return self.element.attrs
+
+    def text(self, strip=True):
+        return self.element.get_text(strip=strip)
+
+    def select(self, css):
+        return [SoupNode(tag) for tag in self.element.select(css)]
+
+    def select_one(self, css):
+        tag = self.element.select_one(css)
+        return SoupNode(tag) if tag is not None else None
+
+    def find_all(self, name=None, class_=None, id=None):
+        filters = {}
+        if class_:
+            filters["class_"] = class_
+        if id:
+            filters["id"] = id
+        return [SoupNode(tag) for tag in self.element.find_all(name, **filters)]
+
+    def _events(self):
+        kinds = self.STRING_KINDS
+        stack = [iter(self.element.contents)]
+        while stack:
+            child = next(stack[-1], None)
+            if child is None:
+                stack.pop()
+                if stack:
+                    yield ("end",)
+            elif child.__class__ in kinds:
+                yield ("text", child, kinds[child.__class__])
+            elif getattr(child, "contents", None) is not None:
+                yield ("start", SoupNode(child))
+                stack.append(iter(child.contents))
+            # Comments, doctypes and the like carry no text
+
+
+class LxmlNode(Node):
+    engine = "lxml"
+
+    @property
+    def name(self):
+        return self.element.tag
+
+    @cached_property
+    def attrs(self):
+        return _bs4_attrs(self.element.tag, self.element.attrib)
+
+    def select(self, css):
+        # cssselect matches the element itself too, BeautifulSoup doesn't
+        return [LxmlNode(el) for el in _lxml_selector(css)(self.element) if el is not self.element]
+
+    def select_one(self, css):
+        found = self.select(css)
+        return found[0] if found else None
+
+    def _events(self):
+        # Walk elements keeping track of the innermost string container,
+        # an element's .text comes before its children and .tail after it
+        root = self.element
+        container = root.tag if root.tag in STRING_CONTAINERS else None
+        if root.text:
+            yield ("text", root.text, container)
+        stack = [(root, iter(root), container)]
+        while stack:
+            element, children, container = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                if stack:
+                    yield ("end",)
+                    if element.tail:
+                        yield ("text", element.tail, stack[-1][2])
+                continue
+            if not isinstance(child.tag, str):
+                # Comment or processing instruction, only its tail is text
+                if child.tail:
+                    yield ("text", child.tail, container)
+                continue
+            yield ("start", LxmlNode(child))
+            inner = child.tag if child.tag in STRING_CONTAINERS else container
+            if child.text:
+                yield ("text", child.text, inner)
+            stack.append((child, iter(child), inner))
+
+
+class SelectolaxNode(Node):
+    engine = "selectolax"
+
+    @property
+    def _key(self):
+        # css(), css_first() and iter() build a new Python object for the
+        # same element every time, its lexbor node address stays the same
+        return self.element.mem_id
+
+    @property
+    def name(self):
+        return self.element.tag
+
+    @cached_property
+    def attrs(self):
+        return _bs4_attrs(self.element.tag, self.element.attributes)
+
+    def select(self, css):
+        return [SelectolaxNode(node) for node in self.element.css(css)]
+
+    def select_one(self, css):
+        node = self.element.css_first(css)
+        return SelectolaxNode(node) if node is not None else None
+
+    def _events(self):
+        root = self.element
+        container = root.tag if root.tag in STRING_CONTAINERS else None
+        stack = [(root.iter(include_text=True), container)]
+        while stack:
+            children, container = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                if stack:
+                    yield ("end",)
+                continue
+            tag = child.tag
+            if tag == "-text":
+                yield ("text", child.text_content or "", container)
+            elif tag[0] != "-":  # skip -comment, -doctype ...
+                yield ("start", SelectolaxNode(child))
+                inner = tag if tag in STRING_CONTAINERS else container
+                stack.append((child.iter(include_text=True), inner))
+
+
+# "tag", "tag.class", ".class.other", "tag#id" and nothing fancier
+SIMPLE_SELECTOR = re.compile(r"([a-zA-Z][\w-]*|\*)?((?:[.#][\w-]+)*)$")
+
+
+@lru_cache(maxsize=256)
+def simple_selector(css):
+    """(tag or None, classes, id or None) of a simple selector, None if the
+    selector needs more than a tag name, classes and an id"""
+    match = SIMPLE_SELECTOR.match(css.strip())
+    if match is None or not css.strip():
+        return None
+    tag, rest = match.groups()
+    parts = re.findall(r"([.#])([\w-]+)", rest)
+    ids = [name for kind, name in parts if kind == "#"]
+    if len(ids) > 1:
+        return None
+    return (None if tag in (None, "*") else tag.lower(),
+            frozenset(name for kind, name in parts if kind == "."), ids[0] if ids else None)
+
+
+class _Targets(ElementFilter or object):
+    # Lets BeautifulSoup create a top-level tag only when it matches one of
+    # the selectors; everything inside a kept tag is kept
+    def __init__(self, selectors):
+        self.selectors = []
+        for css in selectors:
+            compound = simple_selector(css)
+            if compound is None:
+                raise ValueError(f"Partial parsing needs simple selectors like 'li.next', got {css!r}")
+            self.selectors.append(compound)
+
+    def allow_tag_creation(self, nsprefix, name, attrs):
+        attrs = attrs or {}
+        classes = attrs.get("class") or ()
+        if isinstance(classes, str):
+            classes = classes.split()
+        for tag, wanted, id in self.selectors:
+            if (tag is None or tag == name) and wanted.issubset(classes) and (id is None or attrs.get("id") == id):
+                return True
+        return False
+
+    def allow_string_creation(self, string):
+        return False  # text between the kept tags
+
+
+@lru_cache(maxsize=256)
+def _lxml_selector(css):
+    # Compiling a CSS selector to XPath is slow, do it once per selector
+    return CSSSelector(css, translator="html")
+
+
+def _parse_soup(html, only=None):
+    if only and ElementFilter is not None:
+        return SoupNode(BeautifulSoup(html, "html.parser", parse_only=_Targets(only)))
+    return SoupNode(BeautifulSoup(html, "html.parser"))
+
+
+def _parse_lxml(html):
+    if isinstance(html, str):
+        # lxml refuses str input that carries an XML encoding declaration
+        html = html.encode("utf-8")
+    parser = lxml.html.HTMLParser(encoding="utf-8")
+    if not html.strip():
+        html = b"<html></html>"
+    return LxmlNode(lxml.html.document_fromstring(html, parser=parser))
+
+
+def _parse_selectolax(html):
+    return SelectolaxNode(LexborHTMLParser(html).root)
+
+
+# engine name -> function turning html into a Node, None if not installed
+ENGINES = {
+    "html.parser": _parse_soup,
+    "lxml": _parse_lxml if CSSSelector else None,
+    "selectolax": _parse_selectolax if LexborHTMLParser else None,
+}
+
+DEFAULT_ENGINE = "lxml" if ENGINES["lxml"] else "html.parser"
+
+
+def available_engines():
+    return [name for name, parse_function in ENGINES.items() if parse_function]
+
+
+def parse(html, engine=None, only=None):
+    """Parse html (str or bytes) with the named engine, returning its root Node.
+    `only` lists simple selectors of the elements the caller will read, the
+    html.parser engine then builds just those subtrees (the others ignore it)"""
+    engine = engine or DEFAULT_ENGINE
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown parser engine {engine!r}, choose from {', '.join(ENGINES)}")
+    if ENGINES[engine] is None:
+        raise ImportError(f"Parser engine {engine!r} is not installed (pip install {engine} cssselect)")
+    with METRICS.time("stage_seconds", stage="parse", engine=engine):
+        if only and engine == "html.parser":
+            return _parse_soup(html, only)
+        return ENGINES[engine](html)
+
+
+def compile_selector(css, engine=None, first=False):
+    """Parse a CSS selector once for an engine, returning a function that
+    behaves like node.select(css), or node.select_one(css) with first=True"""
+    engine = engine or DEFAULT_ENGINE
+    if engine == "lxml":
+        selector = CSSSelector(css, translator="html")
+        if first:
+            return lambda node: next(
+                (LxmlNode(el) for el in selector(node.element) if el is not node.element), None)
+        return lambda node: [LxmlNode(el) for el in selector(node.element) if el is not node.element]
+    if engine == "html.parser":
+        selector = soupsieve.compile(css)
+        if first:
+            def select_one(node):
+                tag = selector.select_one(node.element)
+                return SoupNode(tag) if tag is not None else None
+            return select_one
+        return lambda node: [SoupNode(tag) for tag in selector.select(node.element)]
+    # lexbor parses the query on every call, there is nothing to keep
+    if first:
+        return lambda node: node.select_one(css)
+    return lambda node: node.select(css)
+
+
+# Fields each scraper-style query pulls out of the pages saved in this repo.
+# Every engine has to give exactly the same values.
+def _demo_fields(doc):
+    return {
+        "title": doc.select_one("title").text(),
+        "links": [(a.get("href"), a.text()) for a in doc.find_all("a")],
+        "sisters": [a["id"] for a in doc.select("p.story a.sister")],
+        "italic": [div.text() for div in doc.find_all("div", class_="italic")],
+        "classes": doc.select_one("span.first")["class"],
+        "books": [[cell.text() for cell in row.select("td")] for row in doc.select("#books-table tr")],
+        "blogs": [blog.select_one("h3.blog-title").text() for blog in doc.select("div.blog")],
+    }
+
+
+def _times_fields(doc):
+    return {
+        "title": doc.select_one("title").text(),
+        "description": [meta.get("content") for meta in doc.select('meta[name="description"]')],
+        "headings": [heading.text() for heading in doc.find_all(["h1", "h2", "h3"])],
+        "images": [img.get("src") for img in doc.select("div.medium-insert-images img")],
+        "links": len(doc.find_all("a")),
+    }
+
+
+def _walmart_fields(doc):
+    # The saved page is the bare __NEXT_DATA__ JSON, so all of it is text
+    text = doc.text()
+    return {"length": len(text), "start": text[:100], "end": text[-100:]}
+
+
+def _sapphire_fields(doc):
+    products = []
+    for tile in doc.select("div.product-tile"):
+        link = tile.select_one(".pdp-link a")
+        price = tile.select_one(".price .value")
+        products.append({
+            "title": link.text(),
+            "url": link.get("href"),
+            "price": price.text() if price else None,
+            "amount": price.get("content") if price else None,
+        })
+    return {"title": doc.select_one("title").text(), "products": products}
+
+
+def _books_fields(doc):
+    books = []
+    for book in doc.find_all("article", class_="product_pod"):
+        books.append([
+            book.select_one("h3 a")["title"],
+            book.find("p", class_="price_color").text(),
+            book.find("p", class_="star-rating")["class"][1],
+        ])
+    next_page = doc.find("li", class_="next")
+    return {"books": books, "next": next_page.select_one("a")["href"] if next_page else None}
+
+
+def _fixture_pages():
+    # (name, html, field extractor) for every page we check engines on
+    from fixture_server import books_catalogue_pages
+
+    pages = []
+    for file_path, fields in [("demo.html", _demo_fields), ("times.html", _times_fields),
+                              ("walmart_data.html", _walmart_fields), ("sap.txt", _sapphire_fields)]:
+        # times.html was saved in the Windows code page, don't choke on it
+        with open(file_path, encoding="utf-8", errors="replace") as f:
+            pages.append((file_path, f.read(), fields))
+    pages.append(("books page-1", books_catalogue_pages()["/catalogue/page-1.html"], _books_fields))
+    return pages
+
+
+def check_conformance(engines=None):
+    """Check every engine extracts the same fields as html.parser, returns
+    a list of (page, engine, field) that differ"""
+    engines = engines or available_engines()
+    mismatches = []
+    for name, html, fields in _fixture_pages():
+        expected = fields(parse(html, "html.parser"))
+        for engine in engines:
+            got = fields(parse(html, engine))
+            for field in expected:
+                if got[field] != expected[field]:
+                    mismatches.append((name, engine, field))
+    return mismatches
+
+
+def benchmark_engines(engines=None, repeat=5):
+    engines = engines or available_engines()
+    for name, html, fields in _fixture_pages():
+        print(f"\n{name} ({len(html) / 1024:.0f} KB)")
+        for engine in engines:
+            parse_times, query_times = [], []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                doc = parse(html, engine)
+                parse_times.append(time.perf_counter() - start)
+
+                start = time.perf_counter()
+                fields(doc)
+                query_times.append(time.perf_counter() - start)
+            print(f"  {engine:<12} parse {min(parse_times) * 1000:>7.1f} ms   "
+                  f"query {min(query_times) * 1000:>7.1f} ms")
+
+
+def _partial_cases():
+    # (page, scraper, run(partial) -> rows) for the scrapers that read a
+    # few known parts of their pages, run the way they parse them
+    from bookscrapingproject import PAGE_TARGETS, parse_books_page
+    from fixture_server import books_catalogue_pages
+    from site_spec import ExtractionPlan, _spec_fixtures, load_spec
+
+    books = books_catalogue_pages()["/catalogue/page-1.html"]
+    url = "http://localhost/catalogue/page-1.html"
+    cases = [("books page-1", "bookscrapingproject",
+              lambda partial: parse_books_page(books, url, "html.parser", PAGE_TARGETS if partial else None))]
+    for name, pages, _ in _spec_fixtures():
+        plan = ExtractionPlan(load_spec(name), "html.parser")
+        targets = plan.parse_only
+        path, html = pages[0]
+
+        def run(partial, plan=plan, targets=targets, html=html, path=path):
+            plan.parse_only = targets if partial else None
+            return plan.extract(html, "http://localhost" + path)
+        cases.append((path.rsplit("/", 1)[-1] or path, f"specs/{name}.yaml", run))
+    return cases
+
+
+def benchmark_partial(repeat=15):
+    """Time and peak traced memory of parse + extract per scraper page, full
+    tree against only the targeted subtrees (html.parser); False if any
+    scraper's output changed"""
+    import tracemalloc
+
+    ok = True
+    for page, scraper, run in _partial_cases():
+        measured = {}
+        for partial in (False, True):
+            result = run(partial)
+            best = float("inf")
+            for _ in range(repeat):
+                start = time.perf_counter()
+                run(partial)
+                best = min(best, time.perf_counter() - start)
+            tracemalloc.start()
+            run(partial)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            measured[partial] = (best, peak, result)
+        (full_time, full_peak, expected), (time_, peak, got) = measured[False], measured[True]
+        same = got == expected
+        ok = ok and same
+        print(f"{page:<22} {scraper:<20} full {full_time * 1000:7.1f} ms {full_peak / 1e6:6.2f} MB   "
+              f"partial {time_ * 1000:7.1f} ms {peak / 1e6:6.2f} MB   "
+              f"{time_ / full_time - 1:+4.0%} time {peak / full_peak - 1:+4.0%} memory  "
+              f"{'same output' if same else 'OUTPUT DIFFERS'}")
+    return ok
+
+
+if __name__ == "__main__":
+    if "--partial" in sys.argv:
+        sys.exit(0 if benchmark_partial() else 1)
+    mismatches = check_conformance()
+    for page, engine, field in mismatches:
+        print(f"MISMATCH {page}: {engine} gives a different {field!r}")
+    print(f"Conformance: {len(mismatches)} mismatches across {', '.join(available_engines())}")
+
+    if "--bench" in sys.argv:
+        benchmark_engines()
+    sys.exit(1 if mismatches else 0)
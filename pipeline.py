@@ -0,0 +1,238 @@
+"""
+Fetch and parse in separate stages.
+
+The scrapers fetch a page and parse it in the same thread, so while
+BeautifulSoup works through sap.txt (720 KB) no request is in flight,
+and with threads every parse still shares one GIL. Pipeline splits the
+two stages:
+
+    fetch stage   `fetch_workers` coroutines, each fetching through the
+                  pooled session in a thread and putting the raw bytes on
+                  a queue holding at most `queue_size` pages
+    parse stage   `parse_workers` processes running extract(body, url)
+
+When the queue is full the fetchers wait (backpressure), so a parse stage
+that falls behind never piles pages up in memory. Parsed results wait in
+a queue of the same size for the consumer, so a slow consumer holds the
+whole pipeline back too. Results come out in input order (ordered=True)
+or as each page is done; in order, no page more than `window` pages
+after the oldest one not yet handed out is fetched, so one slow page
+can't make the others pile up behind it.
+
+extract is sent to the worker processes, so it has to be picklable: a
+module-level function or a functools.partial of one.
+"""
+
+import asyncio
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+from fetcher import fetch
+
+
+class Pipeline:
+    def __init__(self, extract, fetch_workers=16, parse_workers=None, queue_size=32, ordered=True, window=None):
+        self.extract = extract
+        self.fetch_workers = fetch_workers
+        self.parse_workers = parse_workers or os.cpu_count()
+        self.queue_size = queue_size
+        self.ordered = ordered
+        # Enough pages ahead to keep every fetcher, the queue and every
+        # parse worker busy while the oldest page is still on its way
+        self.window = window or fetch_workers + queue_size + self.parse_workers
+        self.errors = {}  # url -> exception, for pages that gave no result
+        self.max_queued = 0
+        self.max_reordered = 0
+
+    async def stream(self, urls):
+        """Yield (url, result) per url. A page that failed to fetch or
+        parse yields (url, None) and its exception goes in self.errors"""
+        loop = asyncio.get_running_loop()
+        pages = asyncio.Queue(self.queue_size)
+        results = asyncio.Queue(self.queue_size)
+        jobs = iter(enumerate(urls))  # shared by the fetchers
+        next_index = 0  # the oldest page not handed out yet
+        window_moved = asyncio.Condition()
+
+        async def fetch_worker():
+            for index, url in jobs:
+                if self.ordered:
+                    async with window_moved:
+                        await window_moved.wait_for(lambda: index < next_index + self.window)
+                try:
+                    response = await asyncio.to_thread(fetch, url)
+                    response.raise_for_status()
+                except Exception as e:
+                    self.errors[url] = e
+                    await results.put((index, url, None))
+                    continue
+                await pages.put((index, url, response.content))  # waits while parsing is behind
+                self.max_queued = max(self.max_queued, pages.qsize())
+
+        async def parse_worker(pool):
+            while (page := await pages.get()) is not None:
+                index, url, body = page
+                try:
+                    result = await loop.run_in_executor(pool, self.extract, body, url)
+                except Exception as e:
+                    self.errors[url] = e
+                    result = None
+                await results.put((index, url, result))
+
+        pool = ProcessPoolExecutor(self.parse_workers)
+        fetchers = [asyncio.create_task(fetch_worker()) for _ in range(self.fetch_workers)]
+        parsers = [asyncio.create_task(parse_worker(pool)) for _ in range(self.parse_workers)]
+
+        async def drain():
+            await asyncio.gather(*fetchers)
+            for _ in parsers:
+                await pages.put(None)
+            await asyncio.gather(*parsers)
+            await results.put(None)
+
+        finisher = asyncio.create_task(drain())
+        finished = False
+        try:
+            early = {}  # index -> (url, result) that finished before earlier pages
+            while (item := await results.get()) is not None:
+                index, url, result = item
+                if not self.ordered:
+                    yield url, result
+                    continue
+                early[index] = (url, result)
+                self.max_reordered = max(self.max_reordered, len(early))
+                if next_index in early:
+                    while next_index in early:
+                        yield early.pop(next_index)
+                        next_index += 1
+                    async with window_moved:
+                        window_moved.notify_all()
+            await finisher
+            finished = True
+        finally:
+            # The caller stopped early (or something failed), stop the
+            # stages and drop the parses not started instead of waiting
+            for task in fetchers + parsers + [finisher]:
+                task.cancel()
+            pool.shutdown(wait=finished, cancel_futures=not finished)
+
+    def run(self, urls):
+        """Every (url, result) as a list"""
+        async def collect():
+            return [item async for item in self.stream(urls)]
+        return asyncio.run(collect())
+
+
+BUNDLED_PAGES = ["demo.html", "times.html", "walmart_data.html", "sap.txt", "books-page-1.html"]
+
+
+def extract_bundled(body, url, engine="html.parser"):
+    # The scraper-style fields of one bundled page, picked by file name.
+    # html.parser (BeautifulSoup) is what the scripts themselves parse with
+    from parsers import (_books_fields, _demo_fields, _sapphire_fields, _times_fields,
+                         _walmart_fields, parse)
+
+    fields = {
+        "demo.html": _demo_fields, "times.html": _times_fields, "walmart_data.html": _walmart_fields,
+        "sap.txt": _sapphire_fields, "books-page-1.html": _books_fields,
+    }[url.split("?")[0].rsplit("/", 1)[-1]]
+    return fields(parse(body.decode("utf-8", errors="replace"), engine))
+
+
+def _bundled_server(delay):
+    from fixture_server import FixtureServer, books_catalogue_pages
+
+    pages = {}
+    for name in BUNDLED_PAGES[:-1]:
+        with open(name, "rb") as f:
+            pages["/" + name] = f.read()
+    pages["/books-page-1.html"] = books_catalogue_pages()["/catalogue/page-1.html"]
+    return FixtureServer(pages, delay=delay)
+
+
+def benchmark_pipeline(copies=8, delay=0.05, engine="html.parser"):
+    # Every bundled page `copies` times, each served after `delay` seconds.
+    # inline is what the scripts do, threads fetch+parse in a thread pool
+    # (parsing shares the GIL), the pipeline parses in worker processes
+    extract = partial(extract_bundled, engine=engine)
+    with _bundled_server(delay) as server:
+        urls = [server.url(f"/{name}?copy={n}") for n in range(copies) for name in BUNDLED_PAGES]
+        megabytes = sum(len(server.pages["/" + name]) for name in BUNDLED_PAGES) * copies / 1024 / 1024
+        print(f"{len(urls)} pages, {megabytes:.1f} MB, {delay * 1000:.0f} ms latency, "
+              f"{os.cpu_count()} CPU(s), {engine}")
+
+        def report(label, seconds, results, note=""):
+            same = "" if results == expected else "  RESULTS DIFFER"
+            print(f"  {label:<26} {len(urls) / seconds:6.1f} pages/s  {seconds:6.2f}s{note}{same}")
+
+        start = time.perf_counter()
+        expected = [(url, extract(fetch(url).content, url)) for url in urls]
+        report("inline", time.perf_counter() - start, expected)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(16) as threads:
+            results = list(zip(urls, threads.map(lambda url: extract(fetch(url).content, url), urls)))
+        report("threads (16)", time.perf_counter() - start, results)
+
+        for workers in sorted({1, 2, 4, os.cpu_count()}):
+            for ordered in (True, False):
+                pipeline = Pipeline(extract, parse_workers=workers, queue_size=8, ordered=ordered)
+                start = time.perf_counter()
+                results = pipeline.run(urls)
+                elapsed = time.perf_counter() - start
+                if not ordered:
+                    results.sort(key=lambda item: urls.index(item[0]))
+                report(f"pipeline {workers} proc {'ordered' if ordered else 'unordered'}", elapsed, results,
+                       f"  max queued {pipeline.max_queued}")
+
+
+def _stalling_extract(body, url):
+    # The first page takes a second to parse, the others none
+    if url.endswith("copy=0"):
+        time.sleep(1)
+    return len(body)
+
+
+async def _consume(pipeline, urls, server, count, pause):
+    # Take `count` results `pause` seconds apart, then stop; how many
+    # pages did the fetchers get in the meantime
+    taken = 0
+    async for _ in pipeline.stream(urls):
+        taken += 1
+        if taken == count:
+            break
+        await asyncio.sleep(pause)
+    return server.requests_served
+
+
+def check_backpressure(pages=500):
+    """A slow consumer and a stalled first page must hold the fetchers back
+    instead of letting them fetch the whole list ahead"""
+    from fixture_server import FixtureServer
+
+    ok = True
+    with FixtureServer({"/page": "<html><body>" + "x" * 1000 + "</body></html>"}) as server:
+        urls = [server.url(f"/page?copy={n}") for n in range(pages)]
+        for label, pipeline, count, pause in (
+            ("slow consumer, unordered", Pipeline(_stalling_extract, 4, 1, queue_size=8, ordered=False), 10, 0.1),
+            ("stalled first page, ordered", Pipeline(_stalling_extract, 4, 2, queue_size=8), 1, 0),
+        ):
+            server.requests_served = 0
+            start = time.perf_counter()
+            fetched = asyncio.run(_consume(pipeline, urls, server, count, pause))
+            # fetchers + both queues + the parse workers, or the window
+            bound = max(4 + 8 + 8 + pipeline.parse_workers, pipeline.window) + count
+            good = fetched <= bound
+            ok = ok and good
+            print(f"{'ok ' if good else 'BAD'} {label}: {fetched}/{pages} pages fetched for {count} taken "
+                  f"(bound {bound}), stopped in {time.perf_counter() - start:.2f}s")
+    return ok
+
+
+if __name__ == "__main__":
+    if "--check" in sys.argv:
+        sys.exit(0 if check_backpressure() else 1)
+    benchmark_pipeline(engine=sys.argv[1] if len(sys.argv) > 1 else "html.parser")
@@ -0,0 +1,246 @@
+"""
+Price history storage for the product trackers (Sapphire notebook etc).
+
+Two tables instead of one row of text per scrape:
+
+    product      one row per product URL, with its latest price kept
+                 alongside so "latest price per product" is one scan
+    observation  numeric price per product over time, clustered on
+                 (product_id, observed_at) so one product's history is a
+                 single index range
+
+A run is written in one transaction with executemany, and a price is
+only stored when it differs from the product's latest one, so daily runs
+of an unchanged catalogue add no rows.
+"""
+
+import math
+import os
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+from normalize import parse_amount, parse_currency
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS product (
+    id INTEGER PRIMARY KEY,
+    url TEXT NOT NULL UNIQUE,
+    title TEXT,
+    currency TEXT,
+    last_price REAL,
+    last_observed_at TEXT
+);
+CREATE TABLE IF NOT EXISTS observation (
+    product_id INTEGER NOT NULL REFERENCES product(id),
+    observed_at TEXT NOT NULL,
+    price REAL NOT NULL,
+    PRIMARY KEY (product_id, observed_at)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS observation_date ON observation(observed_at);
+"""
+
+def _now():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+
+
+class PriceHistory:
+    def __init__(self, path="sapphire_products.db"):
+        self.conn = sqlite3.connect(path)
+        # WAL lets readers (plots, reports) run while a scrape is writing,
+        # and NORMAL sync is safe with WAL and much cheaper per commit
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def record(self, products, observed_at=None):
+        """Save a run of {"url", "title", "price"} dicts, price as scraped
+        text or a number. Returns how many new price rows were written."""
+        observed_at = observed_at or _now()
+        rows = {}
+        for product in products:
+            price = product.get("price")
+            if isinstance(price, (int, float)):
+                amount, currency = float(price), None
+            else:
+                # Locale aware: "€1.234,56" is 1234.56 and "EUR 12,50" 12.5
+                amount, currency = parse_amount(price), parse_currency(price)
+            if not math.isnan(amount):
+                rows[product["url"]] = (product.get("title"), currency, amount)
+        if not rows:
+            return 0
+
+        with self.conn:  # one transaction for the whole run
+            self.conn.executemany(
+                "INSERT INTO product (url, title, currency) VALUES (?, ?, ?) "
+                "ON CONFLICT(url) DO UPDATE SET title = excluded.title, "
+                "currency = COALESCE(excluded.currency, product.currency)",
+                [(url, title, currency) for url, (title, currency, _) in rows.items()],
+            )
+
+            # Look up every product's latest price in one pass
+            latest = {}
+            urls = list(rows)
+            for start in range(0, len(urls), 500):  # stay under SQLite's variable limit
+                chunk = urls[start:start + 500]
+                latest.update(
+                    (url, (product_id, last_price))
+                    for product_id, url, last_price in self.conn.execute(
+                        f"SELECT id, url, last_price FROM product WHERE url IN ({','.join('?' * len(chunk))})",
+                        chunk,
+                    )
+                )
+
+            changed = [
+                (latest[url][0], amount)
+                for url, (_, _, amount) in rows.items()
+                if latest[url][1] != amount
+            ]
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO observation (product_id, observed_at, price) VALUES (?, ?, ?)",
+                [(product_id, observed_at, amount) for product_id, amount in changed],
+            )
+            # An older run (an import, a late batch) adds to the history but
+            # doesn't replace a newer latest price
+            self.conn.executemany(
+                "UPDATE product SET last_price = ?, last_observed_at = ? "
+                "WHERE id = ? AND (last_observed_at IS NULL OR last_observed_at <= ?)",
+                [(amount, observed_at, product_id, observed_at) for product_id, amount in changed],
+            )
+        return len(changed)
+
+    def latest_prices(self):
+        """[(url, title, price, observed_at)] for every product"""
+        return self.conn.execute(
+            "SELECT url, title, last_price, last_observed_at FROM product ORDER BY title"
+        ).fetchall()
+
+    def history(self, url):
+        """[(observed_at, price)] for one product, oldest first"""
+        return self.conn.execute(
+            "SELECT o.observed_at, o.price FROM observation o "
+            "JOIN product p ON p.id = o.product_id WHERE p.url = ? ORDER BY o.observed_at",
+            (url,),
+        ).fetchall()
+
+    def import_legacy(self):
+        """Move rows from the notebook's old products(title, price TEXT, url,
+        date) table into the new tables, oldest first. Imported rows go to
+        products_imported, so running it every session imports them once"""
+        exists = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'products'"
+        ).fetchone()
+        if not exists:
+            return 0
+        written = 0
+        runs = self.conn.execute("SELECT title, price, url, date FROM products ORDER BY date").fetchall()
+        for title, price, url, date in runs:
+            written += self.record([{"url": url, "title": title, "price": price}], observed_at=date)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS products_imported AS SELECT * FROM products WHERE 0")
+            self.conn.execute("INSERT INTO products_imported SELECT * FROM products")
+            self.conn.execute("DROP TABLE products")
+        return written
+
+
+def benchmark_store(path="price_history_bench.db", products=5000, days=200, change_rate=0.1):
+    # Build products * days worth of history, then time the daily write and
+    # the two read queries the notebook needs
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    rng = random.Random(0)
+    urls = [f"https://pk.sapphireonline.pk/products/{n}.html" for n in range(products)]
+    prices = [rng.randrange(1000, 20000, 10) for _ in urls]
+    start_day = datetime(2024, 1, 1)
+
+    with PriceHistory(path) as store:
+        start = time.perf_counter()
+        store.record([{"url": url, "title": f"Product {n}", "price": price}
+                      for n, (url, price) in enumerate(zip(urls, prices))],
+                     observed_at=start_day.strftime("%Y-%m-%d %H:%M:%S"))
+        # Bulk-load the synthetic history with every price changing daily,
+        # in primary key order so the clustered index is appended to
+        dates = [(start_day + timedelta(days=day)).strftime("%Y-%m-%d %H:%M:%S") for day in range(days)]
+        rows = [(n + 1, dates[day], float(price + day))
+                for n, price in enumerate(prices) for day in range(1, days)]
+        with store.conn:
+            store.conn.executemany("INSERT INTO observation VALUES (?, ?, ?)", rows)
+            store.conn.executemany(
+                "UPDATE product SET last_price = ?, last_observed_at = ? WHERE id = ?",
+                [(float(price + days - 1), dates[-1], n + 1) for n, price in enumerate(prices)],
+            )
+        total = store.conn.execute("SELECT COUNT(*) FROM observation").fetchone()[0]
+        print(f"loaded {total:,} observations in {time.perf_counter() - start:.1f}s")
+
+        # A daily run where `change_rate` of the prices moved
+        today = [{"url": url, "title": f"Product {n}",
+                  "price": f"PKR {price + days - 1 + (5 if rng.random() < change_rate else 0):,}"}
+                 for n, (url, price) in enumerate(zip(urls, prices))]
+        day = (start_day + timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+        start = time.perf_counter()
+        written = store.record(today, observed_at=day)
+        print(f"daily run of {products:,} products: {written:,} changed rows in "
+              f"{(time.perf_counter() - start) * 1000:.0f} ms")
+
+        start = time.perf_counter()
+        store.record(today, observed_at=day.replace("00:00:00", "12:00:00"))
+        print(f"same run again: 0 new rows expected, took {(time.perf_counter() - start) * 1000:.0f} ms")
+
+        start = time.perf_counter()
+        latest = store.latest_prices()
+        print(f"latest price per product ({len(latest):,}): {(time.perf_counter() - start) * 1000:.1f} ms")
+
+        start = time.perf_counter()
+        for url in rng.sample(urls, 100):
+            store.history(url)
+        print(f"history for one product: {(time.perf_counter() - start) * 10:.2f} ms")
+
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def check_import():
+    # The notebook imports its old table every session: importing twice
+    # around a newer run mustn't bring the old price back
+    import tempfile
+
+    directory = tempfile.mkdtemp(prefix="price_history_")
+    url = "https://pk.sapphireonline.pk/products/kurta.html"
+    with PriceHistory(os.path.join(directory, "prices.db")) as store:
+        store.conn.execute("CREATE TABLE products (title TEXT, price TEXT, url TEXT, date TEXT)")
+        store.conn.execute("INSERT INTO products VALUES ('Kurta', 'PKR 5,990', ?, '2024-01-01 00:00:00')", (url,))
+        store.conn.commit()
+        first = store.import_legacy()
+        store.record([{"url": url, "title": "Kurta", "price": "PKR 4,990"}], observed_at="2024-06-01 00:00:00")
+        second = store.import_legacy()
+        store.record([{"url": url, "title": "Kurta", "price": "PKR 6,990"}], observed_at="2024-03-01 00:00:00")
+        latest = store.latest_prices()
+        history = store.history(url)
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+    ok = (first == 1 and second == 0 and latest == [(url, "Kurta", 4990.0, "2024-06-01 00:00:00")]
+          and [price for _, price in history] == [5990.0, 6990.0, 4990.0])
+    print(f"{'ok ' if ok else 'BAD'} import: {first} then {second} rows imported, latest {latest[0][2:]}, "
+          f"history {history}")
+    return ok
+
+
+if __name__ == "__main__":
+    if "--check" in sys.argv:
+        sys.exit(0 if check_import() else 1)
+    benchmark_store(*(int(arg) for arg in sys.argv[1:3]))
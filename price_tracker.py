@@ -0,0 +1,233 @@
+"""
+Batch price tracker for a list of product URLs (products.csv).
+
+The notebook's process_products fetched and parsed every URL in turn and
+only printed the prices. track() takes thousands of URLs and:
+
+    groups     the URLs by host, crawling up to `max_hosts` hosts at
+               once with `per_host` threads each, every host under its
+               own AdaptiveLimiter window (rate_limit.py)
+    extracts   the price with that domain's selectors (PRICE_SELECTORS,
+               tried in order), Walmart from __NEXT_DATA__
+    writes     results to PriceHistory in batches of `batch_size`, one
+               transaction each, so only prices that changed since the
+               last run add a row
+
+    python price_tracker.py [products.csv] [--db prices.db] [--out prices.csv]
+    python price_tracker.py --bench
+"""
+
+import csv
+import math
+import queue
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from next_data import extract_product
+from normalize import parse_amount
+from parsers import parse
+from price_history import PriceHistory
+from rate_limit import AdaptiveLimiter
+from sinks import CsvSink
+
+# domain -> (title selectors, price selectors), the first match wins
+PRICE_SELECTORS = {
+    "amazon.com": (["#productTitle"],
+                   ["#corePrice_feature_div .a-offscreen", "#corePriceDisplay_desktop_feature_div .a-offscreen",
+                    "span.a-price .a-offscreen", "#priceblock_ourprice"]),
+    "ebay.com": (["h1.x-item-title__mainTitle .ux-textspans", "#itemTitle"],
+                 [".x-price-primary .ux-textspans", "#prcIsum"]),
+    "bestbuy.com": ([".sku-title h1"], [".priceView-customer-price span"]),
+    "books.toscrape.com": ([".product_main h1"], [".product_main .price_color", ".price_color"]),
+    "sapphireonline.pk": (["h1.product__title", "a.full-unstyled-link"],
+                          ["span.price-item--regular", ".price .value"]),
+}
+
+# Any other site: schema.org / Open Graph price, then the notebook's selector
+GENERIC_SELECTORS = (["h1", "title"],
+                     ['[itemprop="price"]', 'meta[property="product:price:amount"]', ".price_color"])
+
+
+def selectors_for(host, overrides=None):
+    """(title selectors, price selectors) for a host or any parent domain"""
+    table = {**PRICE_SELECTORS, **(overrides or {})}
+    parts = host.split(":")[0].split(".")
+    for start in range(len(parts)):
+        domain = ".".join(parts[start:])
+        if domain in table:
+            return table[domain]
+    return table.get(host, GENERIC_SELECTORS)
+
+
+def _first_text(doc, selectors):
+    for css in selectors:
+        node = doc.select_one(css)
+        if node is not None:
+            text = node.get("content") or node.text()
+            if text:
+                return text
+    return None
+
+
+def extract_price(html, url, overrides=None):
+    """{"url", "title", "price"} with the price as the page shows it, None if not found"""
+    host = urlsplit(url).netloc
+    if host.endswith("walmart.com"):
+        product = extract_product(html) or {}
+        return {"url": url, "title": product.get("name"), "price": product.get("price")}
+    title_selectors, price_selectors = selectors_for(host, overrides)
+    doc = parse(html)
+    return {"url": url, "title": _first_text(doc, title_selectors), "price": _first_text(doc, price_selectors)}
+
+
+class PriceTracker:
+    def __init__(self, store, limiter=None, per_host=8, max_hosts=16, batch_size=500, selectors=None):
+        self.store = store
+        self.limiter = limiter or AdaptiveLimiter(maximum=per_host)
+        self.per_host = per_host
+        self.max_hosts = max_hosts
+        self.batch_size = batch_size
+        self.selectors = selectors  # {host: (title selectors, price selectors)} overrides
+        self.errors = {}  # url -> exception
+        self._errors_lock = threading.Lock()
+
+    def _product(self, url):
+        try:
+            response = self.limiter.get(url)
+            response.raise_for_status()
+            # Fixture and real pages alike are UTF-8, whatever the headers say
+            return extract_price(response.content.decode("utf-8", errors="replace"), url, self.selectors)
+        except Exception as e:
+            with self._errors_lock:
+                self.errors[url] = e
+            return {"url": url, "title": None, "price": None}
+
+    def _crawl_host(self, urls, results):
+        with ThreadPoolExecutor(min(self.per_host, len(urls))) as pool:
+            for product in pool.map(self._product, urls):
+                results.put(product)
+
+    def track(self, urls, observed_at=None):
+        """Fetch every URL and record its price. Returns {url: product} and
+        how many price rows were written"""
+        by_host = defaultdict(list)
+        for url in dict.fromkeys(urls):
+            by_host[urlsplit(url).netloc].append(url)
+
+        results = queue.Queue()
+        products = {}
+        written = 0
+        batch = []
+        # One timestamp for the whole run, whichever batch a price lands in
+        observed_at = observed_at or time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+        with ThreadPoolExecutor(self.max_hosts) as hosts:
+            crawls = [hosts.submit(self._crawl_host, host_urls, results) for host_urls in by_host.values()]
+            remaining = sum(len(host_urls) for host_urls in by_host.values())
+            while remaining:
+                try:
+                    product = results.get(timeout=1)
+                except queue.Empty:
+                    for crawl in crawls:
+                        if crawl.done() and crawl.exception():
+                            raise crawl.exception()
+                    continue
+                remaining -= 1
+                products[product["url"]] = product
+                batch.append(product)
+                if len(batch) >= self.batch_size:
+                    # The sqlite connection belongs to this thread, writes stay here
+                    written += self.store.record(batch, observed_at)
+                    batch = []
+        if batch:
+            written += self.store.record(batch, observed_at)
+        return products, written
+
+
+def read_products(csv_file):
+    """[(url, alert_price or None)] from a products.csv"""
+    with open(csv_file, newline="", encoding="utf-8") as f:
+        return [(row["url"], float(row["alert_price"]) if row.get("alert_price") else None)
+                for row in csv.DictReader(f)]
+
+
+def write_prices(path, products, found):
+    # The url,alert_price,price,alert snapshot prices.csv holds
+    with CsvSink(path, ["url", "alert_price", "price", "alert"], lineterminator="\n") as sink:
+        for url, alert_price in products:
+            price = found.get(url, {}).get("price")
+            amount = float(price) if isinstance(price, (int, float)) else parse_amount(price)
+            amount = None if math.isnan(amount) else amount
+            alert = amount is not None and alert_price is not None and amount <= alert_price
+            sink.write([url, alert_price, amount, alert])
+
+
+def benchmark_tracker(products=1000, stores=("amazon", "ebay", "bestbuy", "books"), delay=0.05,
+                      max_qps=60, changed=0.1):
+    # `products` URLs per store, one local server per store answering after
+    # `delay` and throttling above `max_qps`. The second run has `changed`
+    # of the prices moved and should write only those
+    import os
+    import tempfile
+    from contextlib import ExitStack
+    from fixture_server import ThrottlingServer, product_pages
+
+    with ExitStack() as stack:
+        directory = stack.enter_context(tempfile.TemporaryDirectory())
+        store = stack.enter_context(PriceHistory(os.path.join(directory, "prices.db")))
+        servers, selectors = {}, {}
+        for seed, markup in enumerate(stores):
+            server = stack.enter_context(ThrottlingServer(
+                product_pages(markup, products, seed=seed), max_qps=max_qps, delay=delay, retry_after=1))
+            servers[markup] = server
+            domain = "books.toscrape.com" if markup == "books" else f"{markup}.com"
+            selectors[server.base_url.split("//")[1]] = PRICE_SELECTORS[domain]
+        urls = [server.url(f"/p/{n}") for n in range(products) for server in servers.values()]
+        print(f"{len(urls):,} product URLs on {len(servers)} hosts, {delay * 1000:.0f} ms latency, "
+              f"{max_qps} requests/s per host before 429")
+
+        for run in (0, 1):
+            if run:
+                for seed, (markup, server) in enumerate(servers.items()):
+                    server.pages.update(product_pages(markup, products, seed=seed, changed=changed, run=1))
+            tracker = PriceTracker(store, selectors=selectors)
+            start = time.perf_counter()
+            found, written = tracker.track(urls, observed_at=f"run {run}")
+            elapsed = time.perf_counter() - start
+            priced = sum(product["price"] is not None for product in found.values())
+            throttled = sum(server.throttled for server in servers.values())
+            print(f"  run {run}: {len(urls) / elapsed * 60:7,.0f} URLs/min  {elapsed:5.1f}s  {priced:,} priced  "
+                  f"{len(tracker.errors)} errors  {throttled} throttled  {written:,} price rows written")
+            for server in servers.values():
+                server.throttled = 0
+
+
+def main(arguments):
+    options = {"--db": "prices.db", "--out": "prices.csv"}
+    files = []
+    while arguments:
+        argument = arguments.pop(0)
+        if argument in options:
+            options[argument] = arguments.pop(0)
+        elif argument == "--bench":
+            benchmark_tracker()
+            return 0
+        else:
+            files.append(argument)
+    products = read_products(files[0] if files else "products.csv")
+    with PriceHistory(options["--db"]) as store:
+        tracker = PriceTracker(store)
+        found, written = tracker.track([url for url, _ in products])
+    write_prices(options["--out"], products, found)
+    priced = sum(product["price"] is not None for product in found.values())
+    print(f"{priced}/{len(products)} prices found, {written} changed, {len(tracker.errors)} failed")
+    for url, error in tracker.errors.items():
+        print(f"  {url}: {error}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,260 @@
+"""
+Pool of proxies picked by health instead of at random.
+
+Free proxy lists are mostly dead or slow, and a dead proxy costs a full
+timeout per request. The pool keeps per-proxy numbers:
+
+    latency              moving average of recent request times
+    success rate         smoothed successes / attempts
+    consecutive failures reset by any success
+
+Requests go to a proxy chosen at random weighted by success rate over
+latency. A proxy that fails `max_failures` times in a row is quarantined
+for `cooldown` seconds, doubling on every further failure up to
+`max_cooldown`. A background thread probes every proxy concurrently, so
+quarantined proxies that come back are noticed without spending real
+requests on them.
+"""
+
+import random
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from fetcher import Fetcher
+
+PROBE_URL = "https://quotes.toscrape.com/"
+PROXY_TIMEOUT = 5  # seconds, free proxies that take longer are as good as dead
+
+
+class NoProxiesAvailable(LookupError):
+    """The pool has no proxies to choose from"""
+
+
+class ProxyState:
+    def __init__(self, url, latency):
+        self.url = url
+        self.latency = latency  # seconds, exponentially weighted
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.quarantined_until = 0.0
+
+    @property
+    def success_rate(self):
+        # Smoothed so a new proxy starts at 0.5 rather than 0 or 1
+        return (self.successes + 1) / (self.successes + self.failures + 2)
+
+    @property
+    def score(self):
+        return self.success_rate ** 2 / max(self.latency, 0.001)
+
+    def __repr__(self):
+        return (f"ProxyState({self.url}, latency={self.latency * 1000:.0f}ms, "
+                f"success={self.success_rate:.2f}, failures_in_row={self.consecutive_failures})")
+
+
+class ProxyPool:
+    def __init__(self, proxies, probe_url=PROBE_URL, timeout=PROXY_TIMEOUT, probe_interval=30,
+                 max_failures=2, cooldown=5, max_cooldown=300, fetcher=None):
+        self.probe_url = probe_url
+        self.timeout = timeout
+        self.probe_interval = probe_interval
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        # No urllib3 retries: retrying is done here, on a different proxy
+        self.fetcher = fetcher or Fetcher(retry=0)
+        # Unknown proxies start out looking like half a timeout
+        self.states = {url: ProxyState(url, timeout / 2) for url in proxies}
+        self._lock = threading.Lock()
+        self._random = random.Random()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def choose(self):
+        """Pick a proxy url, weighted by health, skipping quarantined ones"""
+        with self._lock:
+            if not self.states:
+                raise NoProxiesAvailable("no proxies available: the pool is empty")
+            now = time.monotonic()
+            available = [state for state in self.states.values() if state.quarantined_until <= now]
+            if not available:
+                # Everything is cooling down, use whichever is released first
+                return min(self.states.values(), key=lambda state: state.quarantined_until).url
+            return self._random.choices(available, weights=[state.score for state in available])[0].url
+
+    def report(self, proxy, ok, seconds):
+        """Record how a request through `proxy` went"""
+        with self._lock:
+            state = self.states[proxy]
+            state.latency = 0.7 * state.latency + 0.3 * seconds
+            if ok:
+                state.successes += 1
+                state.consecutive_failures = 0
+                state.quarantined_until = 0.0
+                return
+            state.failures += 1
+            state.consecutive_failures += 1
+            extra = state.consecutive_failures - self.max_failures
+            if extra >= 0:
+                cooldown = min(self.cooldown * 2 ** extra, self.max_cooldown)
+                state.quarantined_until = time.monotonic() + cooldown
+
+    def _request(self, proxy, url, **kwargs):
+        # One request through one proxy; proxy errors and 5xx count as
+        # failures, anything else the proxy did its job
+        kwargs.setdefault("timeout", self.timeout)
+        start = time.perf_counter()
+        try:
+            response = self.fetcher.get(url, proxies={"http": proxy, "https": proxy}, **kwargs)
+        except requests.RequestException:
+            self.report(proxy, False, time.perf_counter() - start)
+            raise
+        ok = response.status_code < 500 and response.status_code != 407
+        self.report(proxy, ok, time.perf_counter() - start)
+        return response, ok
+
+    def get(self, url, attempts=3, **kwargs):
+        """GET url through the healthiest proxies, trying up to `attempts`
+        of them. Returns the last response, or raises the last error
+        (NoProxiesAvailable if the pool is empty)."""
+        error = None
+        response = None
+        for _ in range(attempts):
+            proxy = self.choose()
+            try:
+                response, ok = self._request(proxy, url, **kwargs)
+            except requests.RequestException as exc:
+                error = exc
+                continue
+            if ok:
+                return response
+        if response is not None:
+            return response
+        raise error
+
+    def probe(self, proxy):
+        try:
+            return self._request(proxy, self.probe_url)[1]
+        except requests.RequestException:
+            return False
+
+    def probe_all(self):
+        """Probe every proxy at once, returns {proxy: ok}"""
+        if not self.states:
+            return {}
+        with ThreadPoolExecutor(max_workers=min(32, len(self.states))) as pool:
+            return dict(zip(self.states, pool.map(self.probe, list(self.states))))
+
+    def _probe_loop(self):
+        while not self._stop.is_set():
+            self.probe_all()
+            self._stop.wait(self.probe_interval)
+
+    def start(self):
+        """Probe all proxies now and then every probe_interval seconds"""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._probe_loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def healthy(self):
+        """States of proxies not in quarantine, best first"""
+        now = time.monotonic()
+        with self._lock:
+            states = [state for state in self.states.values() if state.quarantined_until <= now]
+        return sorted(states, key=lambda state: state.score, reverse=True)
+
+
+def _random_choice_get(proxies, url, fetcher, timeout, attempts=3):
+    # The old behaviour: a random proxy per try, no memory of what failed
+    for _ in range(attempts):
+        proxy = random.choice(proxies)
+        try:
+            response = fetcher.get(url, proxies={"http": proxy, "https": proxy}, timeout=timeout)
+        except requests.RequestException:
+            continue
+        if response.status_code < 500:
+            return True
+    return False
+
+
+def benchmark_pool(requests_count=300, workers=8, timeout=1.0):
+    # Ten local proxies: three fast, three slow, two flaky and two that
+    # hang. Compare per-request latency (retries included) of random
+    # choice against the health-weighted pool. A request that raised
+    # counts as failed. Returns whether the pool did better on both
+    # latency and successes, and an empty pool raised NoProxiesAvailable
+    from fixture_server import FakeProxy, FixtureServer
+
+    proxies = ([FakeProxy(delay=0.02, jitter=0.03, seed=n) for n in range(3)]
+               + [FakeProxy(delay=0.3, jitter=0.1, seed=n) for n in range(3)]
+               + [FakeProxy(delay=0.05, failure_rate=0.5, seed=n) for n in range(2)]
+               + [FakeProxy(dead=True) for _ in range(2)])
+    for proxy in proxies:
+        proxy.start()
+    try:
+        with FixtureServer({"/": "<html><body>ok</body></html>"}) as server, Fetcher(retry=0) as fetcher:
+            url = server.url("/")
+            urls = [proxy.base_url for proxy in proxies]
+
+            def timed(call):
+                start = time.perf_counter()
+                try:
+                    ok = call()
+                except requests.RequestException:
+                    ok = False
+                return time.perf_counter() - start, ok
+
+            pool = ProxyPool(urls, probe_url=url, timeout=timeout, probe_interval=2, fetcher=fetcher)
+            runs = {
+                "random choice": lambda: _random_choice_get(urls, url, fetcher, timeout),
+                "health-weighted pool": lambda: pool.get(url).status_code == 200,
+            }
+            medians, successes = {}, {}
+            with pool:
+                time.sleep(timeout * 1.5)  # let the first probe round finish
+                for label, call in runs.items():
+                    with ThreadPoolExecutor(max_workers=workers) as executor:
+                        results = list(executor.map(lambda _: timed(call), range(requests_count)))
+                    latencies = sorted(seconds for seconds, _ in results)
+                    medians[label] = statistics.median(latencies)
+                    successes[label] = sum(ok for _, ok in results)
+                    print(f"{label:<22} p50 {medians[label] * 1000:6.0f} ms   "
+                          f"p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:6.0f} ms   "
+                          f"ok {successes[label]}/{requests_count}")
+            for state in pool.healthy()[:3]:
+                print(f"  {state}")
+    finally:
+        for proxy in proxies:
+            proxy.stop()
+
+    try:
+        ProxyPool([], fetcher=fetcher).choose()
+        empty = "returned a proxy"
+    except NoProxiesAvailable as e:
+        empty = None if "no proxies available" in str(e) else str(e)
+    faster = medians["health-weighted pool"] < medians["random choice"]
+    more = successes["health-weighted pool"] >= successes["random choice"]
+    print(f"{'ok ' if faster and more else 'BAD'} pool vs random choice: "
+          f"p50 {'lower' if faster else 'NOT LOWER'}, successes {'as many or more' if more else 'FEWER'}")
+    print(f"{'ok ' if empty is None else 'BAD'} empty pool: {empty or 'NoProxiesAvailable'}")
+    return faster and more and empty is None
+
+
+if __name__ == "__main__":
+    sys.exit(0 if benchmark_pool(*(int(arg) for arg in sys.argv[1:2])) else 1)
@@ -0,0 +1,401 @@
+"""
+Per-host politeness: a fixed token bucket, or a concurrency window that
+finds the sustainable rate by itself.
+
+A bucket refills at `rate` tokens per second up to `burst` tokens and
+every request takes one token. Workers that find the bucket empty wait
+exactly until their token is due, so a pool of threads runs at the
+allowed rate instead of sleeping a fixed amount after every request.
+
+AdaptiveLimiter needs no rate up front. Each host gets a window of
+requests allowed in flight, adjusted like TCP congestion control (AIMD):
+
+    healthy response   the window grows by 1/window, about +1 per round
+    throttled          the window halves, once per round: a 429 or 503,
+                       a block page's <title> on a 200, a timeout or a
+                       reset connection, or a latency over `spike` times
+                       the fastest seen for that host
+    Retry-After        nobody starts a request to the host until it passes
+    robots.txt         a Crawl-delay becomes a token bucket of 1/delay per
+                       second under the window
+
+so it settles just under what the site tolerates and backs off as soon
+as the site says otherwise.
+"""
+
+import email.utils
+import re
+import threading
+import time
+import urllib.robotparser
+from urllib.parse import urlsplit
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=1):
+        self.rate = rate  # tokens added per second
+        self.burst = burst  # most tokens the bucket can hold
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        # Take a token now, going negative if the bucket is empty. A
+        # negative balance is a queue of waiters, each one sleeps until
+        # the refill reaches its place in that queue.
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class HostRateLimiter:
+    def __init__(self, rate, burst=1, per_host=None):
+        self.rate = rate
+        self.burst = burst
+        self.per_host = per_host or {}  # {"wttr.in": (rate, burst)} overrides
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, host):
+        with self._lock:
+            if host not in self._buckets:
+                rate, burst = self.per_host.get(host, (self.rate, self.burst))
+                self._buckets[host] = TokenBucket(rate, burst)
+            return self._buckets[host]
+
+    def acquire(self, url):
+        return self.bucket(urlsplit(url).netloc).acquire()
+
+
+# Titles of block pages served with a 200. Only the <title> is looked
+# at: a real page can load a reCAPTCHA script or say "access denied" in
+# its head or body. per_host markers replace these for one site
+BLOCK_TITLES = ("captcha", "robot check", "are you a robot", "unusual traffic", "access denied",
+                "attention required", "just a moment")
+# Fetch errors that mean the host is overloaded. Others (a bad URL, DNS,
+# TLS, a refused connection) say nothing about its load and aren't retried
+CONGESTION_ERRORS = (TimeoutError, ConnectionResetError)
+THROTTLE_STATUSES = {429, 503}
+MAX_BACKOFF = 30  # seconds
+
+_title = re.compile(r"<title[^>]*>(.*?)</title", re.IGNORECASE | re.DOTALL)
+
+
+def is_congestion(error):
+    """Whether a fetch error is a timeout or a reset connection. requests
+    and urllib3 wrap the socket's error, so look through what each error
+    was raised from and carries in its args"""
+    errors, seen = [error], set()
+    while errors:
+        error = errors.pop()
+        if error is None or id(error) in seen:
+            continue
+        seen.add(id(error))
+        if isinstance(error, CONGESTION_ERRORS):
+            return True
+        errors.extend((error.__cause__, error.__context__))
+        errors.extend(argument for argument in error.args if isinstance(argument, BaseException))
+    return False
+
+
+def retry_after_seconds(value):
+    """Seconds to wait from a Retry-After header (delta or HTTP date)"""
+    if not value:
+        return 0.0
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return 0.0
+    return max(0.0, when.timestamp() - time.time())
+
+
+class HostWindow:
+    def __init__(self, initial=1, minimum=1, maximum=64, spike=4.0, crawl_delay=None):
+        self.window = float(initial)  # requests allowed in flight
+        self.minimum = minimum
+        self.maximum = maximum
+        self.spike = spike
+        self.in_flight = 0
+        self.fastest = None  # lowest healthy latency seen, seconds
+        self.resume_at = 0.0  # monotonic time set by Retry-After or backoff
+        self.backoff = 0.0  # pause after a throttle without Retry-After, seconds
+        self.round = 0  # bumped by every decrease
+        self.increases = 0
+        self.decreases = 0
+        self.spacing = TokenBucket(1 / crawl_delay) if crawl_delay else None
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Wait for a free slot, return the round the request starts in"""
+        with self._condition:
+            while True:
+                wait = self.resume_at - time.monotonic()
+                if wait <= 0 and self.in_flight < int(self.window):
+                    break
+                self._condition.wait(wait if wait > 0 else None)
+            self.in_flight += 1
+            started_in = self.round
+        if self.spacing is not None:
+            self.spacing.acquire()
+        return started_in
+
+    def release(self, started_in, latency, throttled=False, retry_after=0.0):
+        with self._condition:
+            self.in_flight -= 1
+            slow = self.fastest is not None and latency > self.spike * self.fastest  # server queueing us
+            if throttled:
+                # Without a Retry-After, pause the host 0.1s, 0.2s, 0.4s ...
+                # for as long as it keeps throttling
+                if not retry_after:
+                    self.backoff = min(MAX_BACKOFF, self.backoff * 2 or 0.1)
+                self.resume_at = max(self.resume_at, time.monotonic() + (retry_after or self.backoff))
+            if throttled or slow:
+                # Requests already in flight when the window was cut report
+                # the same congestion, only the first of them halves it
+                if started_in == self.round:
+                    self.window = max(self.minimum, self.window / 2)
+                    self.round += 1
+                    self.decreases += 1
+            else:
+                self.backoff = 0.0
+                self.fastest = latency if self.fastest is None else min(self.fastest, latency)
+                if self.window < self.maximum:
+                    self.window = min(self.maximum, self.window + 1 / self.window)
+                    self.increases += 1
+            self._condition.notify_all()
+
+    def cancel(self):
+        """Give the slot back without a verdict on the host's load"""
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def __repr__(self):
+        fastest = f"{self.fastest * 1000:.0f}ms" if self.fastest is not None else "-"
+        return (f"HostWindow(window={self.window:.1f}, in_flight={self.in_flight}, fastest={fastest}, "
+                f"+{self.increases}/-{self.decreases})")
+
+
+class AdaptiveLimiter:
+    def __init__(self, fetcher=None, initial=1, maximum=64, spike=4.0, markers=BLOCK_TITLES, per_host=None,
+                 robots=True, max_attempts=4):
+        self.fetcher = fetcher
+        self.initial = initial
+        self.maximum = maximum
+        self.spike = spike
+        self.markers = tuple(marker.lower() for marker in markers)
+        # {"www.example.com": ("verify you are human",)} overrides
+        self.per_host = {host: tuple(marker.lower() for marker in host_markers)
+                         for host, host_markers in (per_host or {}).items()}
+        self.robots = robots
+        self.max_attempts = max_attempts
+        self.throttled = 0
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def _get(self, url, **kwargs):
+        if self.fetcher is None:
+            from fetcher import DEFAULT_RETRY, Fetcher
+            # The default retries would sleep through the 429s and 503s
+            # the window has to see, keep retrying only the other failures
+            self.fetcher = Fetcher(retry=DEFAULT_RETRY.new(status_forcelist=(500, 502, 504)))
+        return self.fetcher.get(url, **kwargs)
+
+    def _crawl_delay(self, url):
+        parts = urlsplit(url)
+        try:
+            response = self._get(f"{parts.scheme}://{parts.netloc}/robots.txt")
+        except Exception:
+            return None
+        if response.status_code != 200:
+            return None
+        robots = urllib.robotparser.RobotFileParser()
+        robots.parse(response.text.splitlines())
+        agent = self.fetcher.session.headers.get("User-Agent", "*")
+        rate = robots.request_rate(agent)
+        if rate is not None:
+            return rate.seconds / rate.requests
+        delay = robots.crawl_delay(agent)
+        return float(delay) if delay else None
+
+    def window(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            window = self._windows.get(host)
+        if window is None:
+            # robots.txt is read outside the lock, a slow host doesn't hold
+            # up the others; two threads racing here just read it twice
+            crawl_delay = self._crawl_delay(url) if self.robots else None
+            with self._lock:
+                window = self._windows.setdefault(host, HostWindow(
+                    self.initial, maximum=self.maximum, spike=self.spike, crawl_delay=crawl_delay))
+        return window
+
+    def is_throttled(self, response):
+        if response.status_code in THROTTLE_STATUSES:
+            return True
+        markers = self.per_host.get(urlsplit(response.url).netloc, self.markers)
+        if response.status_code != 200 or not markers:
+            return False
+        title = _title.search(response.text[:4096])
+        return bool(title) and any(marker in title.group(1).lower() for marker in markers)
+
+    def get(self, url, **kwargs):
+        """Fetch url within the host's window, retrying throttled responses
+        (after their Retry-After) up to max_attempts times"""
+        window = self.window(url)
+        for attempt in range(self.max_attempts):
+            started_in = window.acquire()
+            start = time.monotonic()
+            try:
+                response = self._get(url, **kwargs)
+            except Exception as e:
+                if not is_congestion(e):
+                    window.cancel()
+                    raise
+                window.release(started_in, time.monotonic() - start, throttled=True)
+                if attempt == self.max_attempts - 1:
+                    raise
+                continue
+            throttled = self.is_throttled(response)
+            window.release(started_in, time.monotonic() - start, throttled,
+                           retry_after_seconds(response.headers.get("Retry-After")))
+            if not throttled:
+                return response
+            with self._lock:
+                self.throttled += 1
+        return response
+
+    def report(self):
+        with self._lock:
+            windows = dict(self._windows)
+        return {host: repr(window) for host, window in windows.items()}
+
+
+def benchmark_rate(rate=20, burst=5, workers=8, requests_count=100, delay=0.2):
+    # Against a server with `delay` seconds of latency, a serial loop runs
+    # at 1/delay requests per second while the limited pool runs at `rate`
+    from concurrent.futures import ThreadPoolExecutor
+    from fetcher import Fetcher
+    from fixture_server import FixtureServer
+
+    with FixtureServer({"/": "ok"}, delay=delay) as server, Fetcher() as fetcher:
+        limiter = HostRateLimiter(rate, burst)
+
+        def limited_get(url):
+            limiter.acquire(url)
+            return fetcher.get(url)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(limited_get, [server.url("/")] * requests_count))
+        elapsed = time.perf_counter() - start
+        print(f"{requests_count} requests at {rate}/s (burst {burst}, {workers} workers): "
+              f"{elapsed:.2f}s, {requests_count / elapsed:.1f} req/s "
+              f"(serial would be {1 / delay:.1f} req/s)")
+
+
+def benchmark_adaptive(max_qps=30, delay=0.05, requests_count=200, workers=32):
+    # A server allowing max_qps requests a second (429 + Retry-After above
+    # it), then one that only slows down past 4 requests in flight, then
+    # one whose robots.txt asks for 10 requests a second. Each is crawled
+    # by `workers` threads with no limit and through AdaptiveLimiter
+    from concurrent.futures import ThreadPoolExecutor
+    from fetcher import Fetcher
+    from fixture_server import ThrottlingServer
+
+    cases = [
+        (f"{max_qps} qps, then 429", dict(max_qps=max_qps, retry_after=1)),
+        (f"{max_qps} qps, then captcha", dict(max_qps=max_qps, captcha=True)),
+        ("queues past 4 in flight", dict(max_qps=10 ** 6, capacity=4)),
+        ("robots Request-rate 10/1s", dict(max_qps=10 ** 6, robots="User-agent: *\nRequest-rate: 10/1\n")),
+    ]
+    for label, options in cases:
+        print(label)
+        for mode in ("unlimited", "adaptive"):
+            with ThrottlingServer({"/": "<html><body>ok</body></html>"}, delay=delay, **options) as server, \
+                    Fetcher(retry=0) as fetcher:
+                urls = [server.url(f"/?n={n}") for n in range(requests_count)]
+                if mode == "unlimited":
+                    get = fetcher.get
+                    limiter = None
+                else:
+                    limiter = AdaptiveLimiter(fetcher, maximum=workers)
+                    get = limiter.get
+                start = time.perf_counter()
+                with ThreadPoolExecutor(workers) as pool:
+                    responses = list(pool.map(get, urls))
+                elapsed = time.perf_counter() - start
+                ok = sum(r.status_code == 200 and b"captcha" not in r.content for r in responses)
+                window = next(iter(limiter._windows.values())) if limiter else None
+                print(f"  {mode:<10} {ok:4}/{requests_count} ok  {ok / elapsed:6.1f} ok/s  "
+                      f"{server.throttled:4} throttled  most in flight {server.most_in_flight:2}  "
+                      f"{elapsed:5.2f}s  {window or ''}")
+
+
+def check_throttling():
+    # Which 200s are block pages, and which fetch errors count as the host
+    # being overloaded: a real timeout does, a refused connection doesn't
+    from types import SimpleNamespace
+    import requests
+    from urllib3.exceptions import ProtocolError
+    from fetcher import Fetcher
+    from fixture_server import FixtureServer
+
+    login = ('<html><head><title>Sign in</title><script src="https://www.google.com/recaptcha/api.js">'
+             '</script></head><body>Access denied? Reset your password</body></html>')
+    pages = [
+        ("page with a reCAPTCHA script", "shop.example", login, False),
+        ("block page", "shop.example", "<html><title>Robot check</title><body>captcha</body></html>", True),
+        ("site's own block title", "strict.example", "<title>Verify you are human</title>", True),
+        ("default title on an overridden site", "strict.example", "<title>Just a moment...</title>", False),
+    ]
+    limiter = AdaptiveLimiter(per_host={"strict.example": ("verify you are human",)})
+    ok = True
+    for label, host, text, expected in pages:
+        response = SimpleNamespace(status_code=200, url=f"https://{host}/", text=text)
+        found = limiter.is_throttled(response)
+        ok = ok and found == expected
+        print(f"{'ok ' if found == expected else 'BAD'} {label}: {'throttled' if found else 'not throttled'}")
+
+    reset = requests.ConnectionError(ProtocolError("Connection aborted.", ConnectionResetError(104, "reset")))
+    errors = [("reset connection", reset, True)]
+    with FixtureServer({"/": "ok"}, delay=0.5) as server, Fetcher(retry=0) as fetcher:
+        for label, url, kwargs, expected in [("read timeout", server.url("/"), {"timeout": 0.1}, True),
+                                             ("refused connection", "http://127.0.0.1:9/", {}, False)]:
+            try:
+                fetcher.get(url, **kwargs)
+            except requests.RequestException as e:
+                errors.append((label, e, expected))
+    window = HostWindow(initial=4)
+    for label, error, expected in errors:
+        found = is_congestion(error)
+        ok = ok and found == expected
+        print(f"{'ok ' if found == expected else 'BAD'} {label} ({type(error).__name__}): "
+              f"{'congestion' if found else 'not congestion'}")
+    # A failure that isn't congestion leaves the window where it was
+    window.acquire()
+    window.cancel()
+    same = window.window == 4 and window.in_flight == 0 and window.decreases == 0
+    ok = ok and len(errors) == 3 and same
+    print(f"{'ok ' if same else 'BAD'} cancel: {window}")
+    return ok
+
+
+if __name__ == "__main__":
+    import sys
+    if "--check" in sys.argv:
+        sys.exit(0 if check_throttling() else 1)
+    if "--adaptive" in sys.argv:
+        benchmark_adaptive()
+    else:
+        benchmark_rate()
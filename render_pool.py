@@ -0,0 +1,305 @@
+"""
+Render JavaScript pages only when nothing cheaper gets the data.
+
+The notebook scraped the Sapphire collection with requests_html: a
+browser for every page and a fixed arender(sleep=3). RenderService
+fetches the page over plain HTTP once and then tries, cheapest first:
+
+    static    the HTML already holds the items (no JS needed)
+    sources   the data the page's JS would draw from: a JSON <script>
+              in the page (embedded_json) or the XHR endpoint it calls
+              (json_endpoint)
+    render    a warm browser page from RenderPool, once `ready` matches
+
+The first step that gives rows wins and is remembered per host, so the
+next page of that site tries it first. The browser is only started the
+first time a page actually needs it.
+
+RenderPool keeps `size` Chromium pages open (playwright), aborts
+requests for images, fonts, media and stylesheets, and waits for the
+ready selector instead of sleeping a fixed time.
+"""
+
+import asyncio
+import json
+import sys
+import time
+from collections import Counter
+from functools import lru_cache
+from urllib.parse import urljoin, urlsplit
+
+from fetcher import DEFAULT_HEADERS, fetch
+from lazy import lazy_module
+from normalize import parse_amount
+from parsers import parse
+from site_spec import compile_spec
+
+try:
+    # Loaded when a page first needs the browser, not by every scrape
+    playwright_api = lazy_module("playwright.async_api")
+except ImportError:
+    playwright_api = None
+
+# Playwright resource types a scraper never needs
+BLOCKED_RESOURCES = {"image", "font", "media", "stylesheet", "manifest", "texttrack"}
+
+
+class RenderPool:
+    def __init__(self, size=4, blocked=BLOCKED_RESOURCES, timeout=15):
+        self.size = size
+        self.blocked = set(blocked)
+        self.timeout = timeout
+        self.renders = 0
+        self.blocked_requests = 0
+        self._playwright = None
+        self._browser = None
+        self._context = None
+        self._pages = None
+
+    async def start(self):
+        if playwright_api is None:
+            raise ImportError("Rendering needs playwright (pip install playwright && playwright install chromium)")
+        self._playwright = await playwright_api.async_playwright().start()
+        try:
+            self._browser = await self._playwright.chromium.launch()
+        except Exception:
+            await self._playwright.stop()  # don't leave the driver running
+            raise
+        self._context = await self._browser.new_context(user_agent=DEFAULT_HEADERS["User-Agent"])
+        await self._context.route("**/*", self._route)
+        self._pages = asyncio.Queue()
+        for _ in range(self.size):
+            self._pages.put_nowait(await self._context.new_page())
+        return self
+
+    @property
+    def started(self):
+        return self._pages is not None
+
+    async def _route(self, route):
+        if route.request.resource_type in self.blocked:
+            self.blocked_requests += 1
+            await route.abort()
+        else:
+            await route.continue_()
+
+    async def render(self, url, ready):
+        """HTML of url once its scripts have put `ready` in the page"""
+        page = await self._pages.get()
+        if page is None:
+            # The slot of a page that couldn't be replaced last time
+            try:
+                page = await self._context.new_page()
+            except Exception:
+                self._pages.put_nowait(None)
+                raise
+        try:
+            await page.goto(url, wait_until="domcontentloaded", timeout=self.timeout * 1000)
+            await page.wait_for_selector(ready, state="attached", timeout=self.timeout * 1000)
+            html = await page.content()
+            self.renders += 1
+            return html
+        except Exception:
+            # A page stuck mid-navigation would hold up the next caller. If
+            # no new page opens, the slot stays empty until the next render
+            closed, page = page, None
+            await closed.close()
+            page = await self._context.new_page()
+            raise
+        finally:
+            self._pages.put_nowait(page)
+
+    async def close(self):
+        if self._browser is not None:
+            await self._browser.close()
+            await self._playwright.stop()
+            self._browser = self._pages = None
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+def embedded_json(css, to_rows):
+    """Source reading JSON from a <script> in the page (`css` selects it)"""
+    def embedded(html, url):
+        script = parse(html).select_one(css)
+        if script is None:
+            return None
+        return to_rows(json.loads(script.text(strip=False)), url)
+    return embedded
+
+
+def json_endpoint(endpoint, to_rows):
+    """Source calling the XHR endpoint the page's JS would, endpoint(url)
+    gives its URL"""
+    def xhr(html, url):
+        response = fetch(endpoint(url))
+        if response.status_code != 200:
+            return None
+        try:
+            data = response.json()
+        except ValueError:
+            return None
+        return to_rows(data, url)
+    return xhr
+
+
+class RenderService:
+    def __init__(self, ready, extract, sources=(), pool=None, log=print):
+        self.ready = ready
+        self.extract = extract  # function(html, url) -> rows
+        self.sources = list(sources)  # functions(html, url) -> rows or None
+        self.pool = pool or RenderPool()
+        self.preferred = {}  # host -> step that worked last
+        self.methods = Counter()
+        self.failures = Counter()  # step -> exceptions it raised
+        self.log = log
+        self._pool_lock = None
+
+    def _steps(self):
+        steps = [("static", self._static)]
+        steps += [(source.__name__, self._source(source)) for source in self.sources]
+        return steps + [("render", self._render)]
+
+    async def _static(self, html, url):
+        return await asyncio.to_thread(self.extract, html, url)
+
+    def _source(self, source):
+        async def step(html, url):
+            return await asyncio.to_thread(source, html, url)
+        return step
+
+    async def _render(self, html, url):
+        if self._pool_lock is None:
+            self._pool_lock = asyncio.Lock()
+        async with self._pool_lock:
+            if not self.pool.started:
+                await self.pool.start()
+        rendered = await self.pool.render(url, self.ready)
+        return await asyncio.to_thread(self.extract, rendered, url)
+
+    async def scrape(self, url):
+        """Return (rows, step that found them) for one page"""
+        response = await asyncio.to_thread(fetch, url)
+        response.raise_for_status()
+        html = response.text
+
+        host = urlsplit(url).netloc
+        steps = self._steps()
+        steps.sort(key=lambda step: step[0] != self.preferred.get(host))
+        error = None
+        for name, step in steps:
+            # A broken cheap step (bad JSON, a changed shape, a failed XHR)
+            # falls through to the next one instead of losing the page
+            try:
+                rows = await step(html, url)
+            except Exception as e:
+                self.failures[name] += 1
+                self.log(f"{url}: {name} failed: {type(e).__name__}: {e}")
+                error = e
+                continue
+            if rows:
+                self.preferred[host] = name
+                self.methods[name] += 1
+                return rows, name
+        raise ValueError(f"{url}: no rows from {', '.join(name for name, _ in steps)}") from error
+
+    async def scrape_many(self, urls, concurrency=8):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(url):
+            async with semaphore:
+                return await self.scrape(url)
+
+        return await asyncio.gather(*(one(url) for url in urls))
+
+    async def close(self):
+        await self.pool.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+# The Sapphire collection, the tiles specs/sapphire.yaml reads
+SAPPHIRE_READY = "div.product-tile"
+
+
+@lru_cache(maxsize=None)
+def _sapphire_plan():
+    return compile_spec("sapphire")
+
+
+def sapphire_rows(html, url):
+    # Prices stay as the page shows them, like `scrape.py sapphire` saves them
+    rows, _ = _sapphire_plan().extract(html, url)
+    return rows
+
+
+def shopify_rows(data, url):
+    # products.json and the theme's embedded JSON have the same shape
+    return [
+        [product["title"], product["variants"][0]["price"], urljoin(url, "/products/" + product["handle"])]
+        for product in data.get("products", ())
+    ]
+
+
+def sapphire_service(pool=None, log=print):
+    return RenderService(
+        SAPPHIRE_READY, sapphire_rows,
+        sources=[
+            embedded_json("script#collection-products", shopify_rows),
+            json_endpoint(lambda url: url.split("?")[0].rstrip("/") + "/products.json", shopify_rows),
+        ],
+        pool=pool,
+        log=log,
+    )
+
+
+async def _check_fallbacks(server):
+    expected = sapphire_rows(server.pages["/static/collections/man"], server.url("/static/collections/man"))
+    ok = True
+    for variant in ("static", "embedded", "broken", "xhr", "js"):
+        path = f"/{variant}/collections/man"
+        async with sapphire_service(log=lambda message: None) as service:
+            served = server.requests_served
+            start = time.perf_counter()
+            try:
+                rows, method = await service.scrape(server.url(path))
+            except Exception as e:
+                if variant != "js":
+                    raise
+                # No playwright, or no browser it can launch
+                print(f"{variant:<9} needs a browser, not run here ({str(e.__cause__ or e).splitlines()[0]})")
+                continue
+            elapsed = time.perf_counter() - start
+        # URLs differ only by the variant prefix, and the JSON has "4990.00"
+        # where the tile shows "Rs.4,990.00": compare titles and amounts
+        same = ([(title, parse_amount(price)) for title, price, _ in rows]
+                == [(title, parse_amount(price)) for title, price, _ in expected])
+        if variant == "broken":
+            # Its embedded JSON doesn't parse, the XHR step has to get the rows
+            same = same and method == "xhr" and service.failures["embedded"] == 1
+        ok = ok and same
+        print(f"{variant:<9} via {method:<9} {len(rows):3} rows  {elapsed * 1000:6.0f} ms  "
+              f"{server.requests_served - served} requests  {'same rows' if same else 'ROWS DIFFER'}")
+    return ok
+
+
+def check_fallbacks(delay=0.05):
+    """Scrape each fixture variant of the collection and report which step
+    got the rows; the old path slept 3 s per page on top of rendering"""
+    from fixture_server import FixtureServer, sapphire_collection_pages
+
+    with FixtureServer(sapphire_collection_pages(), delay=delay,
+                       content_type="text/html; charset=utf-8") as server:
+        return asyncio.run(_check_fallbacks(server))
+
+
+if __name__ == "__main__":
+    sys.exit(0 if check_fallbacks() else 1)
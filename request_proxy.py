@@ -1,5 +1,4 @@
-import random
-import requests
+from proxy_pool import ProxyPool
 
 """
 List of Free Proxies:
@@ -32,11 +31,11 @@ proxy_list = [
     "http://65.108.195.47:8080"   
 ]
 
-# Randomly select a proxy
-proxy = {"http": random.choice(proxy_list), "https": random.choice(proxy_list)}
-
-# Send request through the proxy
-response = requests.get("https://quotes.toscrape.com/", proxies=proxy)
+# Probe every proxy at once, then send the request through the healthiest
+# ones (dead proxies get skipped instead of hanging until the timeout)
+pool = ProxyPool(proxy_list, probe_url="https://quotes.toscrape.com/")
+pool.probe_all()
+response = pool.get("https://quotes.toscrape.com/")
 
 # Print the HTML content of the page
 print(response.text)
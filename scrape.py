@@ -0,0 +1,364 @@
+"""
+One entry point for all the scrapers.
+
+    python scrape.py books [--url URL] [--out books_data.csv] [--async | --resume | --workers N] [--incremental]
+    python scrape.py imdb [--out imdb_top_movies.csv]
+    python scrape.py walmart [URL]
+    python scrape.py weather [--out world_capitals_weather.csv]
+    python scrape.py sapphire [URL ...] [--out sapphire_men_collection.csv] [--pages N] [--render]
+    python scrape.py analyze FILE [--profiles]
+    python scrape.py daemon "COMMAND [OPTIONS]" INTERVAL ["COMMAND [OPTIONS]" INTERVAL ...]
+    python scrape.py --bench
+
+Each script used to import everything it might need before its first
+request. Here a command imports its scraper only when it runs, and the
+heavy modules behind it load on first use (lazy.py): pandas and numpy
+only when a column is normalized, pyarrow when a ParquetSink is opened,
+playwright when a page has to be rendered.
+
+daemon runs the given commands every INTERVAL ("90s", "30m", "6h",
+"1d") in one long-lived process. Imports happen once at start, and
+between jobs the shared fetcher keeps its pooled connections, site
+specs stay compiled and the weather limiter keeps its learned window.
+A job that fails is logged and runs again at its next turn; SIGTERM
+stops the daemon after the job in progress. books --resume can't be a
+daemon job (its frontier is done after the first run), and books
+--workers crawls through a new queue each run.
+"""
+
+import heapq
+import importlib
+import importlib.util
+import os
+import shlex
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# name -> (function(arguments), modules its scraper needs)
+COMMANDS = {}
+
+
+def command(name, modules=()):
+    def register(function):
+        COMMANDS[name] = (function, modules)
+        return function
+    return register
+
+
+def load_script(file_name):
+    """Import one of the scripts whose file name isn't a module name
+    ("weather-project.py"), once per process like any other module"""
+    name = os.path.splitext(file_name)[0].replace("-", "_")
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(name, os.path.join(HERE, file_name))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        try:
+            spec.loader.exec_module(module)
+        except BaseException:
+            del sys.modules[name]
+            raise
+    return sys.modules[name]
+
+
+def preload(name):
+    """Import what a command needs, without running it"""
+    for module in COMMANDS[name][1]:
+        if module.endswith(".py"):
+            load_script(module)
+        else:
+            importlib.import_module(module)
+
+
+def _options(arguments, defaults, flags=()):
+    # "--name value" options and bare --flags, anything else is positional
+    options = dict(defaults)
+    positional = []
+    arguments = list(arguments)
+    while arguments:
+        argument = arguments.pop(0)
+        if argument in flags:
+            options[argument] = True
+        elif argument in defaults:
+            options[argument] = arguments.pop(0)
+        elif argument.startswith("--"):
+            raise ValueError(f"unknown option {argument}")
+        else:
+            positional.append(argument)
+    return options, positional
+
+
+@command("books", modules=("bookscrapingproject",))
+def books(arguments):
+    import bookscrapingproject as books
+
+    options, _ = _options(arguments, {"--url": books.START_URL, "--out": "books_data.csv", "--workers": None},
+                          flags=("--async", "--resume", "--incremental"))
+    detector = None
+    if options.get("--incremental"):
+        from change_detection import ChangeDetector
+        detector = ChangeDetector()
+    try:
+        if options.get("--async"):
+            import asyncio
+            rows = asyncio.run(books.scrape_books_async(options["--url"], detector=detector))
+        elif options.get("--resume"):
+            rows = books.scrape_books_resumable(options["--url"])
+        elif options["--workers"]:
+            # A new queue every run: the last run's has all its pages done
+            # and would only give its rows back
+            with tempfile.TemporaryDirectory(prefix="books_queue_") as directory:
+                rows = books.scrape_books_distributed(options["--url"], int(options["--workers"]),
+                                                      os.path.join(directory, "queue.db"))
+        else:
+            rows = books.iter_books(options["--url"], detector)
+        books.save_to_csv(rows, options["--out"])
+        if detector:
+            print(detector.report())
+    finally:
+        if detector:
+            detector.close()
+
+
+@command("imdb", modules=("imdb-project.py",))
+def imdb(arguments):
+    options, _ = _options(arguments, {"--out": "imdb_top_movies.csv"})
+    project = load_script("imdb-project.py")
+    project.save_to_csv(project.scrape_imdb(), options["--out"])
+
+
+@command("walmart", modules=("walmart_scrape",))
+def walmart(arguments):
+    import walmart_scrape
+    from dedup import canonical_url
+
+    _, urls = _options(arguments, {})
+    walmart_scrape.main(canonical_url(urls[0]) if urls else walmart_scrape.url)
+
+
+@command("weather", modules=("weather-project.py",))
+def weather(arguments):
+    options, _ = _options(arguments, {"--out": "world_capitals_weather.csv"})
+    load_script("weather-project.py").main(options["--out"])
+
+
+@command("sapphire", modules=("site_spec",))
+def sapphire(arguments):
+    options, urls = _options(arguments, {"--out": None, "--pages": None}, flags=("--render",))
+    max_pages = int(options["--pages"]) if options["--pages"] else None
+    if not options.get("--render"):
+        from site_spec import compile_spec
+        plan = compile_spec("sapphire")
+        plan.save(plan.iter_rows(urls or None, max_pages), options["--out"])
+        return
+
+    # JS-only pages: static HTML first, then the page's JSON, and the
+    # browser (and playwright) only for what neither gives
+    import asyncio
+    from render_pool import sapphire_service
+    from sinks import open_sink
+
+    async def scrape():
+        async with sapphire_service() as service:
+            return await service.scrape_many(urls or ["https://pk.sapphireonline.pk/collections/man"])
+
+    out = options["--out"] or "sapphire_men_collection.csv"
+    with open_sink(out, ["Title", "Price", "URL"]) as sink:
+        count = sum(sink.write_all(rows) for rows, _ in asyncio.run(scrape()))
+    print(f"Saved {count} rows to {out}")
+
+
+@command("analyze", modules=("websrcInspect",))
+def analyze(arguments):
+    from websrcInspect import SiteProfiles, analyze_website, print_recommendations
+
+    options, files = _options(arguments, {}, flags=("--profiles",))
+    if not files:
+        raise ValueError("analyze needs the HTML file to look at")
+    profiles = SiteProfiles() if options.get("--profiles") else None
+    try:
+        for file_path in files:
+            analysis = analyze_website(file_path, profiles)
+            if analysis:
+                print_recommendations(analysis)
+            else:
+                print(f"Failed to analyze the website structure of {file_path}")
+    finally:
+        if profiles:
+            profiles.close()
+
+
+def run(arguments):
+    """Run one command line (["books", "--incremental"]), returns the
+    exit status"""
+    if not arguments or arguments[0] not in COMMANDS:
+        print(__doc__.strip().split("\n\n")[1], file=sys.stderr)
+        return 2
+    function, _ = COMMANDS[arguments[0]]
+    try:
+        function(arguments[1:])
+    except ValueError as e:
+        print(f"{arguments[0]}: {e}", file=sys.stderr)
+        return 2
+    return 0
+
+
+# Options that pick up state a previous run left on disk: --resume
+# continues the last crawl's frontier, so every run after the first
+# would return its rows without fetching anything
+NOT_IN_DAEMON = {"books": ("--resume",)}
+
+UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_interval(text):
+    """Seconds in "90s", "30m", "6h", "1d" (plain numbers are seconds)"""
+    if text[-1:] in UNITS:
+        return float(text[:-1]) * UNITS[text[-1]]
+    return float(text)
+
+
+class Daemon:
+    def __init__(self, jobs, log=print):
+        self.jobs = jobs  # [(command line as a list, interval in seconds)]
+        self.log = log
+        self.runs = []  # (command line, seconds, ok) of every job run
+        self._stop = threading.Event()
+
+    def stop(self, *_):
+        self._stop.set()
+
+    def warm_up(self):
+        start = time.perf_counter()
+        for name in dict.fromkeys(arguments[0] for arguments, _ in self.jobs):
+            preload(name)
+        self.log(f"loaded {len(self.jobs)} jobs' modules in {time.perf_counter() - start:.2f}s")
+
+    def run_job(self, arguments):
+        line = shlex.join(arguments)
+        start = time.perf_counter()
+        try:
+            ok = run(arguments) == 0
+        except (Exception, SystemExit) as e:
+            # A broken site shouldn't take the other jobs down with it
+            self.log(f"{line} failed: {type(e).__name__}: {e}")
+            ok = False
+        seconds = time.perf_counter() - start
+        self.runs.append((line, seconds, ok))
+        self.log(f"{line} {'finished' if ok else 'failed'} in {seconds:.2f}s")
+        return ok
+
+    def serve(self, max_runs=None):
+        """Run every job now and then every `interval` seconds, until
+        stop() or `max_runs` job runs"""
+        self.warm_up()
+        now = time.monotonic()
+        schedule = [(now, index) for index in range(len(self.jobs))]
+        heapq.heapify(schedule)
+        while not self._stop.is_set() and (max_runs is None or len(self.runs) < max_runs):
+            due, index = heapq.heappop(schedule)
+            if self._stop.wait(max(0.0, due - time.monotonic())):
+                break
+            arguments, interval = self.jobs[index]
+            self.run_job(arguments)
+            # A job that ran long doesn't make up its missed turns
+            heapq.heappush(schedule, (max(due + interval, time.monotonic()), index))
+
+
+def daemon(arguments):
+    if not arguments or len(arguments) % 2:
+        raise ValueError('daemon takes "COMMAND [OPTIONS]" INTERVAL pairs')
+    jobs = []
+    for line, interval in zip(arguments[::2], arguments[1::2]):
+        job = shlex.split(line)
+        if not job or job[0] not in COMMANDS:
+            raise ValueError(f"unknown command in {line!r}")
+        for option in NOT_IN_DAEMON.get(job[0], ()):
+            if option in job:
+                raise ValueError(f"{option} can't run as a daemon job: {line!r}")
+        jobs.append((job, parse_interval(interval)))
+    service = Daemon(jobs, log=lambda message: print(time.strftime("%Y-%m-%d %H:%M:%S"), message, flush=True))
+    signal.signal(signal.SIGTERM, service.stop)
+    try:
+        service.serve()
+    except KeyboardInterrupt:
+        pass
+
+
+COMMANDS["daemon"] = (daemon, ())
+
+# Loaded only by a run that needs them, whatever the command
+HEAVY_MODULES = ("pandas", "numpy", "pyarrow", "playwright.async_api", "lxml.html", "bs4", "requests")
+
+
+def import_times(code):
+    """{module: cumulative ms} for what `python -X importtime -c code`
+    imports, top-level imports with no leading spaces"""
+    import subprocess
+
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=HERE,
+                            capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and line.count("|") == 2:
+            _, cumulative, name = line.split("|")
+            if cumulative.strip().isdigit():
+                times[name[1:].rstrip()] = int(cumulative) / 1000
+    return times
+
+
+def _total(times):
+    return sum(ms for module, ms in times.items() if not module.startswith(" "))
+
+
+def benchmark_startup():
+    # Import time of each command before its first request (over a bare
+    # interpreter's), and which of the heavy modules it pulls in
+    bare = _total(import_times("pass"))
+    print(f"  {'--help':<9} {_total(import_times('import scrape')) - bare:6.0f} ms of imports")
+    for name in [name for name in COMMANDS if name != "daemon"]:
+        times = import_times(f"import scrape; scrape.preload({name!r})")
+        loaded = {module.strip() for module in times}
+        heavy = [module for module in HEAVY_MODULES if module in loaded]
+        print(f"  {name:<9} {_total(times) - bare:6.0f} ms of imports  loads {', '.join(heavy) or 'none of them'}")
+
+
+def benchmark_daemon(jobs=3):
+    # The books job against the local catalogue: a fresh process per run,
+    # as cron would start it, against runs inside one warm daemon
+    import subprocess
+    from fixture_server import FixtureServer, books_catalogue_pages
+
+    directory = tempfile.mkdtemp(prefix="scrape_")
+    with FixtureServer(books_catalogue_pages()) as server:
+        line = ["books", "--url", server.url("/catalogue/page-1.html"), "--out", os.path.join(directory, "b.csv")]
+        start = time.perf_counter()
+        for _ in range(jobs):
+            subprocess.run([sys.executable, os.path.join(HERE, "scrape.py"), *line], check=True,
+                           stdout=subprocess.DEVNULL)
+        cold = (time.perf_counter() - start) / jobs
+        server.connections_opened = 0
+
+        service = Daemon([(line, 0)], log=lambda message: None)
+        sys.stdout = open(os.devnull, "w")
+        try:
+            service.serve(max_runs=jobs + 1)
+        finally:
+            sys.stdout.close()
+            sys.stdout = sys.__stdout__
+        warm = sum(seconds for _, seconds, _ in service.runs[1:]) / jobs
+    print(f"books job, {len(books_catalogue_pages())} pages from a local server: new process {cold:.2f}s per run, "
+          f"warm daemon {warm:.2f}s per run ({server.connections_opened} connections for {jobs + 1} runs)")
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--bench"]:
+        benchmark_startup()
+        benchmark_daemon()
+        sys.exit(0)
+    sys.exit(run(sys.argv[1:]))
@@ -0,0 +1,286 @@
+"""
+Streaming output writers for scraped rows.
+
+The scrapers used to collect every row in a list (or a DataFrame) and
+write the file at the end, so memory grew with the crawl and a crash on
+the last page lost everything. A sink takes rows one at a time (or
+straight from a generator with write_all), buffers `flush_every` of them
+and then writes them out:
+
+    CsvSink      csv.writer rows, header from `columns` or the first dict
+    JsonlSink    one JSON object per line
+    ParquetSink  one row group per flush (needs pyarrow), typed by the
+                 first flush or a given `schema`
+
+Rows go to "<path>.part" and the file is renamed to `path` only when the
+sink is closed cleanly, so readers never see half a file and a failed
+run leaves the previous output alone (and its rows so far in .part).
+"""
+
+import csv
+import importlib
+import json
+import os
+import sys
+import time
+
+from lazy import lazy_module
+from metrics import METRICS
+
+try:
+    pyarrow = lazy_module("pyarrow")  # loaded by the first ParquetSink
+except ImportError:
+    pyarrow = None
+
+
+class Sink:
+    mode = "w"
+
+    def __init__(self, path, columns=None, flush_every=1000):
+        self.path = path
+        self.part_path = path + ".part"
+        self.columns = list(columns) if columns else None
+        self.flush_every = flush_every
+        self.rows_written = 0
+        self._buffer = []
+        self._file = open(self.part_path, self.mode, **self._open_options())
+
+    def _open_options(self):
+        return {"newline": "", "encoding": "utf-8"}
+
+    def _record(self, row):
+        # Dicts keep their keys, lists/tuples are matched up with columns
+        if isinstance(row, dict):
+            if self.columns is None:
+                self.columns = list(row)
+            return row
+        if self.columns is None:
+            raise ValueError("Rows without keys need `columns`")
+        return dict(zip(self.columns, row))
+
+    def write(self, row):
+        self._buffer.append(row)
+        if len(self._buffer) >= self.flush_every:
+            self.flush()
+
+    def write_all(self, rows):
+        """Write every row of an iterable (a generator is never held in
+        memory as a whole), returns how many were written"""
+        count = 0
+        for row in rows:
+            self.write(row)
+            count += 1
+        return count
+
+    def flush(self):
+        if self._buffer:
+            with METRICS.time("stage_seconds", stage="write", sink=type(self).__name__):
+                self._write_rows(self._buffer)
+            self.rows_written += len(self._buffer)
+            self._buffer = []
+        self._file.flush()
+
+    def _write_rows(self, rows):
+        raise NotImplementedError
+
+    def _finish(self):
+        pass
+
+    def close(self):
+        """Flush what's left and move the finished file into place"""
+        self.flush()
+        self._finish()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self.part_path, self.path)
+
+    def abort(self):
+        # Keep the rows we got in .part, leave `path` as it was
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class CsvSink(Sink):
+    def __init__(self, path, columns=None, flush_every=1000, **csv_options):
+        self.csv_options = csv_options  # passed on to csv.writer
+        self._writer = None
+        super().__init__(path, columns, flush_every)
+
+    def _write_rows(self, rows):
+        if self._writer is None:
+            self._writer = csv.writer(self._file, **self.csv_options)
+            if self.columns is None and isinstance(rows[0], dict):
+                self.columns = list(rows[0])
+            if self.columns:
+                self._writer.writerow(self.columns)
+        columns = self.columns
+        self._writer.writerows(
+            [row.get(column) for column in columns] if isinstance(row, dict) else row
+            for row in rows
+        )
+
+    def _finish(self):
+        if self._writer is None and self.columns:
+            # No rows at all, still write the header like save_to_csv did
+            csv.writer(self._file, **self.csv_options).writerow(self.columns)
+
+
+class JsonlSink(Sink):
+    def _open_options(self):
+        return {"encoding": "utf-8"}
+
+    def _write_rows(self, rows):
+        self._file.write("".join(json.dumps(self._record(row), ensure_ascii=False) + "\n" for row in rows))
+
+
+class ParquetSink(Sink):
+    mode = "wb"
+
+    def __init__(self, path, columns=None, flush_every=50000, schema=None):
+        if pyarrow is None:
+            raise ImportError("Parquet output needs pyarrow (pip install pyarrow)")
+        importlib.import_module("pyarrow.parquet")  # makes pyarrow.parquet available
+        self.schema = schema
+        self._writer = None
+        super().__init__(path, columns or (schema.names if schema is not None else None), flush_every)
+
+    def _infer_schema(self, records):
+        # The first row group types the whole file, column by column in
+        # `columns` order (the first row's keys when not given). A column
+        # with only None in it so far would be typed null and reject later
+        # values, make it string; ints become float64, since the next page
+        # can give 12.99 where this one gave 1299
+        inferred = pyarrow.Table.from_pylist(records).schema
+        fields = []
+        for column in self.columns:
+            kind = inferred.field(column).type if column in inferred.names else pyarrow.null()
+            if pyarrow.types.is_null(kind):
+                kind = pyarrow.string()
+            elif pyarrow.types.is_integer(kind):
+                kind = pyarrow.float64()
+            fields.append(pyarrow.field(column, kind))
+        return pyarrow.schema(fields)
+
+    def _open_options(self):
+        return {}
+
+    def _write_rows(self, rows):
+        records = [self._record(row) for row in rows]
+        if self.schema is None:
+            self.schema = self._infer_schema(records)
+        if self._writer is None:
+            self._writer = pyarrow.parquet.ParquetWriter(self._file, self.schema)
+        # Built straight to the schema: values are taken by key whatever
+        # order a row has them in, missing keys are None and keys outside
+        # `columns` are left out, like CsvSink does
+        self._writer.write_table(pyarrow.Table.from_pylist(records, schema=self.schema))
+
+    def _finish(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+SINKS = {".csv": CsvSink, ".jsonl": JsonlSink, ".parquet": ParquetSink}
+
+
+def open_sink(path, columns=None, **options):
+    """Pick the sink for a file name by its extension"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in SINKS:
+        raise ValueError(f"No sink for {extension!r} files, choose from {', '.join(SINKS)}")
+    return SINKS[extension](path, columns, **options)
+
+
+def check_parquet_rows():
+    # Row dicts as scrapers build them: keys in another order, a key
+    # missing, an extra one, a price that is an int on one page and a
+    # float on the next and a column that is None for the whole first
+    # row group. Three rows per row group, so they land in different ones
+    import tempfile
+
+    if pyarrow is None:
+        print("skipped: pyarrow isn't installed")
+        return True
+    rows = [
+        {"title": "A", "price": 1299, "rating": None},
+        {"price": 5990, "title": "B", "rating": None},
+        {"title": "C", "rating": None, "price": 10},
+        {"rating": "Three", "price": 12.99, "title": "D"},
+        {"title": "E", "price": 45.5, "seller": "someone"},
+        {"price": 7, "rating": "One", "title": "F"},
+    ]
+    directory = tempfile.mkdtemp(prefix="sinks_")
+    path = os.path.join(directory, "rows.parquet")
+    with ParquetSink(path, flush_every=3) as sink:
+        sink.write_all(rows)
+    table = pyarrow.parquet.read_table(path)
+    os.remove(path)
+    os.rmdir(directory)
+    expected = [{"title": row["title"], "price": float(row["price"]), "rating": row.get("rating")} for row in rows]
+    ok = (table.column_names == ["title", "price", "rating"] and table.to_pylist() == expected
+          and str(table.schema.field("price").type) == "double")
+    print(f"{'ok ' if ok else 'BAD'} mixed row dicts: {table.num_rows} rows, schema "
+          f"{', '.join(f'{field.name}: {field.type}' for field in table.schema)}")
+    return ok
+
+
+def _synthetic_crawl(rows):
+    # Book-shaped rows, generated one at a time like a crawl would yield them
+    ratings = ("One", "Two", "Three", "Four", "Five")
+    for n in range(rows):
+        yield [f"Book number {n} with a longer title", f"£{n % 9000 / 100 + 10:.2f}", ratings[n % 5]]
+
+
+def _measure(mode, rows, path):
+    # Runs in a fresh interpreter so ru_maxrss is this mode's peak alone
+    import resource
+
+    columns = ["Title", "Price", "Rating"]
+    start = time.perf_counter()
+    if mode == "list+csv":
+        data = list(_synthetic_crawl(rows))  # accumulate, then save
+        with open(path, "w", newline="", encoding="utf-8") as file:
+            writer = csv.writer(file)
+            writer.writerow(columns)
+            writer.writerows(data)
+    else:
+        with open_sink(path, columns) as sink:
+            sink.write_all(_synthetic_crawl(rows))
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on Linux
+    print(f"{mode:<10} {rows:>9,} rows  peak RSS {peak:6.0f} MB  {elapsed:5.1f}s  "
+          f"{os.path.getsize(path) / 1024 / 1024:5.0f} MB file")
+
+
+def benchmark_memory(sizes=(100_000, 1_000_000)):
+    # Peak memory of accumulate-then-save against streaming sinks; the
+    # sinks should stay flat as the crawl grows
+    import subprocess
+    import tempfile
+
+    directory = tempfile.mkdtemp(prefix="sinks_")
+    modes = ["list+csv", ".csv", ".jsonl"] + ([".parquet"] if pyarrow else [])
+    for rows in sizes:
+        for mode in modes:
+            path = os.path.join(directory, "rows" + (".csv" if mode == "list+csv" else mode))
+            subprocess.run([sys.executable, __file__, "--measure", mode, str(rows), path], check=True)
+            os.remove(path)
+    os.rmdir(directory)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--measure"]:
+        _measure(sys.argv[2], int(sys.argv[3]), sys.argv[4])
+    elif "--check" in sys.argv:
+        sys.exit(0 if check_parquet_rows() else 1)
+    else:
+        benchmark_memory()
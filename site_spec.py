@@ -0,0 +1,298 @@
+"""
+Declarative site specs and the one engine that runs them.
+
+Every scraper here had the same shape: fetch, parse, select the item
+containers, pull a few fields out of each, follow the next link, write a
+CSV. A spec says just the site-specific parts (see specs/*.yaml):
+
+    start_urls    where the crawl begins
+    pagination    next: selector of the "next page" link
+    container     selector for one item
+    fields        column -> "css", "css@attr", "@attr", or a dict with
+                  select, attr, transforms, default, absolute
+    output        output file name (.csv, .jsonl or .parquet)
+    parse_only    simple selectors of the parts of the page to build when
+                  the plan parses with html.parser (default: the outermost
+                  step of container and pagination.next)
+
+compile_spec() turns a spec into an ExtractionPlan once: selectors are
+parsed for the parser engine, transforms looked up and every field
+becomes a small function, so extracting an item does no spec work at
+all.
+"""
+
+import csv
+import os
+import sys
+import time
+from urllib.parse import urljoin
+
+from fetcher import fetch
+from metrics import METRICS
+from parsers import DEFAULT_ENGINE, available_engines, compile_selector, parse, simple_selector
+from sinks import open_sink
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+SPEC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "specs")
+
+# name -> function(value) or function(value, argument)
+TRANSFORMS = {
+    "strip": lambda value: value.strip(),
+    "lower": lambda value: value.lower(),
+    "after": lambda value, separator: value.split(separator, 1)[-1],
+    "word": lambda value, index: value.split()[index],
+    "item": lambda value, index: value[index],
+    "replace": lambda value, pair: value.replace(*pair),
+}
+
+
+def load_spec(name_or_path):
+    """Load a spec from a YAML file, or by name from specs/"""
+    if yaml is None:
+        raise ImportError("Loading YAML specs needs PyYAML (pip install pyyaml)")
+    path = name_or_path
+    if not os.path.exists(path):
+        path = os.path.join(SPEC_DIR, f"{name_or_path}.yaml")
+    with open(path, encoding="utf-8") as f:
+        return yaml.safe_load(f)
+
+
+def _field_options(field):
+    # "h3 a@title" -> {"select": "h3 a", "attr": "title"}
+    if isinstance(field, dict):
+        return field
+    select, _, attr = field.partition("@")
+    return {"select": select.strip() or None, "attr": attr.strip() or None}
+
+
+def _compile_transform(transform):
+    if isinstance(transform, str):
+        name, arguments = transform, ()
+    else:
+        (name, argument), = transform.items()
+        arguments = (argument,)
+    if name not in TRANSFORMS:
+        raise ValueError(f"Unknown transform {name!r}, choose from {', '.join(TRANSFORMS)}")
+    function = TRANSFORMS[name]
+    return (lambda value: function(value, *arguments)) if arguments else function
+
+
+def _compile_field(field, engine):
+    options = _field_options(field)
+    select = compile_selector(options["select"], engine, first=True) if options.get("select") else None
+    attr = options.get("attr")
+    steps = [_compile_transform(transform) for transform in options.get("transforms", ())]
+    default = options.get("default")
+    absolute = options.get("absolute", False)
+
+    def extract(node, url):
+        if select is not None:
+            node = select(node)
+            if node is None:
+                return default
+        value = node.get(attr) if attr else node.text()
+        if value is None:
+            return default
+        if absolute:
+            value = urljoin(url, value)
+        for step in steps:
+            value = step(value)
+        return value
+
+    return extract
+
+
+def _parse_targets(spec):
+    # Every match of "div.grid ul li.item" sits inside some div.grid, so the
+    # first step of the container and next-link selectors is all the page
+    # a plan reads. Selector lists, sibling combinators and pseudo-classes
+    # can look outside that, those specs get a full parse
+    if "parse_only" in spec:
+        return spec["parse_only"] or None
+    selectors = [spec["container"]]
+    next_page = (spec.get("pagination") or {}).get("next")
+    if next_page:
+        selectors.append(_field_options(next_page).get("select"))
+    targets = []
+    for css in selectors:
+        if not css or any(character in css for character in ",+~:["):
+            return None
+        first = css.replace(">", " ").split()[0]
+        if simple_selector(first) is None:
+            return None
+        targets.append(first)
+    return targets
+
+
+class ExtractionPlan:
+    def __init__(self, spec, engine=None):
+        self.spec = spec
+        self.name = spec["name"]
+        self.engine = engine or DEFAULT_ENGINE
+        self.start_urls = spec["start_urls"]
+        self.headers = spec.get("headers")
+        self.require_text = spec.get("require_text")
+        self.output = spec.get("output", f"{self.name}.csv")
+        self.columns = list(spec["fields"])
+        self.container = compile_selector(spec["container"], self.engine)
+        self.fields = [_compile_field(field, self.engine) for field in spec["fields"].values()]
+        next_page = (spec.get("pagination") or {}).get("next")
+        self.next_page = _compile_field(next_page, self.engine) if next_page else None
+        # Only html.parser builds partial trees, the other engines ignore them
+        self.parse_only = _parse_targets(spec) if self.engine == "html.parser" else None
+
+    def extract(self, html, url):
+        """Return (rows, next_url) for one page"""
+        if self.require_text and self.require_text not in html:
+            raise ValueError(f"{url}: expected {self.require_text!r}, got a captcha or redirect?")
+        document = parse(html, self.engine, only=self.parse_only)
+        fields = self.fields
+        with METRICS.time("stage_seconds", stage="extract", spec=self.name):
+            rows = [[field(item, url) for field in fields] for item in self.container(document)]
+        next_url = self.next_page(document, url) if self.next_page else None
+        return rows, urljoin(url, next_url) if next_url else None
+
+    def iter_rows(self, start_urls=None, max_pages=None):
+        """Crawl from the start urls following pagination, yielding rows
+        page by page"""
+        found = False
+        for url in start_urls or self.start_urls:
+            pages = 0
+            while url and (max_pages is None or pages < max_pages):
+                response = fetch(url, headers=self.headers)
+                response.raise_for_status()
+                page_rows, url = self.extract(response.text, url)
+                found = found or bool(page_rows)
+                yield from page_rows
+                pages += 1
+        if not found:
+            raise ValueError(f"{self.name}: no items matched {self.spec['container']!r}")
+
+    def run(self, start_urls=None, max_pages=None):
+        return list(self.iter_rows(start_urls, max_pages))
+
+    def save(self, rows, filename=None):
+        """Stream rows (a list or iter_rows()) into a .csv, .jsonl or
+        .parquet file"""
+        filename = filename or self.output
+        with open_sink(filename, self.columns) as sink:
+            count = sink.write_all(rows)
+        print(f"Saved {count} rows to {filename}")
+
+
+def compile_spec(spec, engine=None):
+    if isinstance(spec, str):
+        spec = load_spec(spec)
+    return ExtractionPlan(spec, engine)
+
+
+def _extract_interpreted(spec, document, url):
+    # The same extraction without a plan: every item re-reads the spec,
+    # re-splits shorthand, re-looks up transforms and re-resolves selectors
+    rows = []
+    for item in document.select(spec["container"]):
+        row = []
+        for field in spec["fields"].values():
+            options = _field_options(field)
+            node = item
+            if options.get("select"):
+                node = item.select_one(options["select"])
+            if node is None:
+                row.append(options.get("default"))
+                continue
+            value = node.get(options["attr"]) if options.get("attr") else node.text()
+            if value is None:
+                row.append(options.get("default"))
+                continue
+            if options.get("absolute"):
+                value = urljoin(url, value)
+            for transform in options.get("transforms", ()):
+                value = _compile_transform(transform)(value)
+            row.append(value)
+        rows.append(row)
+    return rows
+
+
+def _spec_fixtures():
+    # (spec name, [(url path, html)], rows the current CSV / scraper gives)
+    from fixture_server import books_catalogue_pages, imdb_chart_page
+
+    def read_rows(csv_file):
+        with open(csv_file, newline="", encoding="utf-8") as f:
+            return list(csv.reader(f))[1:]
+
+    with open("sap.txt", encoding="utf-8", errors="replace") as f:
+        sapphire = f.read()
+    return [
+        ("books", list(books_catalogue_pages().items()), read_rows("books_data.csv")),
+        ("imdb", [("/chart/top/", imdb_chart_page())], read_rows("imdb_top_movies.csv")),
+        # The saved sapphire_men_collection.csv is empty (old selectors), so
+        # compare with the tiles the parser conformance check reads
+        ("sapphire", [("/collections/man", sapphire)], None),
+    ]
+
+
+def check_specs():
+    """Run every shipped spec against local copies of its site and compare
+    with the CSVs the old scripts produced"""
+    from fixture_server import FixtureServer
+    from parsers import _sapphire_fields, parse as parse_page
+
+    ok = True
+    for name, pages, expected in _spec_fixtures():
+        plan = compile_spec(name)
+        with FixtureServer(dict(pages), content_type="text/html; charset=utf-8"
+                           if name != "books" else "text/html") as server:
+            rows = plan.run([server.url(pages[0][0])])
+        if expected is None:
+            tiles = _sapphire_fields(parse_page(pages[0][1]))["products"]
+            expected = [[tile["title"], tile["price"], urljoin(server.url(pages[0][0]), tile["url"])]
+                        for tile in tiles]
+        same = rows == expected
+        ok = ok and same
+        print(f"{name:<9} {len(rows):4} rows  {'same as before' if same else 'ROWS DIFFER'}")
+    return ok
+
+
+def benchmark_plans(repeat=5):
+    # Time only the extraction over already parsed pages, per engine
+    for name, pages, _ in _spec_fixtures():
+        spec = load_spec(name)
+        for engine in available_engines():
+            plan = ExtractionPlan(spec, engine)
+            documents = [(parse(html, engine), "http://localhost" + path) for path, html in pages]
+            timings = {}
+            for label, extract in (
+                ("re-resolved", lambda doc, url: _extract_interpreted(spec, doc, url)),
+                ("compiled", lambda doc, url: [[field(item, url) for field in plan.fields]
+                                               for item in plan.container(doc)]),
+            ):
+                best = float("inf")
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    results = [extract(doc, url) for doc, url in documents]
+                    best = min(best, time.perf_counter() - start)
+                timings[label] = (best, results)
+            same = timings["re-resolved"][1] == timings["compiled"][1]
+            items = sum(len(rows) for rows in timings["compiled"][1])
+            print(f"{name:<9} {engine:<12} {items:5} items  "
+                  f"re-resolved {timings['re-resolved'][0] * 1000:7.1f} ms  "
+                  f"compiled {timings['compiled'][0] * 1000:7.1f} ms  "
+                  f"x{timings['re-resolved'][0] / timings['compiled'][0]:.1f}"
+                  f"{'' if same else '  ROWS DIFFER'}")
+
+
+if __name__ == "__main__":
+    if "--bench" in sys.argv:
+        benchmark_plans()
+    elif "--check" in sys.argv:
+        sys.exit(0 if check_specs() else 1)
+    else:
+        # python site_spec.py books [imdb ...] runs specs and writes their CSVs
+        for spec_name in sys.argv[1:]:
+            spec_plan = compile_spec(spec_name)
+            spec_plan.save(spec_plan.iter_rows())
@@ -38,9 +38,16 @@
 
 
 
-import requests
-import pandas as pd
-import time
+from concurrent.futures import ThreadPoolExecutor
+
+from rate_limit import AdaptiveLimiter
+from sinks import CsvSink
+
+# wttr.in politeness: start with one request in flight and let the
+# limiter open up to WORKERS while wttr.in answers normally, halving on
+# 429/503 and waiting out any Retry-After
+WORKERS = 8
+MAX_ATTEMPTS = 4  # per city
 
 # List of world capitals
 capitals = [
@@ -66,37 +73,57 @@ capitals = [
     "Caracas", "Hanoi", "Sana'a", "Lusaka", "Harare"
 ]
 
-# Initialize an empty list to store weather data
-weather_data = []
+limiter = AdaptiveLimiter(maximum=WORKERS, max_attempts=MAX_ATTEMPTS)
+
+
+def get_weather(city):
+    url = f"https://wttr.in/{city}?format=%C+%t+%h+%w"  # Fetch weather data in a readable format
 
-# Loop through each capital and scrape data
-for city in capitals:
     try:
-        url = f"https://wttr.in/{city}?format=%C+%t+%h+%w"  # Fetch weather data in a readable format
-        response = requests.get(url)
+        # Waits for a slot in wttr.in's window, retries throttled answers
+        response = limiter.get(url)
 
         if response.status_code == 200:
-            data = response.text.strip().split(" ")  # Split the response
+            # "Partly cloudy +15°C 55% ↓4km/h": the condition can have
+            # spaces, the three readings after it never do
+            data = response.text.strip().rsplit(" ", 3)
 
-            # Append data to the list
-            weather_data.append({
+            weather = {
                 "City": city,
                 "Condition": data[0],  # Weather condition (e.g., Clear, Rainy)
                 "Temperature": data[1],  # Temperature
                 "Humidity": data[2],  # Humidity
                 "Wind Speed": data[3]  # Wind Speed
-            })
+            }
             print(f"Retrieved: {city}")  # Print progress
+            return weather
 
-        else:
-            print(f"Failed to retrieve weather for {city}")
+        print(f"Failed to retrieve weather for {city} (HTTP {response.status_code})")
 
     except Exception as e:
         print(f"Error retrieving {city}: {e}")
-    time.sleep(1)  # Pause for 1 second to avoid being blocked
 
-# Save to CSV
-df = pd.DataFrame(weather_data)
-df.to_csv("world_capitals_weather.csv", index=False)
+    return None
+
+
+def main(filename="world_capitals_weather.csv"):
+    # Fetch all capitals in parallel, map() hands results back in input order
+    # and each one is written as soon as it (and the ones before it) arrive
+    failed = []
+    columns = ["City", "Condition", "Temperature", "Humidity", "Wind Speed"]
+    with ThreadPoolExecutor(max_workers=WORKERS) as pool, \
+            CsvSink(filename, columns, flush_every=20, lineterminator="\n") as sink:
+        for city, weather in zip(capitals, pool.map(get_weather, capitals)):
+            if weather:
+                sink.write(weather)
+            else:
+                failed.append(city)
+
+    if failed:
+        print(f"Gave up on {len(failed)} cities after {MAX_ATTEMPTS} attempts: {', '.join(failed)}")
+
+    print(f"✅ Weather data saved to '{filename}' successfully!")
+
 
-print("✅ Weather data saved to 'world_capitals_weather.csv' successfully!")
+if __name__ == "__main__":
+    main()
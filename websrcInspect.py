@@ -1,106 +1,137 @@
-from bs4 import BeautifulSoup
+from parsers import available_engines, parse
+import hashlib
+import json
 import re
+import sqlite3
+import sys
+import time
+
+# Class names and text that hint at each kind of field, compiled once
+NAME_CLASS_PATTERN = re.compile(r'title|name|heading', re.I)
+PRICE_CLASS_PATTERN = re.compile(r'price|cost|amount', re.I)
+RATING_CLASS_PATTERN = re.compile(r'rating|star|review', re.I)
+REVIEW_CLASS_PATTERN = re.compile(r'review|comment|feedback', re.I)
+
+PRICE_PATTERN = re.compile(r'\$?\d{1,3}(?:,\d{3})*(?:\.\d{2})?')
+RATING_PATTERN = re.compile(r'\d\.?\d? out of \d|[\d.]+/[\d.]+')
+REVIEW_PATTERN = re.compile(r'\d+ (?:reviews|ratings)')
+
 
 class WebStructureAnalyzer:
-    def __init__(self, html_content):
-        self.soup = BeautifulSoup(html_content, 'html.parser')
+    def __init__(self, html_content, engine=None):
+        self.document = parse(html_content, engine)
         self.findings = {
             'name': [],
             'price': [],
             'rating': [],
             'reviews': []
         }
-        
+        # category -> (tags it looks at, scoring function, minimum score)
+        self.detectors = {
+            'name': ({'h1', 'h2', 'h3', 'div', 'span', 'meta'}, self._score_name, 3),
+            'price': ({'span', 'div', 'meta', 'p', 'b'}, self._score_price, 2),
+            'rating': ({'div', 'span', 'meta', 'section'}, self._score_rating, 2),
+            'reviews': ({'div', 'span', 'a', 'section'}, self._score_reviews, 2),
+        }
+
     def analyze(self):
-        self._detect_names()
-        self._detect_prices()
-        self._detect_ratings()
-        self._detect_reviews()
+        # One walk over the tree scores every tag for all four categories
+        candidates = {category: [] for category in self.detectors}
+        for tag, text in self._scan():
+            for category, (tag_names, scorer, threshold) in self.detectors.items():
+                if tag.name not in tag_names:
+                    continue
+                score = scorer(tag, text)
+                if score > threshold:
+                    candidates[category].append(self._create_candidate(tag, text, score))
+
+        for category, found in candidates.items():
+            self.findings[category] = sorted(found, key=lambda x: x['confidence'], reverse=True)
         return self.findings
-    
-    def _detect_names(self):
-        candidates = []
-        for tag in self.soup.find_all(['h1', 'h2', 'h3', 'div', 'span', 'meta']):
-            text = self._get_element_text(tag)
-            attributes = tag.attrs
-            
-            score = 0
-            if tag.name in ['h1', 'h2', 'h3']:
-                score += 2
-            if 'itemprop' in attributes and 'name' in attributes['itemprop']:
-                score += 3
-            if 'class' in attributes and any(re.search(r'title|name|heading', c, re.I) for c in attributes['class']):
-                score += 2
-            if 10 < len(text) < 120:
-                score += 1
-                
-            if score > 3:
-                candidates.append(self._create_candidate(tag, text, score))
-        
-        self.findings['name'] = sorted(candidates, key=lambda x: x['confidence'], reverse=True)
-
-    def _detect_prices(self):
-        price_pattern = re.compile(r'\$?\d{1,3}(?:,\d{3})*(?:\.\d{2})?')
-        candidates = []
-        
-        for tag in self.soup.find_all(['span', 'div', 'meta', 'p', 'b']):
-            text = self._get_element_text(tag)
-            attributes = tag.attrs
-            
-            score = 0
-            if price_pattern.search(text):
-                score += 3
-            if 'itemprop' in attributes and 'price' in attributes['itemprop']:
-                score += 3
-            if 'class' in attributes and any(re.search(r'price|cost|amount', c, re.I) for c in attributes['class']):
-                score += 2
-                
-            if score > 2:
-                candidates.append(self._create_candidate(tag, text, score))
-        
-        self.findings['price'] = sorted(candidates, key=lambda x: x['confidence'], reverse=True)
-
-    def _detect_ratings(self):
-        rating_pattern = re.compile(r'\d\.?\d? out of \d|[\d.]+/[\d.]+')
-        candidates = []
-        
-        for tag in self.soup.find_all(['div', 'span', 'meta', 'section']):
-            text = self._get_element_text(tag)
-            attributes = tag.attrs
-            
-            score = 0
-            if rating_pattern.search(text):
-                score += 3
-            if 'itemprop' in attributes and 'ratingValue' in attributes['itemprop']:
-                score += 3
-            if 'class' in attributes and any(re.search(r'rating|star|review', c, re.I) for c in attributes['class']):
-                score += 2
-                
-            if score > 2:
-                candidates.append(self._create_candidate(tag, text, score))
-        
-        self.findings['rating'] = sorted(candidates, key=lambda x: x['confidence'], reverse=True)
-
-    def _detect_reviews(self):
-        review_pattern = re.compile(r'\d+ (?:reviews|ratings)')
-        candidates = []
-        
-        for tag in self.soup.find_all(['div', 'span', 'a', 'section']):
-            text = self._get_element_text(tag)
-            attributes = tag.attrs
-            
-            score = 0
-            if review_pattern.search(text):
-                score += 3
-            if 'itemprop' in attributes and 'reviewCount' in attributes['itemprop']:
-                score += 3
-            if 'class' in attributes and any(re.search(r'review|comment|feedback', c, re.I) for c in attributes['class']):
-                score += 2
-                
-            if score > 2:
-                candidates.append(self._create_candidate(tag, text, score))
-        
-        self.findings['reviews'] = sorted(candidates, key=lambda x: x['confidence'], reverse=True)
+
+    def analyze_selectors(self, selectors):
+        # Score only the tags matched by {category: [selector, ...]} instead
+        # of every tag. One selector list per category keeps document order
+        # and matches each tag once, as the full scan does
+        matched = {}
+        for category, (tag_names, _, _) in self.detectors.items():
+            if selectors.get(category):
+                matched[category] = [tag for tag in self.document.select(', '.join(selectors[category]))
+                                     if tag.name in tag_names]
+        # Matched tags are often containers of each other (div.page holds
+        # div#maincontent), so their texts come from one walk, not one each
+        wanted = {tag for tags in matched.values() for tag in tags}
+        texts = {tag: text for tag, text in self._scan(names={tag.name for tag in wanted}) if tag in wanted}
+
+        for category, (_, scorer, threshold) in self.detectors.items():
+            found = []
+            for tag in matched.get(category, ()):
+                text = texts.get(tag)
+                if text is None:  # not seen by the walk, read it on its own
+                    text = tag.get('content', '') if tag.name == 'meta' else tag.text()
+                score = scorer(tag, text)
+                if score > threshold:
+                    found.append(self._create_candidate(tag, text, score))
+            self.findings[category] = sorted(found, key=lambda x: x['confidence'], reverse=True)
+        return self.findings
+
+    def _scan(self, names=None):
+        # Yield (tag, text) in document order for every tag a detector looks
+        # at (or every tag in `names`), the parser builds all the texts in a
+        # single walk
+        wanted = names
+        if wanted is None:
+            wanted = set().union(*(tag_names for tag_names, _, _ in self.detectors.values()))
+        for tag, text in self.document.scan_text(wanted):
+            if tag.name == 'meta':
+                text = tag.get('content', '')
+            yield tag, text
+
+    def _score_name(self, tag, text):
+        attributes = tag.attrs
+        score = 0
+        if tag.name in ['h1', 'h2', 'h3']:
+            score += 2
+        if 'itemprop' in attributes and 'name' in attributes['itemprop']:
+            score += 3
+        if 'class' in attributes and any(NAME_CLASS_PATTERN.search(c) for c in attributes['class']):
+            score += 2
+        if 10 < len(text) < 120:
+            score += 1
+        return score
+
+    def _score_price(self, tag, text):
+        attributes = tag.attrs
+        score = 0
+        if PRICE_PATTERN.search(text):
+            score += 3
+        if 'itemprop' in attributes and 'price' in attributes['itemprop']:
+            score += 3
+        if 'class' in attributes and any(PRICE_CLASS_PATTERN.search(c) for c in attributes['class']):
+            score += 2
+        return score
+
+    def _score_rating(self, tag, text):
+        attributes = tag.attrs
+        score = 0
+        if RATING_PATTERN.search(text):
+            score += 3
+        if 'itemprop' in attributes and 'ratingValue' in attributes['itemprop']:
+            score += 3
+        if 'class' in attributes and any(RATING_CLASS_PATTERN.search(c) for c in attributes['class']):
+            score += 2
+        return score
+
+    def _score_reviews(self, tag, text):
+        attributes = tag.attrs
+        score = 0
+        if REVIEW_PATTERN.search(text):
+            score += 3
+        if 'itemprop' in attributes and 'reviewCount' in attributes['itemprop']:
+            score += 3
+        if 'class' in attributes and any(REVIEW_CLASS_PATTERN.search(c) for c in attributes['class']):
+            score += 2
+        return score
 
     def _create_candidate(self, tag, text, score):
         return {
@@ -119,16 +150,130 @@ class WebStructureAnalyzer:
             return f"{tag.name}.{'.'.join(classes)}"
         return tag.name
 
-    def _get_element_text(self, tag):
-        if tag.name == 'meta':
-            return tag.get('content', '')
-        return tag.get_text(strip=True)
+# Tags that make up a page template; what sits inside them (badges,
+# product names, prices) changes from page to page
+SKELETON_TAGS = {'html', 'body', 'header', 'nav', 'main', 'section', 'article', 'aside', 'footer',
+                 'div', 'ul', 'ol', 'form', 'table'}
+# Lower case only: a template writes its tags one way, and re.I makes the
+# scan over a 700 KB page twice as slow
+SKELETON_PATTERN = re.compile(r'<(%s)(?=[\s>])([^>]*)>' % '|'.join(sorted(SKELETON_TAGS)))
+CLASS_ATTRIBUTE_PATTERN = re.compile(r'\bclass\s*=\s*["\']([^"\']*)')
+
+PROFILE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS profile (
+    fingerprint TEXT PRIMARY KEY,
+    selectors TEXT NOT NULL,
+    pages INTEGER NOT NULL DEFAULT 0,
+    relearned INTEGER NOT NULL DEFAULT 0
+)
+"""
+
+
+def structure_fingerprint(html):
+    # Hash of the distinct tag.class signatures of the skeleton tags, read
+    # straight off the markup so it costs no parsing. Classes with digits
+    # ("product-1234") name content, not template, and are left out
+    signatures = set()
+    for name, attributes in SKELETON_PATTERN.findall(html):
+        match = CLASS_ATTRIBUTE_PATTERN.search(attributes)
+        classes = sorted(c for c in match.group(1).split() if not any(ch.isdigit() for ch in c)) if match else []
+        signatures.add('.'.join([name] + classes))
+    return hashlib.blake2b('\n'.join(sorted(signatures)).encode('utf-8'), digest_size=16).hexdigest()
+
+
+class SiteProfiles:
+    # Selectors learned per page template. The first page of a template gets
+    # the full scan, and the selectors of each category's best-scoring
+    # candidates (up to `keep`) are stored under the page's structure
+    # fingerprint; later pages with that fingerprint only evaluate those,
+    # so their top candidate is the one a full scan would rank first among
+    # the learned selectors. When a category's selectors match nothing any
+    # more the template has changed, so that page is scanned in full again
+    # and the profile relearned from it.
+    def __init__(self, path='site_profiles.db', keep=5):
+        self.keep = keep
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(PROFILE_SCHEMA)
+        self.profiles = {fingerprint: json.loads(selectors) for fingerprint, selectors in
+                         self.conn.execute('SELECT fingerprint, selectors FROM profile')}
+        self.stats = {'profile': 0, 'full': 0, 'relearned': 0}
+        self._hits = {}  # fingerprint -> pages analyzed from its selectors since the last save
+
+    def save(self):
+        with self.conn:
+            self.conn.executemany('UPDATE profile SET pages = pages + ? WHERE fingerprint = ?',
+                                  [(hits, fingerprint) for fingerprint, hits in self._hits.items()])
+        self._hits.clear()
+
+    def close(self):
+        self.save()
+        self.conn.close()
 
-def analyze_website(file_path):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def analyze(self, html, engine=None):
+        """Return (findings, how): how is 'profile' when only the learned
+        selectors were evaluated, 'full' when the page was scanned"""
+        fingerprint = structure_fingerprint(html)
+        analyzer = WebStructureAnalyzer(html, engine)
+        selectors = self.profiles.get(fingerprint)
+        if selectors is not None:
+            findings = analyzer.analyze_selectors(selectors)
+            if all(findings[category] for category in selectors if selectors[category]):
+                # Counted in memory, a commit per page would cost more than the analysis
+                self._hits[fingerprint] = self._hits.get(fingerprint, 0) + 1
+                self.stats['profile'] += 1
+                return findings, 'profile'
+            self.stats['relearned'] += 1
+
+        findings = analyzer.analyze()
+        self._learn(fingerprint, analyzer, findings, relearned=selectors is not None)
+        self.stats['full'] += 1
+        return findings, 'full'
+
+    def _learn(self, fingerprint, analyzer, findings, relearned=False):
+        selectors = {}
+        for category, candidates in findings.items():
+            # Candidates are sorted best first, keep the top confidence only
+            best = candidates[0]['confidence'] if candidates else None
+            learned = []
+            for selector in dict.fromkeys(c['selector'] for c in candidates if c['confidence'] == best):
+                try:
+                    analyzer.document.select(selector)  # ids and classes that aren't valid CSS
+                except Exception:
+                    continue
+                learned.append(selector)
+                if len(learned) == self.keep:
+                    break
+            selectors[category] = learned
+        self.profiles[fingerprint] = selectors
+        with self.conn:
+            self.conn.execute(
+                'INSERT INTO profile (fingerprint, selectors, pages, relearned) VALUES (?, ?, 1, ?) '
+                'ON CONFLICT(fingerprint) DO UPDATE SET selectors = excluded.selectors, '
+                'pages = pages + 1, relearned = relearned + excluded.relearned',
+                (fingerprint, json.dumps(selectors), int(relearned)))
+
+    def report(self):
+        return (f"{self.stats['profile']} pages from learned selectors, {self.stats['full']} full scans "
+                f"({self.stats['relearned']} after the selectors stopped matching), "
+                f"{len(self.profiles)} templates")
+
+
+def analyze_website(file_path, profiles=None):
+    # With a SiteProfiles, pages of a template seen before only evaluate
+    # the selectors learned from it
     try:
         with open(file_path, 'r', encoding='utf-8') as f:
-            analyzer = WebStructureAnalyzer(f.read())
-            return analyzer.analyze()
+            html = f.read()
+        if profiles is not None:
+            return profiles.analyze(html)[0]
+        analyzer = WebStructureAnalyzer(html)
+        return analyzer.analyze()
     except Exception as e:
         print(f"Error analyzing website: {str(e)}")
         return None
@@ -147,8 +292,132 @@ def print_recommendations(results):
             print(f"Confidence: {'★' * candidate['confidence']}")
             print("-" * 60)
 
+# Pages saved in this repo, used to time the analyzer
+BUNDLED_PAGES = ['demo.html', 'times.html', 'walmart_data.html', 'sap.txt']
+
+def benchmark_analyze(files=BUNDLED_PAGES, engines=None, repeat=5):
+    for file_path in files:
+        # times.html was saved in the Windows code page, don't choke on it
+        with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+            html = f.read()
+        print(f"{file_path} ({len(html) / 1024:.0f} KB)")
+
+        for engine in engines or available_engines():
+            parse_times, analyze_times = [], []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                analyzer = WebStructureAnalyzer(html, engine)
+                parse_times.append(time.perf_counter() - start)
+
+                start = time.perf_counter()
+                results = analyzer.analyze()
+                analyze_times.append(time.perf_counter() - start)
+
+            found = ', '.join(f"{category} {len(candidates)}" for category, candidates in results.items())
+            print(f"  {engine:<12} parse {min(parse_times) * 1000:>7.1f} ms  "
+                  f"analyze {min(analyze_times) * 1000:>7.1f} ms  ({found})")
+
+def _template_sites():
+    # (site, pages) where every page of a site shares one template: the
+    # catalogue fixture, store product pages, and sap.txt with its prices
+    # moved around
+    from fixture_server import PRODUCT_MARKUP, books_catalogue_pages, product_pages
+
+    sites = [('books catalogue', list(books_catalogue_pages().values()))]
+    for markup in PRODUCT_MARKUP:
+        sites.append((f'{markup} product', list(product_pages(markup, 50).values())))
+    with open('sap.txt', 'r', encoding='utf-8', errors='replace') as f:
+        sap = f.read()
+    sites.append(('sapphire collection', [
+        re.sub(r'Rs\.(\d)', lambda m, n=n: f'Rs.{(int(m.group(1)) + n) % 10}', sap) for n in range(20)
+    ]))
+    return sites
+
+
+def _winners(findings):
+    # The top candidate of each category, what a scraper would pick
+    return {category: (candidates[0]['selector'], candidates[0]['text']) if candidates else None
+            for category, candidates in findings.items()}
+
+
+def benchmark_profiles(engine=None):
+    # Every page analyzed with a full scan and through SiteProfiles; the
+    # first page of a template is learned, the rest use its selectors.
+    # Then the amazon pages again with the price span's class renamed, which
+    # keeps the template fingerprint but breaks its learned price selector
+    import os
+    import tempfile
+    from fixture_server import product_pages
+
+    directory = tempfile.mkdtemp(prefix='site_profiles_')
+    with SiteProfiles(os.path.join(directory, 'profiles.db')) as profiles:
+        for site, pages in _template_sites():
+            full_time = profile_time = 0.0
+            same = 0
+            for html in pages:
+                start = time.perf_counter()
+                expected = WebStructureAnalyzer(html, engine).analyze()
+                full_time += time.perf_counter() - start
+
+                start = time.perf_counter()
+                findings, _ = profiles.analyze(html, engine)
+                profile_time += time.perf_counter() - start
+                same += _winners(findings) == _winners(expected)
+            print(f"{site:<20} {len(pages):3} pages  full scan {full_time / len(pages) * 1000:7.2f} ms/page  "
+                  f"learned selectors {profile_time / len(pages) * 1000:7.2f} ms/page  "
+                  f"x{full_time / profile_time:.1f}  {same}/{len(pages)} same top candidates")
+
+        renamed = [html.replace('"a-price"', '"apex-price-to-pay"') for html in product_pages('amazon', 50).values()]
+        results = [profiles.analyze(html, engine)[1] for html in renamed]
+        print(f"amazon, price class renamed: {results.count('full')} full scan(s), "
+              f"{results.count('profile')} from relearned selectors")
+        print(profiles.report())
+    # SiteProfiles has closed its connection, nothing else holds the files
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+
+
+def check_profiles(engines=None, pages_per_site=5):
+    # SiteProfiles under every engine: learned selectors must give the
+    # full scan's top candidates, and a page whose template kept its
+    # fingerprint but lost a class must be rescanned, not raise
+    import os
+    import tempfile
+    from fixture_server import product_pages
+
+    ok = True
+    for engine in engines or available_engines():
+        directory = tempfile.mkdtemp(prefix='site_profiles_')
+        same = total = 0
+        with SiteProfiles(os.path.join(directory, 'profiles.db')) as profiles:
+            for _, pages in _template_sites():
+                for html in pages[:pages_per_site]:
+                    findings, _ = profiles.analyze(html, engine)
+                    same += _winners(findings) == _winners(WebStructureAnalyzer(html, engine).analyze())
+                    total += 1
+            renamed = next(iter(product_pages('amazon', 1).values())).replace('"a-price"', '"apex-price-to-pay"')
+            _, how = profiles.analyze(renamed, engine)
+            stats = profiles.report()
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+        ok = ok and same == total and how == 'full'
+        print(f"{engine:<12} {same}/{total} same top candidates, renamed price class: {how} scan  ({stats})")
+    return ok
+
+
 # Usage
 if __name__ == "__main__":
+    if "--check" in sys.argv:
+        sys.exit(0 if check_profiles() else 1)
+    if "--bench" in sys.argv:
+        benchmark_analyze()
+        sys.exit()
+    if "--profiles" in sys.argv:
+        benchmark_profiles()
+        sys.exit()
+
     file_path = r'F:\DS\web scraping\demo.html'  # Update with your file path
     analysis = analyze_website(file_path)
     
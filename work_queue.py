@@ -0,0 +1,398 @@
+"""
+Work queue shared by crawl workers in several processes, or on several
+machines that see the same file.
+
+The Frontier (frontier.py) hands URLs to threads of one process. Here
+the queue is an SQLite database any number of worker processes open at
+once, and each task is leased rather than handed out:
+
+    queued     waiting for a worker
+    leased     taken by a worker until `lease_until`; a lease that runs
+               out (the worker died or hung) makes the task queued again
+               for whoever asks next
+    done       finished, with the worker's JSON result stored with it
+    failed     its lease ran out or it raised `max_attempts` times
+
+Keys are unique, so putting a URL twice queues it once, and complete()
+only takes the first result for a key: a task that was leased again
+after its lease ran out can't be stored twice. merge() writes the
+results to a sink in the order the keys were first queued, so running
+it again gives the same file.
+
+A leased task's result and the keys it discovered are stored in one
+transaction. Workers poll while other workers still hold leases, since
+those may add more tasks (or die and give theirs back).
+
+The database keeps WAL mode, which needs shared memory between the
+processes: on a network volume pass wal=False.
+
+    python work_queue.py --worker QUEUE.db module:function
+    python work_queue.py [--bench]
+
+crawl() raises CrawlError when a task failed or was never done, so a
+crawl can't come back quietly short of pages.
+"""
+
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import time
+from importlib import import_module
+
+QUEUED, LEASED, DONE, FAILED = "queued", "leased", "done", "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    key TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_until REAL,
+    error TEXT,
+    result TEXT
+);
+CREATE INDEX IF NOT EXISTS tasks_state ON tasks(state);
+"""
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue:
+    def __init__(self, path="work_queue.db", visibility_timeout=60, max_attempts=3, wal=True):
+        self.visibility_timeout = visibility_timeout  # seconds a lease lasts
+        self.max_attempts = max_attempts
+        # Every worker writes here, wait for the others' transactions
+        # instead of failing with "database is locked"
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        if wal:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers
+        # can't both read a task as queued and lease it
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def put(self, keys):
+        """Queue keys not seen before, returns how many were new"""
+        conn = self._transaction()
+        try:
+            added = self._put(keys)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return added
+
+    def _put(self, keys):
+        before = self.conn.total_changes
+        self.conn.executemany("INSERT OR IGNORE INTO tasks (key, state) VALUES (?, ?)",
+                              ((key, QUEUED) for key in keys))
+        return self.conn.total_changes - before
+
+    def lease(self, worker, count=1):
+        """Up to `count` keys, now leased to `worker` for visibility_timeout
+        seconds. Tasks whose lease ran out are taken like queued ones"""
+        now = time.time()
+        conn = self._transaction()
+        try:
+            # A task that keeps killing its workers stops being retried
+            conn.execute(
+                "UPDATE tasks SET state = ?, error = 'lease expired' "
+                "WHERE state = ? AND lease_until < ? AND attempts >= ?",
+                (FAILED, LEASED, now, self.max_attempts),
+            )
+            keys = [key for key, in conn.execute(
+                "SELECT key FROM tasks WHERE state = ? OR (state = ? AND lease_until < ?) ORDER BY rowid LIMIT ?",
+                (QUEUED, LEASED, now, count),
+            )]
+            conn.executemany(
+                "UPDATE tasks SET state = ?, worker = ?, lease_until = ?, attempts = attempts + 1 WHERE key = ?",
+                ((LEASED, worker, now + self.visibility_timeout, key) for key in keys),
+            )
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return keys
+
+    def complete(self, key, result=None, follow=()):
+        """Store key's JSON serialisable result and queue the keys it led
+        to. False if the key was already done (by a worker whose lease on
+        it had run out), in which case nothing changes"""
+        conn = self._transaction()
+        try:
+            cursor = conn.execute(
+                "UPDATE tasks SET state = ?, result = ?, lease_until = NULL, error = NULL "
+                "WHERE key = ? AND state != ?",
+                (DONE, json.dumps(result), key, DONE),
+            )
+            stored = cursor.rowcount == 1
+            if stored:
+                self._put(follow)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return stored
+
+    def fail(self, key, worker, error):
+        """Requeue key, or mark it failed once it used up its attempts.
+        Nothing changes if the lease has gone to another worker"""
+        conn = self._transaction()
+        try:
+            conn.execute(
+                "UPDATE tasks SET state = CASE WHEN attempts < ? THEN ? ELSE ? END, "
+                "lease_until = NULL, error = ? WHERE key = ? AND state = ? AND worker = ?",
+                (self.max_attempts, QUEUED, FAILED, str(error), key, LEASED, worker),
+            )
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def counts(self):
+        counts = {QUEUED: 0, LEASED: 0, DONE: 0, FAILED: 0}
+        counts.update(self.conn.execute("SELECT state, COUNT(*) FROM tasks GROUP BY state"))
+        return counts
+
+    def results(self):
+        """Yield (key, result) for done keys in the order they were queued"""
+        for key, result in self.conn.execute("SELECT key, result FROM tasks WHERE state = ? ORDER BY rowid",
+                                             (DONE,)):
+            yield key, json.loads(result)
+
+    def errors(self):
+        return dict(self.conn.execute("SELECT key, error FROM tasks WHERE state = ?", (FAILED,)))
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_handler(name):
+    """The function behind a "module:function" name"""
+    module, _, function = name.partition(":")
+    return getattr(import_module(module), function)
+
+
+def run_worker(queue, handler, worker=None, batch=1, poll_interval=0.2):
+    """Lease and run tasks until none are queued or leased. handler(key)
+    returns (result, keys to queue next). Returns how many tasks this
+    worker completed"""
+    worker = worker or worker_name()
+    completed = 0
+    while True:
+        keys = queue.lease(worker, batch)
+        if not keys:
+            counts = queue.counts()
+            if not counts[QUEUED] and not counts[LEASED]:
+                return completed
+            time.sleep(poll_interval)  # others may still add tasks, or die
+            continue
+        for key in keys:
+            try:
+                result, follow = handler(key)
+            except Exception as e:
+                queue.fail(key, worker, e)
+                continue
+            completed += queue.complete(key, result, follow)
+
+
+def start_workers(path, handler, count, visibility_timeout=60):
+    """`count` worker processes on this machine working on the queue at
+    `path`, for handler given as "module:function". Run the same command
+    on other machines to add theirs"""
+    command = [sys.executable, os.path.abspath(__file__), "--worker", path, handler,
+               "--visibility-timeout", str(visibility_timeout)]
+    return [subprocess.Popen(command) for _ in range(count)]
+
+
+def merge(queue, sink):
+    """Write every done task's result rows to the sink in queue order,
+    returns how many rows were written"""
+    return sum(sink.write_all(rows) for _, rows in queue.results())
+
+
+class CrawlError(RuntimeError):
+    """Tasks failed or were left unfinished. The queue at `path` keeps
+    what was done, for a look or a partial merge"""
+
+    def __init__(self, path, errors, counts, exit_codes):
+        self.path = path
+        self.errors = errors  # {key: last error} of the failed tasks
+        self.counts = counts
+        self.exit_codes = exit_codes  # non-zero exit codes of the workers
+        unfinished = counts[QUEUED] + counts[LEASED]
+        message = f"{len(errors)} tasks failed, {unfinished} unfinished"
+        if exit_codes:
+            message += f", workers exited with {exit_codes}"
+        if errors:
+            key, error = next(iter(errors.items()))
+            message += f"; {key}: {error}"
+        super().__init__(message)
+
+
+def crawl(path, seeds, handler, workers=4, visibility_timeout=60, log=print):
+    """Queue the seeds, run `workers` local processes until the queue is
+    drained and return the open queue to merge from. Raises CrawlError if
+    any task failed or was never done; a worker that died while the others
+    finished its tasks is only logged"""
+    queue = WorkQueue(path, visibility_timeout)
+    queue.put(seeds)
+    processes = start_workers(path, handler, workers, visibility_timeout)
+    for process in processes:
+        process.wait()
+    exit_codes = [process.returncode for process in processes if process.returncode]
+    if exit_codes:
+        log(f"{len(exit_codes)} of {workers} workers exited with {exit_codes}")
+    counts, errors = queue.counts(), queue.errors()
+    if errors or counts[QUEUED] or counts[LEASED]:
+        queue.close()
+        raise CrawlError(path, errors, counts, exit_codes)
+    return queue
+
+
+def _books_server(delay, per_page):
+    from fixture_server import FixtureServer, books_catalogue_pages
+    return FixtureServer(books_catalogue_pages(per_page=per_page), delay=delay)
+
+
+def benchmark_workers(counts=(1, 2, 4, 8), delay=0.1, per_page=5):
+    # The books crawl through the queue against a local catalogue of small
+    # pages, each taking `delay` to serve, with more and more workers.
+    # Pages/s counts from the first page served to the last, so it leaves
+    # out the workers' interpreter start-up (~0.8s of CPU each here)
+    import tempfile
+    from bookscrapingproject import scrape_books
+
+    with _books_server(delay, per_page) as server:
+        start_url = server.url("/catalogue/page-1.html")
+        expected = scrape_books(start_url)
+        pages = len(server.pages)
+        print(f"{pages} catalogue pages, {delay * 1000:.0f} ms per page")
+        single = None
+        for count in counts:
+            path = os.path.join(tempfile.mkdtemp(prefix="work_queue_"), "queue.db")
+            with WorkQueue(path) as queue:
+                queue.put([start_url])
+            server.requests_served = 0
+            start = time.perf_counter()
+            processes = start_workers(path, "bookscrapingproject:books_task", count)
+            first = last = None
+            while any(process.poll() is None for process in processes):
+                if first is None and server.requests_served:
+                    first = time.perf_counter()
+                if last is None and server.requests_served >= pages:
+                    last = time.perf_counter()
+                time.sleep(0.002)
+            elapsed = time.perf_counter() - start
+            with WorkQueue(path) as queue:
+                rows = [row for _, page_rows in queue.results() for row in page_rows]
+            rate = pages / (last - first)
+            single = single or rate / count
+            print(f"  {count} worker{'s' if count > 1 else ' '}: {elapsed:5.2f}s wall  {rate:6.1f} pages/s  "
+                  f"x{rate / single:.1f}  {'same rows' if rows == expected else 'ROWS DIFFER'}")
+
+
+def demo_worker_death(workers=3, kill_after=40, delay=0.05, per_page=5, visibility_timeout=2):
+    # Kill one of the workers outright mid-crawl: the pages it had leased
+    # go to the others once their lease runs out, and merging into a CSV
+    # twice gives the same file with every book once. Returns whether it did
+    import tempfile
+    from bookscrapingproject import scrape_books
+    from sinks import CsvSink
+
+    directory = tempfile.mkdtemp(prefix="work_queue_")
+    path = os.path.join(directory, "queue.db")
+    with _books_server(delay, per_page) as server:
+        start_url = server.url("/catalogue/page-1.html")
+        expected = scrape_books(start_url)
+        server.requests_served = 0
+        with WorkQueue(path, visibility_timeout) as queue:
+            queue.put([start_url])
+        processes = start_workers(path, "bookscrapingproject:books_task", workers, visibility_timeout)
+        while server.requests_served < kill_after:
+            time.sleep(0.005)
+        processes[0].kill()
+        for process in processes:
+            process.wait()
+        fetched = server.requests_served
+
+    outputs = []
+    with WorkQueue(path) as queue:
+        leased_again = queue.conn.execute("SELECT COUNT(*) FROM tasks WHERE attempts > 1").fetchone()[0]
+        for run in (1, 2):
+            out = os.path.join(directory, f"books-{run}.csv")
+            with CsvSink(out, ["Title", "Price", "Rating"]) as sink:
+                merge(queue, sink)
+            with open(out, "rb") as f:
+                outputs.append(f.read())
+        rows = [row for _, page_rows in queue.results() for row in page_rows]
+        counts = queue.counts()
+    exit_codes = [process.returncode for process in processes]
+    ok = (exit_codes[0] != 0 and not any(exit_codes[1:]) and not counts[FAILED] and not counts[QUEUED]
+          and not counts[LEASED] and rows == expected and outputs[0] == outputs[1])
+    print(f"killed 1 of {workers} workers after {kill_after} pages served; {fetched} fetches for "
+          f"{counts[DONE]} pages, {leased_again} leased again, {counts[FAILED]} failed, exit codes {exit_codes}")
+    print(f"{'ok ' if ok else 'BAD'} rows: {len(rows)}, same as a serial crawl: {rows == expected}, "
+          f"two merges give the same file: {outputs[0] == outputs[1]}")
+    return ok
+
+
+def _failing_task(key):
+    # A work_queue task for check_crawl_errors(): keys starting with "bad"
+    # raise every time
+    if key.startswith("bad"):
+        raise ValueError(f"can't handle {key}")
+    return [key], []
+
+
+def check_crawl_errors():
+    # A task that keeps raising fails the crawl instead of leaving a hole
+    # in the results, and says which key and why
+    import tempfile
+
+    path = os.path.join(tempfile.mkdtemp(prefix="work_queue_"), "queue.db")
+    try:
+        crawl(path, ["a", "bad-1", "c"], "work_queue:_failing_task", workers=1).close()
+        error = None
+    except CrawlError as e:
+        error = e
+    ok = error is not None and list(error.errors) == ["bad-1"] and error.counts[DONE] == 2
+    print(f"{'ok ' if ok else 'BAD'} failing task: {error!r}")
+    return ok
+
+
+def main(arguments):
+    if arguments[:1] == ["--worker"]:
+        options = {"--visibility-timeout": "60", "--batch": "1"}
+        path, handler = arguments[1:3]
+        rest = arguments[3:]
+        while rest:
+            option = rest.pop(0)
+            options[option] = rest.pop(0)
+        with WorkQueue(path, float(options["--visibility-timeout"])) as queue:
+            run_worker(queue, load_handler(handler), batch=int(options["--batch"]))
+        return 0
+    ok = check_crawl_errors()
+    ok = demo_worker_death() and ok
+    if "--bench" in arguments:
+        benchmark_workers()
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))